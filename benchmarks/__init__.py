@@ -0,0 +1,36 @@
+import os
+import timeit
+from typing import Callable
+
+# importing the model requires the bot configuration to be present
+os.environ.setdefault('BOT_ADMIN_ID', '0')
+os.environ.setdefault('TELEGRAM_API_TOKEN', '0:benchmark')
+
+import common  # noqa: E402,F401 (resolves the common <-> model import cycle)
+
+
+def time_per_call(func: Callable[[], None], number: int = 10000, repeat: int = 5) -> float:
+    return min(timeit.repeat(func, number=number, repeat=repeat)) / number
+
+
+def synthetic_users(users: int = 1000, goals_per_user: int = 3, points_per_goal: int = 100, seed: int = 0):
+    import random
+    from datetime import datetime, timedelta
+    from common import goal_score_types
+    from model import Goal, User, UserList
+
+    rand = random.Random(seed)
+    start = datetime(2021, 1, 1, 11)
+    user_list = UserList()
+    for uid in range(1, users + 1):
+        user = User(uid)
+        user.authorized = True
+        user.chat_id = uid
+        for idx in range(goals_per_user):
+            score_type = goal_score_types[idx % len(goal_score_types)]
+            goal = Goal(f'goal {idx}', '0 11 * * *', score_type, -1 if score_type == goal_score_types[0] else 10, uid)
+            for day in range(points_per_goal):
+                goal.add_data(1 if rand.random() < 0.7 else 0, start + timedelta(days=day))
+            user.add_goal(goal)
+        user_list.append(user)
+    return user_list
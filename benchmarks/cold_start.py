@@ -0,0 +1,52 @@
+import copyreg
+import os
+import pickle
+import sys
+import tempfile
+import time
+from benchmarks import synthetic_users
+from model import Goal
+from persistence import SQLitePersistence, BotData, unpickle
+
+
+class LegacyGoal:
+    """Pickles like a goal stored by the first versions of the bot (one dict per data point, scalar scores)"""
+
+    def __init__(self, goal: Goal):
+        self.state = {'title': goal.title, 'cron': goal.cron, 'score_type': goal.score_type,
+                      'score_range': goal.score_range, 'waiting_for_data': False,
+                      'data': [{'time': t, 'value': v, 'score': float(s)}
+                               for t, v, s in zip(goal.times, goal.values, goal.scores(goal.score_type))]}
+
+    def __reduce__(self):
+        return copyreg._reconstructor, (Goal, object, None), self.state
+
+
+def timed(func) -> float:
+    start = time.perf_counter()
+    func()
+    return time.perf_counter() - start
+
+
+def run(users: int = 10000, goals_per_user: int = 3, points_per_goal: int = 100):
+    user_list = synthetic_users(users, goals_per_user, points_per_goal)
+    print(f'{users} users, {goals_per_user} goals per user, {points_per_goal} data points per goal')
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'state.sqlite')
+        persistence = SQLitePersistence(path)
+        persistence.save_bot_data(BotData(users=user_list))
+        persistence.close()
+        # the first open of a database written by a former version migrates it
+        SQLitePersistence(path).close()
+        load = timed(lambda: SQLitePersistence(path).load_bot_data())
+        print(f'loading the database:       {load:>7.2f}s ({os.path.getsize(path) / 2**20:.1f}MB)')
+
+    pickled = pickle.dumps(user_list)
+    print(f'unpickling the users:       {timed(lambda: pickle.loads(pickled)):>7.2f}s')
+
+    legacy = pickle.dumps([[LegacyGoal(goal) for goal in user.goals] for user in user_list])
+    print(f'unpickling legacy goals:    {timed(lambda: unpickle(legacy)):>7.2f}s')
+
+
+if __name__ == '__main__':
+    run(*map(int, sys.argv[1:]))
@@ -0,0 +1,53 @@
+import contextlib
+import io
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+from benchmarks import synthetic_users
+
+
+def measured(func):
+    """The seconds and the peak of the memory allocated by a call"""
+    start = time.perf_counter()
+    func()
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    func()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+def run(goals: int = 1000, points_per_goal: int = 100):
+    from persistence import SQLitePersistence, export_formats, export_snapshot, import_exports, write_export
+
+    user = synthetic_users(1, goals, points_per_goal)[1]
+    print(f'1 user with {goals} goals of {points_per_goal} data points')
+    # the part of /export that runs on the event loop
+    elapsed, peak = measured(lambda: export_snapshot(user))
+    print(f'snapshot      {elapsed * 1e3:>8.1f}ms, peak {peak / 2**10:>7.1f}KB')
+    snapshot = export_snapshot(user)
+    with tempfile.TemporaryDirectory() as directory:
+        for name, export in export_formats.items():
+            path = os.path.join(directory, f'export.{name}')
+
+            elapsed, peak = measured(lambda: write_export(path, name, snapshot))
+            print(f'/export {name:<6} {elapsed * 1e3:>8.1f}ms, peak {peak / 2**10:>7.1f}KB '
+                  f'({os.path.getsize(path) / 2**20:.1f}MB written)')
+            _, joined = measured(lambda: ''.join(export(snapshot)))
+            print(f'  as one string:           peak {joined / 2**10:>7.1f}KB')
+
+        persistence = SQLitePersistence(os.path.join(directory, 'state.sqlite'))
+        with contextlib.redirect_stdout(io.StringIO()):
+            start = time.perf_counter()
+            import_exports(directory, persistence)
+            elapsed = time.perf_counter() - start
+        imported = persistence.load_bot_data()['users'][user.id]
+        persistence.close()
+    print(f'importing both:   {elapsed:>8.2f}s ({sum(len(goal.times) for goal in imported.goals)} data points)')
+
+
+if __name__ == '__main__':
+    run(*map(int, sys.argv[1:]))
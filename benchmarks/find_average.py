@@ -0,0 +1,68 @@
+import random
+import timeit
+from datetime import datetime, timedelta
+import numpy as np
+import benchmarks  # noqa: F401
+from stats.chart import find_averages
+
+
+def find_average_reference(all_goals_data, x_curr: datetime, x_min: datetime) -> float:
+    """The former pure python implementation (one sample per call, linear bracket search)"""
+    summed = 0
+    count = 0
+    for goal in all_goals_data:
+        xs = goal['x']
+        ys = goal['y']
+        if xs[0] > x_curr or len(xs) == 0:
+            continue
+        if xs[-1] < x_curr:
+            if xs[0] >= x_min:
+                count += 1
+                summed += ys[-1]
+            continue
+        if xs[0] == x_curr:
+            count += 1
+            summed += ys[0]
+            continue
+        elif xs[-1] == x_curr:
+            count += 1
+            summed += ys[-1]
+            continue
+        bounds = next((i, i + 1) for i, (x0, x1) in enumerate(zip(xs[:-1], xs[1:])) if x0 <= x_curr <= x1)
+        y_0, y_1, x_0, x_1 = ys[bounds[0]], ys[bounds[1]], xs[bounds[0]], xs[bounds[1]]
+        summed += ((y_1 - y_0) / (x_1 - x_0).total_seconds()) * (x_curr - x_0).total_seconds() + y_0
+        count += 1
+    return 0 if count == 0 else summed / count
+
+
+def run(goals=500, points=100, samples=100):
+    rand = random.Random(0)
+    start = datetime(2021, 1, 1)
+    series = []
+    for _ in range(goals):
+        offset = rand.randint(0, 50)
+        xs = [start + timedelta(days=offset + day, hours=rand.random()) for day in range(points)]
+        series.append({'x': xs, 'y': [rand.random() for _ in range(points)]})
+    x_min = min(s['x'][0] for s in series)
+    x_max = max(s['x'][-1] for s in series)
+    interval = (x_max - x_min) / samples
+    sample_times = [x_min + interval * i for i in range(samples)] + [x_max]
+
+    vectorized_series = [{'x': np.array([x.timestamp() for x in s['x']]), 'y': np.array(s['y'])} for s in series]
+    sample_timestamps = np.array([x.timestamp() for x in sample_times])
+
+    reference = [find_average_reference(series, x, x_min) for x in sample_times]
+    vectorized = find_averages(vectorized_series, sample_timestamps, x_min.timestamp())
+    assert np.allclose(reference, vectorized), 'vectorized averages differ from the reference implementation'
+
+    reference_time = min(timeit.repeat(lambda: [find_average_reference(series, x, x_min) for x in sample_times],
+                                       number=1, repeat=3))
+    vectorized_time = min(timeit.repeat(lambda: find_averages(vectorized_series, sample_timestamps,
+                                                              x_min.timestamp()), number=10, repeat=3)) / 10
+    print(f'{goals} goals x {points} points, {len(sample_times)} samples')
+    print(f'per sample python loop: {reference_time * 1e3:>9.2f}ms')
+    print(f'batched numpy:          {vectorized_time * 1e3:>9.2f}ms ({reference_time / vectorized_time:.0f}x)')
+
+
+if __name__ == '__main__':
+    run()
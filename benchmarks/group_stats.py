@@ -0,0 +1,55 @@
+import asyncio
+import contextlib
+import io
+import sys
+import time
+from types import SimpleNamespace
+from benchmarks import synthetic_users
+
+
+class Message:
+    async def reply_photo(self, *args, **kwargs):
+        return None
+
+    async def reply_text(self, *args, **kwargs):
+        return None
+
+
+def fake_update(chat_id: int, chat_type: str, user_id: int):
+    return SimpleNamespace(effective_chat=SimpleNamespace(id=chat_id, type=chat_type),
+                           effective_user=SimpleNamespace(id=user_id), message=Message())
+
+
+async def time_stats(update, context, number: int) -> float:
+    from stats import handle_stats
+    with contextlib.redirect_stdout(io.StringIO()):
+        await handle_stats(update, context)
+        start = time.perf_counter()
+        for _ in range(number):
+            await handle_stats(update, context)
+    return (time.perf_counter() - start) / number
+
+
+def run(members: int = 200, goals_per_user: int = 3, points_per_goal: int = 100, number: int = 20):
+    from stats.evaluation import chart_cache
+
+    users = synthetic_users(members, goals_per_user, points_per_goal)
+    group_id = -1
+    chat_data = {group_id: {'users': {user.id for user in users}}}
+    bot_data = {'users': users}
+    application = SimpleNamespace(chat_data=chat_data, bot_data=bot_data)
+    context = SimpleNamespace(application=application, bot_data=bot_data, chat_data=chat_data[group_id])
+
+    # the charts are served from the cache, so only the handlers are timed
+    chart_cache.put(chart_cache.key(users[1].goals, False), 'cached')
+    chart_cache.put(chart_cache.key([goal for user in users for goal in user.goals], False), 'cached')
+
+    private = asyncio.run(time_stats(fake_update(1, 'private', 1), context, number))
+    group = asyncio.run(time_stats(fake_update(group_id, 'group', 1), context, number))
+    print(f'{members} members with {goals_per_user} goals of {points_per_goal} data points')
+    print(f'private /stats: {private * 1e3:>8.2f}ms')
+    print(f'group /stats:   {group * 1e3:>8.2f}ms ({group / private:.1f}x)')
+
+
+if __name__ == '__main__':
+    run(*map(int, sys.argv[1:]))
@@ -0,0 +1,34 @@
+import asyncio
+import time
+import benchmarks  # noqa: F401 (sets up the bot configuration)
+from metrics import timed_handler, registry
+
+
+async def handle(update, context):
+    return None
+
+
+async def time_calls(callback, number: int, repeat: int) -> float:
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            await callback(None, None)
+        timings.append((time.perf_counter() - start) / number)
+    return min(timings)
+
+
+async def run(number: int = 100000, repeat: int = 5):
+    plain = await time_calls(handle, number, repeat)
+    timed = await time_calls(timed_handler(handle, 'benchmark'), number, repeat)
+    print(f'handler call:            {plain * 1e6:>6.2f}us')
+    print(f'instrumented call:       {timed * 1e6:>6.2f}us')
+    print(f'overhead per update:     {(timed - plain) * 1e6:>6.2f}us')
+
+    start = time.perf_counter()
+    body = registry.render()
+    print(f'rendering the metrics:   {(time.perf_counter() - start) * 1e3:>6.2f}ms ({len(body)} bytes)')
+
+
+if __name__ == '__main__':
+    asyncio.run(run())
@@ -0,0 +1,102 @@
+import asyncio
+import statistics
+import sys
+import time
+from collections import defaultdict, deque
+from telegram.error import RetryAfter
+import benchmarks  # noqa: F401 (sets up the bot configuration)
+from messaging import OutboundQueue, Priority
+
+
+class FakeBot:
+    """Answers after a fixed latency and enforces Telegram's flood limits (scaled by ``speedup``)"""
+
+    def __init__(self, speedup: float, latency: float = 0.03):
+        self.latency = latency / speedup
+        self.window = 1. / speedup
+        self.global_limit = 30
+        self.flood_errors = 0
+        self.sent = 0
+        self._global = deque()
+        self._chats = defaultdict(deque)
+
+    async def send_message(self, chat_id, text, **kwargs):
+        await asyncio.sleep(self.latency)
+        now = time.monotonic()
+        for sent in [self._global] + [self._chats[chat_id]]:
+            while len(sent) > 0 and sent[0] < now - self.window:
+                sent.popleft()
+        # a chat may receive a short burst, but not more than 3 messages a second
+        if len(self._global) >= self.global_limit or len(self._chats[chat_id]) >= 3:
+            self.flood_errors += 1
+            raise RetryAfter(self.window)
+        self._global.append(now)
+        self._chats[chat_id].append(now)
+        self.sent += 1
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+async def run_queue(users: int, messages_per_user: int, interactive: int, speedup: float):
+    bot = FakeBot(speedup)
+    queue = OutboundQueue(bot, global_rate=30 * speedup, chat_rate=1 * speedup, chat_burst=2, concurrency=8)
+    delays = {Priority.SCHEDULED: [], Priority.INTERACTIVE: []}
+
+    def track(priority, future, enqueued):
+        future.add_done_callback(lambda f: delays[priority].append(time.monotonic() - enqueued))
+        return future
+
+    start = time.monotonic()
+    futures = []
+    for user in range(users):
+        for _ in range(messages_per_user):
+            futures.append(track(Priority.SCHEDULED, queue.send_message(user, 'prompt'), time.monotonic()))
+    # interactive replies keep arriving while the fan-out is in progress
+    for idx in range(interactive):
+        await asyncio.sleep(0.5 / speedup)
+        futures.append(track(Priority.INTERACTIVE, queue.send_message(users + idx, 'reply', Priority.INTERACTIVE),
+                             time.monotonic()))
+    await asyncio.wait(futures)
+    duration = time.monotonic() - start
+    await queue.stop()
+    return bot, duration, delays
+
+
+async def run_direct(users: int, messages_per_user: int, speedup: float):
+    bot = FakeBot(speedup)
+    slots = asyncio.Semaphore(8)
+    failed = 0
+
+    async def send(chat_id):
+        nonlocal failed
+        async with slots:
+            try:
+                await bot.send_message(chat_id, 'prompt')
+            except RetryAfter:
+                failed += 1
+
+    await asyncio.gather(*(send(user) for user in range(users) for _ in range(messages_per_user)))
+    return failed
+
+
+def run(users=300, messages_per_user=4, interactive=50, speedup=10.):
+    total = users * messages_per_user
+    print(f'{users} users x {messages_per_user} scheduled messages, {interactive} interactive replies, '
+          f'limits and latency scaled by {speedup:g}')
+    print(f'direct sending: {asyncio.run(run_direct(users, messages_per_user, speedup))} of {total} messages rejected '
+          f'with RetryAfter')
+
+    for label, per_user in [('separate prompts', messages_per_user), ('merged prompts', 1)]:
+        bot, duration, delays = asyncio.run(run_queue(users, per_user, interactive, speedup))
+        print(f'queue, {label}: {bot.sent} sent in {duration * speedup:.1f}s (unscaled), '
+              f'{bot.sent / duration / speedup:.1f} msg/s, {bot.flood_errors} RetryAfter')
+        for priority, values in delays.items():
+            print(f'  {priority.name.lower():>12}: p50 {statistics.median(values) * speedup:6.2f}s '
+                  f'p99 {percentile(values, 0.99) * speedup:6.2f}s (unscaled)')
+
+
+if __name__ == '__main__':
+    run(*(float(arg) if idx == 3 else int(arg) for idx, arg in enumerate(sys.argv[1:])))
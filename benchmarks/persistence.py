@@ -0,0 +1,43 @@
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from copy import deepcopy
+from datetime import datetime, timedelta
+from telegram.ext import PicklePersistence
+from benchmarks import synthetic_users
+from persistence import SQLitePersistence, BotData
+
+
+async def flush_latency(persistence, bot_data, rounds: int) -> float:
+    # like the application, which deep copies the bot data for every update (a no-op for BotData)
+    users = bot_data['users']
+    await persistence.update_bot_data(deepcopy(bot_data))
+    timings = []
+    for i in range(rounds):
+        user = users[(i * 7919) % len(users) + 1]
+        user.goals[0].add_data(1, datetime(2022, 1, 1) + timedelta(days=i))
+        users.mark_dirty(user)
+        start = time.perf_counter()
+        await persistence.update_bot_data(deepcopy(bot_data))
+        timings.append(time.perf_counter() - start)
+    return statistics.median(timings)
+
+
+def run(sizes=(100, 1000, 10000), goals_per_user=3, points_per_goal=100, rounds=5):
+    print(f"{'users':>8} {'pickle':>12} {'sqlite':>12}   (latency of persisting one answered goal check)")
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            pickle_persistence = PicklePersistence(os.path.join(directory, f'state_{size}'))
+            pickle_latency = asyncio.run(flush_latency(
+                pickle_persistence, {'users': synthetic_users(size, goals_per_user, points_per_goal)}, rounds))
+            sqlite_persistence = SQLitePersistence(os.path.join(directory, f'state_{size}.sqlite'))
+            sqlite_latency = asyncio.run(flush_latency(
+                sqlite_persistence, BotData(users=synthetic_users(size, goals_per_user, points_per_goal)), rounds))
+            sqlite_persistence.close()
+            print(f'{size:>8} {pickle_latency * 1e3:>10.2f}ms {sqlite_latency * 1e3:>10.2f}ms')
+
+
+if __name__ == '__main__':
+    run()
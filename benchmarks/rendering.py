@@ -0,0 +1,83 @@
+import asyncio
+import sys
+import time
+from datetime import datetime, timedelta
+import benchmarks  # noqa: F401 (sets up the bot configuration)
+
+
+def rss_mb(pid: int = None) -> float:
+    with open(f"/proc/{pid or 'self'}/status") as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.
+
+
+def recent_goals(goal_count: int, days: int = 60):
+    """Goals with data up until now (the chart only shows the last 100 days)"""
+    import random
+    from common import goal_score_types
+    from model import Goal
+
+    rand = random.Random(0)
+    start = datetime.now() - timedelta(days=days)
+    goals = []
+    for idx in range(goal_count):
+        goal = Goal(f'goal {idx}', '0 11 * * *', goal_score_types[idx % len(goal_score_types)], 10, 1)
+        for day in range(days):
+            goal.add_data(1 if rand.random() < 0.7 else 0, start + timedelta(days=day))
+        goals.append(goal)
+    return goals
+
+
+async def run(renders=200, concurrency=8, goal_count=12):
+    from stats.evaluation import collect_chart_data
+    from stats.rendering import ChartRenderer, RendererBusy
+
+    chart = collect_chart_data(recent_goals(goal_count), legend_full_goal_title=False)
+    renderer = ChartRenderer(max_queued=concurrency)
+    await renderer.render(chart)
+    print(f'{renders} renders of {goal_count} goals, {concurrency} concurrent requests, {renderer.workers} workers')
+    print(f"{'renders':>8} {'bot rss':>10} {'workers rss':>12} {'renders/s':>10} {'rejected':>9}")
+
+    rejected = 0
+
+    async def render():
+        nonlocal rejected
+        try:
+            return len(await renderer.render(chart))
+        except RendererBusy:
+            rejected += 1
+            return 0
+
+    async def render_all(count: int):
+        slots = asyncio.Semaphore(concurrency)
+
+        async def limited():
+            async with slots:
+                return await render()
+        return await asyncio.gather(*(limited() for _ in range(count)))
+
+    done = 0
+    start = time.perf_counter()
+    for step in range(10):
+        batch = renders // 10
+        await render_all(batch)
+        done += batch
+        workers = sum(rss_mb(p.pid) for p in renderer._executor._processes.values())
+        print(f'{done:>8} {rss_mb():>8.1f}MB {workers:>10.1f}MB {done / (time.perf_counter() - start):>10.1f} '
+              f'{rejected:>9}')
+
+    # while the pool renders, the event loop stays available for other updates (e.g. goal check callbacks)
+    pending = asyncio.ensure_future(render_all(concurrency * 4))
+    timings = []
+    while not pending.done():
+        tick = time.perf_counter()
+        await asyncio.sleep(0.001)
+        timings.append(time.perf_counter() - tick - 0.001)
+    print(f'max event loop stall while rendering: {max(timings) * 1e3:.2f}ms')
+    renderer.shutdown()
+
+
+if __name__ == '__main__':
+    asyncio.run(run(*(int(arg) for arg in sys.argv[1:])))
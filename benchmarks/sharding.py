@@ -0,0 +1,197 @@
+import asyncio
+import json
+import os
+import resource
+import sys
+import tempfile
+import time
+from typing import Optional, Tuple
+from urllib.parse import parse_qs
+from telegram import Update
+from benchmarks import synthetic_users
+from persistence import SQLitePersistence, BotData
+from sharding import ShardRouter
+
+
+class FakeBotApi:
+    """A minimal Bot API server that answers every request after ``latency`` seconds and counts the sent messages"""
+
+    def __init__(self, latency: float = 0.01):
+        self.latency = latency
+        self.sent = 0
+        self.port = None
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve_connection, '127.0.0.1', 0)
+        self.port = self._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        self._server.close()
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    return
+                method = request_line.split()[1].rsplit(b'/', 1)[-1].decode()
+                length = 0
+                while (line := await reader.readline()) not in (b'\r\n', b''):
+                    if line.lower().startswith(b'content-length:'):
+                        length = int(line.split(b':')[1])
+                parameters = parse_qs((await reader.readexactly(length)).decode()) if length > 0 else {}
+                await asyncio.sleep(self.latency)
+                writer.write(self._response(method, parameters))
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    def _response(self, method: str, parameters) -> bytes:
+        if method == 'getMe':
+            result = {'id': 1, 'is_bot': True, 'first_name': 'benchmark', 'username': 'benchmark_bot'}
+        elif method == 'sendMessage':
+            self.sent += 1
+            chat_id = int(parameters['chat_id'][0])
+            result = {'message_id': self.sent, 'date': int(time.time()), 'chat': {'id': chat_id, 'type': 'private'},
+                      'text': parameters.get('text', [''])[0]}
+        else:
+            result = True
+        body = json.dumps({'ok': True, 'result': result}).encode()
+        return f'HTTP/1.1 200 OK\r\nContent-Type: application/json\r\nContent-Length: {len(body)}\r\n\r\n'.encode() \
+            + body
+
+
+def info_updates(count: int, users: int):
+    """The updates as received by the webhook"""
+    for update_id in range(1, count + 1):
+        user = {'id': update_id % users + 1, 'is_bot': False, 'first_name': 'user'}
+        yield {'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': int(time.time()), 'from': user, 'text': '/info',
+            'chat': {'id': user['id'], 'type': 'private'},
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}]}}
+
+
+class DiscardingWriter:
+    """Stands in for the connection to a shard"""
+
+    def write(self, data: bytes):
+        pass
+
+    async def drain(self):
+        pass
+
+    def is_closing(self) -> bool:
+        return False
+
+
+def front_cost(updates, shards: int = 4) -> Tuple[float, float]:
+    """The CPU seconds the front process spends per update forwarding it decoded (as in polling mode, including
+    decoding it) and as received (as in webhook mode)"""
+    router = ShardRouter(shards, 'state.sqlite')
+    router._writers = {shard: DiscardingWriter() for shard in range(shards)}
+
+    async def decoded():
+        for data in updates:
+            await router.route(Update.de_json(data, None))
+
+    async def received():
+        for data in updates:
+            await router.route_data(data)
+
+    costs = []
+    for forward in (decoded, received):
+        start = time.process_time()
+        asyncio.run(forward())
+        costs.append((time.process_time() - start) / len(updates))
+    return costs[0], costs[1]
+
+
+def children_cpu() -> float:
+    """The CPU seconds used by the child processes that have exited (the workers, once the router stopped them)"""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+async def run_once(shards: int, directory: str, updates, settle: float) -> Tuple[float, float, float]:
+    """The seconds until all updates have been answered, the seconds spent routing them and the CPU seconds the
+    front process used meanwhile (including the fake Bot API, which runs in the same process)"""
+    api = FakeBotApi()
+    await api.start()
+    environment = dict(os.environ, TELEGRAM_API_URL=f'http://127.0.0.1:{api.port}/bot', STATS_RENDER_WORKERS='1')
+    router = ShardRouter(shards, os.path.join(directory, 'state.sqlite'), environment=environment)
+    await router.start()
+    # lets the workers finish starting up (e.g. warming up the chart renderers)
+    await asyncio.sleep(settle)
+
+    start, cpu_start = time.monotonic(), time.process_time()
+    for data in updates:
+        await router.route_data(data)
+    routing = time.monotonic() - start
+    while api.sent < len(updates):
+        await asyncio.sleep(0.01)
+    elapsed, front_cpu = time.monotonic() - start, time.process_time() - cpu_start
+
+    await router.stop()
+    await api.stop()
+    return elapsed, routing, front_cpu
+
+
+def run_workers(shards: int, users: int, updates, settle: float) -> Tuple[float, float, float, float]:
+    """Runs the updates through a fresh database split into ``shards`` and returns the results of :func:`run_once`
+    and the CPU seconds the workers used"""
+    with tempfile.TemporaryDirectory() as directory:
+        persistence = SQLitePersistence(os.path.join(directory, 'state.sqlite'))
+        persistence.save_bot_data(BotData(users=synthetic_users(users, points_per_goal=30)))
+        persistence.close()
+        cpu = children_cpu()
+        elapsed, routing, front_cpu = asyncio.run(run_once(shards, directory, updates, settle))
+        return elapsed, routing, front_cpu, children_cpu() - cpu
+
+
+def run(shard_counts=(1, 2, 4), users: int = 2000, count: int = 10000, settle: float = 5.,
+        min_efficiency: float = 0.8) -> Optional[bool]:
+    """Measures the throughput with each number of shards and checks that it scales near-linearly, i.e. that the
+    speedup over the first shard count is at least ``min_efficiency`` times the ratio of the shard counts
+
+    Returns None if the machine has fewer cpus than the largest shard count plus one (for the front process), since
+    the processes would share cpus and the speedup can't be measured.
+    """
+    updates = list(info_updates(count, users))
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    print(f'{count} /info updates of {users} users, {cpus} cpus')
+    decoded, received = front_cost(updates)
+    print(f'front cpu per update: {decoded * 1e6:.0f}us decoded, {received * 1e6:.0f}us as received '
+          f'(up to {1 / received:.0f} updates/s)')
+    print(f"{'shards':>7} {'updates/s':>10} {'speedup':>8} {'efficiency':>11} {'routed/s':>9} {'front cpu':>10} "
+          f"{'worker cpu':>11}")
+    # the first run is slower (e.g. the workers' imports are not cached yet), which would inflate the speedup
+    run_workers(shard_counts[0], users, updates[:count // 10], settle)
+    baseline = None
+    scaling = True
+    for shards in shard_counts:
+        # the CPU the workers use to start, load and split the database and to stop is measured without updates
+        idle_cpu = run_workers(shards, users, [], settle)[3]
+        elapsed, routing, front_cpu, worker_cpu = run_workers(shards, users, updates, settle)
+        rate = count / elapsed
+        baseline = (shards, rate) if baseline is None else baseline
+        speedup, efficiency = rate / baseline[1], rate / baseline[1] / (shards / baseline[0])
+        scaling = scaling and efficiency >= min_efficiency
+        front_cpu, worker_cpu = front_cpu / count, max(worker_cpu - idle_cpu, 0.) / count
+        print(f'{shards:>7} {rate:>10.0f} {speedup:>7.2f}x {efficiency:>10.0%} {count / routing:>9.0f} '
+              f'{front_cpu * 1e3:>8.2f}ms {worker_cpu * 1e3:>9.2f}ms')
+
+    if max(shard_counts) + 1 > cpus:
+        print(f'NOT VERIFIED: the front process and {max(shard_counts)} workers share {cpus} cpus, the scaling can only '
+              f'be measured with at least {max(shard_counts) + 1} cpus')
+        return None
+    print(f"{'PASSED' if scaling else 'FAILED'}: the efficiency has to be at least {min_efficiency:.0%} "
+          f"for every shard count")
+    return scaling
+
+
+if __name__ == '__main__':
+    # exits with 0 if the throughput scales near-linearly, 1 if it doesn't and 2 if it could not be measured
+    result = run(tuple(int(shards) for shards in sys.argv[1:]) or (1, 2, 4))
+    sys.exit(2 if result is None else 0 if result else 1)
@@ -0,0 +1,49 @@
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import List, Tuple
+
+
+def import_times(tree: str) -> List[Tuple[int, int, str]]:
+    """Imports main.py with ``-X importtime`` and returns (self us, cumulative us, module) per imported module"""
+    env = dict(os.environ, PYTHONDONTWRITEBYTECODE='1')
+    env.setdefault('BOT_ADMIN_ID', '0')
+    env.setdefault('TELEGRAM_API_TOKEN', '0:benchmark')
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import main'], cwd=tree, env=env,
+                            capture_output=True, text=True, check=True)
+    times = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative_us, module = line[len('import time:'):].split('|')
+        times.append((int(self_us), int(cumulative_us), module.rstrip()))
+    return times
+
+
+def wall_time(tree: str) -> float:
+    env = dict(os.environ)
+    env.setdefault('BOT_ADMIN_ID', '0')
+    env.setdefault('TELEGRAM_API_TOKEN', '0:benchmark')
+    start = time.perf_counter()
+    subprocess.run([sys.executable, '-c', 'import main'], cwd=tree, env=env, check=True)
+    return time.perf_counter() - start
+
+
+def run(tree: str = os.path.dirname(os.path.dirname(os.path.abspath(__file__))), rounds: int = 5, top: int = 15):
+    wall_time(tree)
+    print(f'time to import main.py (median of {rounds}): '
+          f'{statistics.median(wall_time(tree) for _ in range(rounds)) * 1e3:.0f}ms')
+
+    times = import_times(tree)
+    # the module column is indented by two spaces per nesting level, main.py's own imports are on level one
+    imported_by_main = [t for t in times if len(t[2]) - len(t[2].lstrip()) == 3]
+    print(f'{len(times)} modules imported, {sum(t[0] for t in times) / 1e3:.0f}ms in total')
+    print(f"{'cumulative':>12} {'self':>10}  module (imported by main.py)")
+    for self_us, cumulative_us, module in sorted(imported_by_main, key=lambda t: -t[1])[:top]:
+        print(f'{cumulative_us / 1e3:>10.1f}ms {self_us / 1e3:>8.1f}ms {module.strip()}')
+
+
+if __name__ == '__main__':
+    run(*sys.argv[1:2])
@@ -0,0 +1,38 @@
+import gc
+import pickle
+import tracemalloc
+from benchmarks import synthetic_users
+
+
+def measure(build):
+    gc.collect()
+    tracemalloc.start()
+    obj = build()
+    gc.collect()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return obj, size
+
+
+def run(users=10000, goals_per_user=3, points_per_goal=100):
+    user_list = synthetic_users(users, goals_per_user, points_per_goal)
+    _, compact_memory = measure(lambda: synthetic_users(users, goals_per_user, points_per_goal))
+    legacy_data, legacy_memory = measure(lambda: [[[{'value': dp['value'], 'time': dp['time'],
+                                                     'score': dict(dp['score'])} for dp in goal.data]
+                                                   for goal in user.goals] for user in user_list])
+    legacy_pickle = len(pickle.dumps(legacy_data))
+    del legacy_data
+    compact_pickle = len(pickle.dumps(user_list))
+
+    points = users * goals_per_user * points_per_goal
+    print(f'{users} users, {goals_per_user} goals per user, {points_per_goal} data points per goal ({points} points)')
+    print(f"{'':>24} {'memory':>12} {'pickle':>12} {'bytes/point':>12}")
+    print(f"{'dict per data point':>24} {legacy_memory / 2**20:>10.1f}MB {legacy_pickle / 2**20:>10.1f}MB "
+          f"{legacy_pickle / points:>12.1f}")
+    print(f"{'compact goals':>24} {compact_memory / 2**20:>10.1f}MB {compact_pickle / 2**20:>10.1f}MB "
+          f"{compact_pickle / points:>12.1f}")
+
+
+if __name__ == '__main__':
+    import sys
+    run(*map(int, sys.argv[1:]))
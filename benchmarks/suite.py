@@ -0,0 +1,192 @@
+import argparse
+import asyncio
+import contextlib
+import io
+import itertools
+import json
+import pickle
+import platform
+import sys
+import time
+from datetime import datetime, timedelta
+from typing import Dict, List, Optional
+import numpy as np
+from benchmarks import time_per_call, synthetic_users
+from benchmarks.rendering import recent_goals
+
+
+def benchmark_model(users, number: int, repeat: int) -> Dict[str, float]:
+    from model import Goal, User
+
+    sample = [goal for user in itertools.islice(users, 100) for goal in user.goals]
+    goals = itertools.cycle(sample)
+    points = len(sample[0].times)
+    days = itertools.count(points)
+    start = datetime(2021, 1, 1, 11)
+    # the history is trimmed to the score range, so appending keeps the goals at a constant size
+    appended = [Goal(goal.title, goal.cron, goal.score_type, goal.score_range, goal.chat_id) for goal in sample[:3]]
+    for goal, source in zip(appended, sample):
+        for time_end, value in zip(source.times, source.values):
+            goal.add_data(value, datetime.fromtimestamp(time_end))
+    appending = itertools.cycle(appended)
+    states = itertools.cycle([goal.__getstate__() for goal in sample])
+
+    ids = itertools.cycle([user.id for user in users])
+    new_ids = itertools.count(len(users) + 1)
+
+    return {
+        'goal.add_data': time_per_call(
+            lambda: next(appending).add_data(1, start + timedelta(days=next(days))), number, repeat),
+        'goal.calculate_score_days': time_per_call(lambda: next(goals).calculate_score_days(), number, repeat),
+        'goal.calculate_score_floating_average': time_per_call(
+            lambda: next(goals).calculate_score_floating_average(), number, repeat),
+        'goal.calculate_score_floating_average(range)': time_per_call(
+            lambda: next(goals).calculate_score_floating_average(points // 2), number, repeat),
+        'goal.calculate_score_floating_amount': time_per_call(
+            lambda: next(goals).calculate_score_floating_amount(), number, repeat),
+        'goal.calculate_score_floating_amount(range, offset)': time_per_call(
+            lambda: next(goals).calculate_score_floating_amount(points // 2, 1), number, repeat),
+        'goal.__setstate__': time_per_call(lambda: Goal.__new__(Goal).__setstate__(next(states)), number, repeat),
+        'userlist.lookup': time_per_call(lambda: users[next(ids)], number, repeat),
+        'userlist.append': time_per_call(lambda: users.append(User(next(new_ids))), number, repeat),
+    }
+
+
+def benchmark_stats(users, number: int, repeat: int) -> Dict[str, float]:
+    from stats import get_user_stats
+    from stats.chart import find_averages
+    from stats.evaluation import collect_chart_data
+
+    # the goals of a group of 10 users, sampled like the chart does
+    chart = collect_chart_data([goal for user in itertools.islice(users, 10) for goal in user.goals])
+    all_goals_data = [{'x': np.asarray(times), 'y': np.asarray(scores)} for times, scores in zip(chart.times,
+                                                                                                   chart.scores)]
+    x_min = min(times[0] for times in chart.times)
+    x_max = max(times[-1] for times in chart.times)
+    x_samples = np.append(np.arange(x_min, x_max, (x_max - x_min) / 100), x_max)
+
+    user = next(iter(users))
+    results = {
+        'stats.find_averages': time_per_call(lambda: find_averages(all_goals_data, x_samples, x_min),
+                                             max(number // 10, 1), repeat),
+    }
+    # get_user_stats prints the goals
+    with contextlib.redirect_stdout(io.StringIO()):
+        results['stats.get_user_stats'] = time_per_call(lambda: get_user_stats(user), max(number // 10, 1), repeat)
+
+    return results
+
+
+def benchmark_graph(goals_per_user: int, points: int, number: int, repeat: int) -> Dict[str, float]:
+    from stats import get_renderer
+    from stats.evaluation import generate_graph
+
+    # charts only show the last 100 days, so the goals of the graph have data up until now
+    goals = recent_goals(goals_per_user, days=points)
+    renderer = get_renderer()
+    renders = max(number // 1000, 1)
+
+    async def render_all() -> float:
+        # the first render waits for the renderer processes to start
+        await generate_graph(goals)
+        timings = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            for _ in range(renders):
+                await generate_graph(goals)
+            timings.append((time.perf_counter() - start) / renders)
+        return min(timings)
+    try:
+        return {'stats.generate_graph': asyncio.run(render_all())}
+    finally:
+        renderer.shutdown()
+
+
+def benchmark_persistence(users, repeat: int) -> Dict[str, float]:
+    from persistence import BotData
+
+    bot_data = BotData(users=users)
+    pickled = pickle.dumps(bot_data)
+    return {
+        'bot_data.pickle': time_per_call(lambda: pickle.dumps(bot_data), 1, repeat),
+        'bot_data.unpickle': time_per_call(lambda: pickle.loads(pickled), 1, repeat),
+    }
+
+
+def run(users: int = 1000, goals_per_user: int = 3, points_per_goal: int = 100, number: int = 10000,
+        repeat: int = 5, graph: bool = True, seed: int = 0) -> Dict:
+    dataset = synthetic_users(users, goals_per_user, points_per_goal, seed)
+    results = {}
+    results.update(benchmark_persistence(dataset, repeat))
+    results.update(benchmark_stats(dataset, number, repeat))
+    # appends users to the dataset, so it runs after the benchmarks using the dataset
+    results.update(benchmark_model(dataset, number, repeat))
+    if graph:
+        # runs last, so the renderer processes don't compete with the other benchmarks
+        results.update(benchmark_graph(goals_per_user, points_per_goal, number, repeat))
+    return {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'dataset': {'users': users, 'goals_per_user': goals_per_user, 'points_per_goal': points_per_goal,
+                    'seed': seed},
+        'number': number,
+        'repeat': repeat,
+        'seconds': dict(sorted(results.items())),
+    }
+
+
+def compare(results: Dict, baseline: Dict, tolerance: float) -> bool:
+    """Prints the timings relative to the baseline, returns whether no benchmark got slower by more than tolerance"""
+    if results['dataset'] != baseline['dataset']:
+        print(f"warning: the baseline was measured on a different dataset ({baseline['dataset']})")
+    print(f"{'benchmark':<52} {'baseline':>11} {'current':>11} {'ratio':>7}")
+    passed = True
+    for name, seconds in results['seconds'].items():
+        before = baseline['seconds'].get(name)
+        if before is None:
+            print(f'{name:<52} {"-":>11} {seconds * 1e6:>9.2f}us')
+            continue
+        ratio = seconds / before
+        regressed = ratio > 1 + tolerance
+        passed = passed and not regressed
+        print(f'{name:<52} {before * 1e6:>9.2f}us {seconds * 1e6:>9.2f}us {ratio:>6.2f}x'
+              f'{" REGRESSION" if regressed else ""}')
+    return passed
+
+
+def print_results(results: Dict):
+    print(f"{'benchmark':<52} {'per call':>11}")
+    for name, seconds in results['seconds'].items():
+        print(f'{name:<52} {seconds * 1e6:>9.2f}us')
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(prog='python -m benchmarks.suite',
+                                     description='Times the model and stats hot paths on a synthetic dataset')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--goals', type=int, default=3, help='goals per user')
+    parser.add_argument('--points', type=int, default=100, help='data points per goal')
+    parser.add_argument('--number', type=int, default=10000, help='calls per timing of the fast benchmarks')
+    parser.add_argument('--repeat', type=int, default=5, help='timings per benchmark (the fastest is reported)')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--no-graph', action='store_true', help="don't render charts (uses the renderer processes)")
+    parser.add_argument('--output', help='writes the results as json to this file')
+    parser.add_argument('--baseline', help='compares the results to a json file written with --output')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='slowdown relative to the baseline that counts as a regression (default: 0.2)')
+    args = parser.parse_args(argv)
+
+    results = run(args.users, args.goals, args.points, args.number, args.repeat, not args.no_graph, args.seed)
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    if args.baseline is None:
+        print_results(results)
+    if args.baseline is not None:
+        with open(args.baseline) as f:
+            return 0 if compare(results, json.load(f), args.tolerance) else 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
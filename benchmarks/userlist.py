@@ -0,0 +1,18 @@
+import random
+from benchmarks import time_per_call
+from model import User, UserList
+
+
+def run(sizes=(100, 1000, 10000, 50000)):
+    print(f"{'users':>8} {'lookup':>12} {'contains':>12} {'append':>12}")
+    for size in sizes:
+        users = UserList(User(uid) for uid in random.sample(range(size * 10), size))
+        ids = [u.id for u in users]
+        lookup = time_per_call(lambda: users[random.choice(ids)])
+        contains = time_per_call(lambda: random.choice(ids) in users)
+        append = time_per_call(lambda: users.append(User(random.randrange(size * 10))), number=1000)
+        print(f'{size:>8} {lookup * 1e9:>10.0f}ns {contains * 1e9:>10.0f}ns {append * 1e9:>10.0f}ns')
+
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,114 @@
+import asyncio
+import json
+import sys
+import time
+from collections import Counter
+from telegram import Update
+from telegram.ext import ApplicationBuilder, TypeHandler
+from telegram.request import BaseRequest
+import benchmarks  # noqa: F401 (sets up the bot configuration)
+from messaging import WebhookServer
+
+secret = 'benchmark-secret'
+
+
+class OfflineRequest(BaseRequest):
+    """Answers getMe, which the application needs for initializing, without contacting Telegram"""
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        return 200, json.dumps({'ok': True, 'result': {'id': 1, 'is_bot': True, 'first_name': 'benchmark',
+                                                       'username': 'benchmark_bot'}}).encode()
+
+
+def synthetic_updates(count: int):
+    for update_id in range(1, count + 1):
+        user = {'id': update_id % 1000 + 1, 'is_bot': False, 'first_name': 'user'}
+        yield {'update_id': update_id, 'message': {
+            'message_id': update_id, 'date': int(time.time()), 'from': user, 'text': '/info',
+            'chat': {'id': user['id'], 'type': 'private'},
+            'entities': [{'type': 'bot_command', 'offset': 0, 'length': 5}]}}
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * fraction))] if values else float('nan')
+
+
+async def post(port: int, bodies, latencies, statuses, token: str = secret):
+    """POSTs the bodies one after another over a single keep-alive connection"""
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    for body in bodies:
+        start = time.monotonic()
+        writer.write(f'POST /webhook HTTP/1.1\r\nHost: localhost\r\nContent-Type: application/json\r\n'
+                     f'X-Telegram-Bot-Api-Secret-Token: {token}\r\nContent-Length: {len(body)}\r\n\r\n'.encode()
+                     + body)
+        await writer.drain()
+        status = int((await reader.readline()).split()[1])
+        length = 0
+        while (line := await reader.readline()) != b'\r\n':
+            if line.lower().startswith(b'content-length:'):
+                length = int(line.split(b':')[1])
+        await reader.readexactly(length)
+        latencies.append(time.monotonic() - start)
+        statuses[status] += 1
+    writer.close()
+
+
+async def run_once(updates, connections: int, handler_latency: float, queue_size: int, concurrency: int):
+    async def handle(_, __):
+        await asyncio.sleep(handler_latency)
+
+    application = ApplicationBuilder().token('1:benchmark').request(OfflineRequest()).updater(None) \
+        .concurrent_updates(256).build()
+    application.add_handler(TypeHandler(Update, handle))
+    await application.initialize()
+    await application.start()
+    server = WebhookServer(application, secret, path='/webhook', listen='127.0.0.1', port=0, queue_size=queue_size,
+                           concurrency=concurrency)
+    await server.start()
+
+    bodies = [json.dumps(update).encode() for update in updates]
+    post_latencies, statuses = [], Counter()
+    start = time.monotonic()
+    await asyncio.gather(*(post(server.port, bodies[idx::connections], post_latencies, statuses)
+                           for idx in range(connections)))
+    # a request without the secret token is refused
+    await post(server.port, bodies[:1], [], statuses, token='wrong')
+    await server.stop(timeout=60)
+    elapsed = time.monotonic() - start
+    stats = server.stats()
+    await application.stop()
+    await application.shutdown()
+    return stats, statuses, post_latencies, elapsed
+
+
+def run(count: int = 20000, connections: int = 40, handler_latency: float = 0.02, updates_path: str = None):
+    if updates_path is not None:
+        # recorded updates, one JSON object per line
+        with open(updates_path) as f:
+            updates = [json.loads(line) for line in f if line.strip()]
+    else:
+        updates = list(synthetic_updates(count))
+
+    print(f'{len(updates)} updates over {connections} connections, handlers take {handler_latency * 1e3:.0f}ms')
+    print(f"{'queue':>6} {'handlers':>9} {'updates/s':>10} {'post p50':>10} {'post p99':>10} {'ingest p50':>11} "
+          f"{'ingest p99':>11} {'200':>7} {'503':>7} {'403':>5}")
+    # the second configuration can't keep up, the excess updates are refused with 503 instead of piling up
+    for queue_size, concurrency in ((1000, 256), (50, 8)):
+        stats, statuses, post_latencies, elapsed = asyncio.run(
+            run_once(updates, connections, handler_latency, queue_size, concurrency))
+        print(f'{queue_size:>6} {concurrency:>9} {stats["processed"] / elapsed:>10.0f} '
+              f'{percentile(post_latencies, .5) * 1e3:>8.2f}ms {percentile(post_latencies, .99) * 1e3:>8.2f}ms '
+              f'{stats["latency_p50"] * 1e3:>9.2f}ms {stats["latency_p99"] * 1e3:>9.2f}ms '
+              f'{statuses[200]:>7} {statuses[503]:>7} {statuses[403]:>5}')
+
+
+if __name__ == '__main__':
+    run(updates_path=sys.argv[1] if len(sys.argv) > 1 else None)
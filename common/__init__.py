@@ -1,3 +1,3 @@
 from .functions import initialize, chat_types, markdown_v2_escape
 from .constants import goal_score_types, goal_schedule_types, goal_score_types_regex, cron_pattern, \
-    telegram_markdown_special_chars, days_of_week, admin_id, reaction_stickers
+    telegram_markdown_special_chars, days_of_week, admin_id, reaction_stickers, max_score_range
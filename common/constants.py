@@ -10,6 +10,8 @@ goal_score_types_regex = r'^(number of successes|floating average|floating amoun
 goal_score_types_regex_comp = re.compile(goal_score_types_regex)
 for t in goal_score_types:
     assert goal_score_types_regex_comp.fullmatch(t) is not None
+# the largest score range of a floating score, the number of successes is always scored over the whole history (-1)
+max_score_range = 60
 cron_pattern = re.compile(r'(?P<minute>(\d+|\*|)(/\d+)?)( *(?P<hour>(\d+|\*|)(/\d+)?))( *(?P<dom>(\d+|\*|)(/\d+)?))'
                           r'( *(?P<month>(\d+|\*|)(/\d+)?))( *(?P<dow>(\d+|\*|)(/\d+)?))')
 days_of_week = ['Sun', 'Mon', 'Tue', 'Wed', 'Thu', 'Sat']
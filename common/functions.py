@@ -1,33 +1,40 @@
-from telegram.ext import Dispatcher
+import functools
+from telegram.ext import Application
 from telegram import Update
 from .constants import admin_id, telegram_markdown_special_chars
 from model import UserList, User
+from sharding import get_peers, shard_of
 from typing import Callable, Any, TYPE_CHECKING
 
 
 def chat_types(*types: ...):
 
     def inner(func: Callable[[Update, Any], Any]):
-        def wrapped(update: Update, *args, **kwargs):
+        @functools.wraps(func)
+        async def wrapped(update: Update, *args, **kwargs):
             if update.effective_chat is None or update.effective_chat.type not in types:
-                update.message.reply_text(f'This action is only available in {" and ".join(types)} chats')
+                await update.message.reply_text(f'This action is only available in {" and ".join(types)} chats')
                 return
-            return func(update, *args, **kwargs)
+            return await func(update, *args, **kwargs)
         return wrapped
 
     return inner
 
 
-def initialize(dispatcher: Dispatcher):
-    if 'users' not in dispatcher.bot_data:
-        dispatcher.bot_data['users'] = UserList()
+def initialize(application: Application):
+    if 'users' not in application.bot_data:
+        application.bot_data['users'] = UserList()
 
-    if admin_id not in dispatcher.bot_data['users']:
-        dispatcher.bot_data['users'].append(User(admin_id))
-        dispatcher.bot_data['users'][admin_id].authorized = True
+    peers = get_peers()
+    # with shards, the admin only exists on the shard owning it
+    owns_admin = peers is None or shard_of(admin_id, peers.count) == peers.index
+    if admin_id not in application.bot_data['users'] and owns_admin:
+        application.bot_data['users'].append(User(admin_id))
+        application.bot_data['users'][admin_id].authorized = True
+        application.bot_data['users'].mark_dirty(admin_id)
 
-    if 'auth_polls' not in dispatcher.bot_data:
-        dispatcher.bot_data['auth_polls'] = {}
+    if 'auth_polls' not in application.bot_data:
+        application.bot_data['auth_polls'] = {}
 
 
 def markdown_v2_escape(text: str):
@@ -1,4 +1,6 @@
 from .add_goal import add_goal_handler
 from .auth import authorized, show_auth_dialog, authorize_user
 from .goal_check import schedule_goal_check, schedule_all_goal_checks, schedule_all_goal_checks_for_user, \
-    handle_goal_check_response
+    handle_goal_check_response, handle_signed_goal_check_response
+from .dialogs import sweep_dialogs, dialog_counts, DIALOG_SWEEP_INTERVAL
+from .export import handle_export
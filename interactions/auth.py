@@ -1,9 +1,12 @@
 from common import chat_types
 from telegram import Update, Chat, InlineKeyboardButton, InlineKeyboardMarkup, User as TelegramUser
-from telegram.ext import CallbackContext
-from model import User
-from typing import Any, Callable, Optional
+from telegram.ext import Application, CallbackContext
+from model import DialogStore, User
+from sharding import get_peers, shard_call
+from typing import Any, Callable, Optional, Tuple
+import functools
 import random
+import re
 import string
 from datetime import datetime
 import time
@@ -12,17 +15,19 @@ authorization_dialog_text = 'Use the buttons below to de-/authorize or register
                             'group\'s statistics\n\n' \
                             'authorization count: {}\n' \
                             'users registered: {}'
+shown_counts_pattern = re.compile(r'authorization count: (-?\d+)\nusers registered: (\d+)')
 
 
 def authorized(func_or_result: Optional = None):
     def inner(func: Callable[[Update, CallbackContext], Any]):
-        def wrapped(update: Update, context: CallbackContext):
+        @functools.wraps(func)
+        async def wrapped(update: Update, context: CallbackContext):
             uid = update.effective_user.id
             if uid not in context.bot_data['users'] or not context.bot_data['users'][uid].authorized:
                 print(f'User {uid} is not authorized!')
-                update.effective_chat.send_message("Sorry, you're not authorized to use this bot.")
+                await update.effective_chat.send_message("Sorry, you're not authorized to use this bot.")
                 return func_or_result
-            return func(update, context)
+            return await func(update, context)
 
         return wrapped
 
@@ -32,68 +37,98 @@ def authorized(func_or_result: Optional = None):
         return inner
 
 
-def authorize_user(update: Update, context: CallbackContext):
+async def authorize_user(update: Update, context: CallbackContext):
     query = update.callback_query
     _, dialog_id, action = query.data.split(':')
-    if 'dialogs' not in context.chat_data or dialog_id not in context.chat_data['dialogs']:
-        query.answer('Your request was not authorized!')
-        return
+    dialogs = DialogStore.of(context.chat_data)
+    if dialog_id not in dialogs:
+        if get_peers() is None:
+            await query.answer('Your request was not authorized!')
+            return
+        # the dialog has been opened on another shard
+        dialogs[dialog_id] = {'authcount': shown_counts(query.message.text)[0], 'close_uid': -1, 'close_timestamp': 0}
+        dialogs.set_message(dialog_id, query.message.message_id)
     uid = query.from_user.id
+    auth_change, registration_change = 0, 0
 
     if action == 'authorize':
         if uid in context.bot_data['users'] and context.bot_data['users'][uid].authorized:
             context.bot_data['users'][uid].authorized = False
-            query.answer('Your authorization has been revoked!')
-            context.chat_data['dialogs'][dialog_id]['authcount'] -= 1
+            context.bot_data['users'].mark_dirty(uid)
+            await query.answer('Your authorization has been revoked!')
+            auth_change = -1
         else:
             if query.from_user.id not in context.bot_data['users']:
                 context.bot_data['users'].append(User(uid))
             context.bot_data['users'][uid].authorized = True
-            query.answer('You have been authorized for using the Drill Sergeant!')
-            context.chat_data['dialogs'][dialog_id]['authcount'] += 1
+            context.bot_data['users'].mark_dirty(uid)
+            await query.answer('You have been authorized for using the Drill Sergeant!')
+            auth_change = 1
     elif action == 'group_reg':
         if 'users' not in context.chat_data:
             context.chat_data['users'] = set()
         if uid in context.chat_data['users']:
             context.chat_data['users'].remove(uid)
-            query.answer('Your goals won\'t be included in this group\'s stats anymore!')
+            registration_change = -1
+            await query.answer('Your goals won\'t be included in this group\'s stats anymore!')
         else:
             context.chat_data['users'].add(uid)
-            query.answer('Your goals will now be included in this group\'s stats!')
-
-    group_user_count = len(context.chat_data['users'])
-    auth_count = context.chat_data['dialogs'][dialog_id]['authcount']
+            registration_change = 1
+            await query.answer('Your goals will now be included in this group\'s stats!')
+        # imported here, the stats package depends on this one
+        from stats.aggregate import group_stats
+        group_stats.registration_changed(update.effective_chat.id, uid, registration_change == 1)
+
+    dialogs[dialog_id]['authcount'] += auth_change
+    if get_peers() is None:
+        group_user_count = len(context.chat_data['users'])
+        auth_count = dialogs[dialog_id]['authcount']
+    else:
+        # every shard only knows its own users, the message shows the counts of all shards
+        shown_auth_count, shown_user_count = shown_counts(query.message.text)
+        auth_count, group_user_count = shown_auth_count + auth_change, shown_user_count + registration_change
 
     if action == 'close':
         if uid not in context.bot_data['users'] or not context.bot_data['users'][uid].authorized:
-            query.answer('You don\'t have permission to close this poll')
+            await query.answer('You don\'t have permission to close this poll')
             return
 
-        if time.time() - context.chat_data['dialogs'][dialog_id]['close_timestamp'] > 10:
-            context.chat_data['dialogs'][dialog_id]['close_timestamp'] = time.time()
-            context.chat_data['dialogs'][dialog_id]['close_uid'] = query.from_user.id
-            query.answer('If you really want to close the dialog for all users, press the button again')
-            query.edit_message_reply_markup(reply_markup=get_auth_keyboard(context, dialog_id))
+        if time.time() - dialogs[dialog_id]['close_timestamp'] > 10:
+            dialogs[dialog_id]['close_timestamp'] = time.time()
+            dialogs[dialog_id]['close_uid'] = query.from_user.id
+            await query.answer('If you really want to close the dialog for all users, press the button again')
+            await query.edit_message_reply_markup(reply_markup=get_auth_keyboard(context, dialog_id))
 
-            def reset_buttons(_):
-                if dialog_id in context.chat_data['dialogs']:
-                    query.edit_message_reply_markup(reply_markup=get_auth_keyboard(context, dialog_id))
+            async def reset_buttons(_):
+                if dialog_id in dialogs:
+                    await query.edit_message_reply_markup(reply_markup=get_auth_keyboard(context, dialog_id))
 
             context.job_queue.run_once(reset_buttons, 10)
             return
 
-        if context.chat_data['dialogs'][dialog_id]['close_uid'] != query.from_user.id:
-            query.answer('Only the user who pressed the button for the first time can confirm the closing!')
+        if dialogs[dialog_id]['close_uid'] != query.from_user.id:
+            await query.answer('Only the user who pressed the button for the first time can confirm the closing!')
             return
 
-        del context.chat_data['dialogs'][dialog_id]
-        query.answer('authorization dialog closed!')
+        del dialogs[dialog_id]
+        await query.answer('authorization dialog closed!')
 
     msg_text = authorization_dialog_text.format(auth_count, group_user_count) \
                + (f'\n\n--closed by {find_user_name(query.from_user)}--' if action == 'close' else '')
     if msg_text != query.message.text:
-        query.edit_message_text(msg_text,
-                                reply_markup=get_auth_keyboard(context, dialog_id) if action != 'close' else None)
+        await query.edit_message_text(msg_text,
+                                      reply_markup=get_auth_keyboard(context, dialog_id) if action != 'close' else None)
+
+
+def shown_counts(text: Optional[str]) -> Tuple[int, int]:
+    """The authorization count and the number of registered users shown in the text of an authorization dialog"""
+    match = shown_counts_pattern.search(text or '')
+    return (int(match[1]), int(match[2])) if match is not None else (0, 0)
+
+
+@shard_call
+async def registered_user_count(application: Application, chat_id: int) -> int:
+    return len(application.chat_data.get(chat_id, {}).get('users', ()))
 
 
 def find_user_name(user_data: TelegramUser):
@@ -109,28 +144,30 @@ def find_user_name(user_data: TelegramUser):
 
 @chat_types('group', 'supergroup')
 @authorized
-def show_auth_dialog(update: Update, context: CallbackContext):
+async def show_auth_dialog(update: Update, context: CallbackContext):
     if 'users' not in context.chat_data:
         context.chat_data['users'] = set()
-    if 'dialogs' not in context.chat_data:
-        context.chat_data['dialogs'] = {}
+    dialogs = DialogStore.of(context.chat_data)
     dialog_id = ''.join(random.choice(string.ascii_letters) for _ in range(24))
-    context.chat_data['dialogs'][dialog_id] = {
+    dialogs[dialog_id] = {
         'authcount': 0,
         'close_uid': -1,
         'close_timestamp': 0
     }
 
-    group_user_count = len(context.chat_data['users'])
-    auth_count = context.chat_data['dialogs'][dialog_id]['authcount']
+    peers = get_peers()
+    group_user_count = len(context.chat_data['users']) if peers is None \
+        else sum(await peers.gather('registered_user_count', update.effective_chat.id))
+    auth_count = dialogs[dialog_id]['authcount']
     keyboard = get_auth_keyboard(context, dialog_id)
-    update.message.reply_text(authorization_dialog_text.format(auth_count, group_user_count),
-                              reply_markup=keyboard)
+    message = await update.message.reply_text(authorization_dialog_text.format(auth_count, group_user_count),
+                                              reply_markup=keyboard)
+    dialogs.set_message(dialog_id, message.message_id)
 
 
 def get_auth_keyboard(context, dialog_id: str):
     close_text = 'Close Dialog'
-    if time.time() - context.chat_data['dialogs'][dialog_id]['close_timestamp'] <= 10:
+    if time.time() - DialogStore.of(context.chat_data)[dialog_id]['close_timestamp'] <= 10:
         close_text = 'Really?'
 
     option_template = f'auth_dialog:{dialog_id}:{{}}'
@@ -145,9 +182,9 @@ def get_auth_keyboard(context, dialog_id: str):
 
 
 @chat_types('group', 'supergroup')
-def auth_poll(update: Update, context: CallbackContext):
+async def auth_poll(update: Update, context: CallbackContext):
     options = ['yes', 'no']
-    message = context.bot.send_poll(
+    message = await context.bot.send_poll(
         update.effective_chat.id,
         "Select 'yes' to get authorized to use the Drill Sergeant",
         options,
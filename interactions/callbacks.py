@@ -0,0 +1,61 @@
+import base64
+import hashlib
+import hmac
+import os
+from typing import List, Optional
+from telegram import Bot
+from model import Goal, User
+
+# Buttons are signed with this key (or, if it is not set, with a key derived from the bot token), so their callback
+# data can be trusted without keeping any state on the server
+CALLBACK_SIGNING_KEY = os.environ['CALLBACK_SIGNING_KEY'] if 'CALLBACK_SIGNING_KEY' in os.environ else None
+callback_data_limit = 64
+signature_length = 9
+
+
+def signing_key(bot: Bot) -> bytes:
+    if CALLBACK_SIGNING_KEY is not None:
+        return CALLBACK_SIGNING_KEY.encode()
+    return hashlib.sha256(b'callback_data:' + bot.token.encode()).digest()
+
+
+def signature(bot: Bot, user_id: int, payload: str) -> str:
+    digest = hmac.new(signing_key(bot), f'{user_id}:{payload}'.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest[:signature_length]).decode()
+
+
+def sign(bot: Bot, user_id: int, *fields: str) -> str:
+    """Joins the fields to callback data, signed for the given user (only that user's button presses verify)"""
+    payload = ':'.join(fields)
+    data = f'{payload}:{signature(bot, user_id, payload)}'
+    if len(data.encode()) > callback_data_limit:
+        raise ValueError(f'Callback data exceeds {callback_data_limit} bytes: {data}')
+    return data
+
+
+def verify(bot: Bot, user_id: int, data: str) -> Optional[List[str]]:
+    """Returns the fields of signed callback data, or None if the signature does not match"""
+    payload, _, received = data.rpartition(':')
+    if not hmac.compare_digest(received, signature(bot, user_id, payload)):
+        return None
+    return payload.split(':')
+
+
+def goal_key(goal: Goal) -> str:
+    """The key of a goal in callback data, which no other goal of the user (not even one with the same title created
+    after the goal has been deleted) has"""
+    return goal.key
+
+
+def find_goal(user: User, key: str) -> Optional[Goal]:
+    return next((goal for goal in user.goals if goal_key(goal) == key), None)
+
+
+def to_base36(number: int) -> str:
+    digits = '0123456789abcdefghijklmnopqrstuvwxyz'
+    encoded = ''
+    while True:
+        number, remainder = divmod(number, 36)
+        encoded = digits[remainder] + encoded
+        if number == 0:
+            return encoded
@@ -0,0 +1,46 @@
+import os
+import time
+from typing import Dict, Tuple
+from telegram.ext import CallbackContext
+from messaging import get_outbound_queue, Priority
+from metrics import timed_job
+from model import DialogStore
+
+DIALOG_SWEEP_INTERVAL = float(os.environ['DIALOG_SWEEP_INTERVAL']) \
+    if 'DIALOG_SWEEP_INTERVAL' in os.environ else 600.
+# at most this many expired keyboards are closed per sweep, the others are closed when they are pressed
+DIALOG_SWEEP_BATCH = int(os.environ['DIALOG_SWEEP_BATCH']) if 'DIALOG_SWEEP_BATCH' in os.environ else 500
+
+
+def dialog_counts(chat_data: Dict[int, Dict]) -> Tuple[int, int]:
+    """Returns the number of stored dialogs and the number of chats with dialogs"""
+    counts = [len(data['dialogs']) for data in list(chat_data.values()) if len(data.get('dialogs', ())) > 0]
+    return sum(counts), len(counts)
+
+
+@timed_job
+async def sweep_dialogs(context: CallbackContext):
+    now = time.time()
+    expired_count = 0
+    to_close = set()
+    changed_chats = set()
+    for chat_id, data in list(context.application.chat_data.items()):
+        if 'dialogs' not in data:
+            continue
+        for dialog_id, dialog in DialogStore.of(data).pop_expired(now):
+            expired_count += 1
+            changed_chats.add(chat_id)
+            if 'message_id' in dialog:
+                to_close.add((chat_id, dialog['message_id']))
+    # only the chats of the handled updates are written automatically
+    context.application.mark_data_for_update_persistence(chat_ids=changed_chats)
+
+    outbound = get_outbound_queue(context.bot)
+    closing = sorted(to_close)[:DIALOG_SWEEP_BATCH]
+    for chat_id, message_id in closing:
+        outbound.send(Priority.SCHEDULED, chat_id, 'edit_message_reply_markup', chat_id=chat_id,
+                      message_id=message_id, reply_markup=None)
+
+    dialog_count, chat_count = dialog_counts(context.application.chat_data)
+    print(f'dialogs: {dialog_count} open in {chat_count} chats, {expired_count} expired, '
+          f'closing {len(closing)} keyboards')
@@ -0,0 +1,35 @@
+import asyncio
+import os
+import tempfile
+from pathlib import Path
+from telegram import Update
+from telegram.ext import CallbackContext
+from common import chat_types
+from interactions.auth import authorized
+from persistence import export_formats, export_snapshot, write_export
+
+
+@chat_types('private')
+@authorized
+async def handle_export(update: Update, context: CallbackContext):
+    """Sends the goals and data points of the user as a file per format (/export [csv|jsonl], all formats by default)
+
+    The goals are copied on the event loop, the documents are then written chunk by chunk to temporary files in a
+    worker thread, which a local Bot API server (see TELEGRAM_API_LOCAL_MODE) reads directly, so a long history is
+    neither held in memory as a whole nor blocks the other updates while it is serialized.
+    """
+    formats = [f.lower() for f in context.args] if context.args else list(export_formats)
+    unknown = [f for f in formats if f not in export_formats]
+    if len(unknown) > 0:
+        await update.message.reply_text(f"Unknown export format '{unknown[0]}' (available: "
+                                        f"{', '.join(export_formats)})")
+        return
+
+    user = context.bot_data['users'][update.effective_user.id]
+    goals = export_snapshot(user)
+    with tempfile.TemporaryDirectory() as directory:
+        for export_format in formats:
+            filename = f'drill_sergeant_{user.id}.{export_format}'
+            path = os.path.join(directory, filename)
+            await asyncio.to_thread(write_export, path, export_format, goals)
+            await update.message.reply_document(Path(path), filename=filename)
@@ -1,66 +1,126 @@
 from common import reaction_stickers
 from apscheduler.schedulers.base import BaseScheduler
 from apscheduler.triggers.cron.expressions import AllExpression
-from apscheduler.triggers.cron import CronTrigger
-from telegram.ext import CallbackContext, Dispatcher
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, ReplyKeyboardRemove
-from model import Goal, User
-from typing import List, Union, Iterable
-from croniter import croniter
+from telegram.ext import Application, CallbackContext, Job, JobQueue
+from telegram import Bot, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup, Update, ReplyKeyboardRemove
+from model import CronSchedule, DialogStore, Goal, User
+from persistence import record_answer
+from messaging import get_outbound_queue, Priority
+from metrics import timed_job
+from interactions.callbacks import sign, verify, goal_key, find_goal, to_base36
+from typing import Dict, List, Optional, Tuple, Union, Iterable
 from datetime import datetime, timedelta
+from threading import Lock
+import os
 import random
-import string
 
 
-def check_goals(context: CallbackContext):
-    user_id = int(context.job.context['user_id'])
-    goals: List[Goal] = list(context.job.context['goals'])
-    user: User = context.bot_data['users'][user_id]
-    if len(goals) == 0:
+# sends all goals of a goal check in a single message (one keyboard row per goal) instead of one message per goal
+MERGE_GOAL_CHECK_PROMPTS = os.environ['GOAL_CHECK_MERGE_PROMPTS'].lower() in ['1', 'true', 'yes'] \
+    if 'GOAL_CHECK_MERGE_PROMPTS' in os.environ else False
+GOAL_CHECK_BATCH_SIZE = int(os.environ['GOAL_CHECK_BATCH_SIZE']) if 'GOAL_CHECK_BATCH_SIZE' in os.environ else 200
+
+
+def goal_check_buttons(bot: Bot, user: User, goal: Goal, timestamp: int, label: str = '') -> List[InlineKeyboardButton]:
+    fields = ('gc', goal_key(goal), to_base36(timestamp))
+    return [InlineKeyboardButton(f"{label}yes", callback_data=sign(bot, user.id, *fields, 'y')),
+            InlineKeyboardButton(f"{label}no", callback_data=sign(bot, user.id, *fields, 'n'))]
+
+
+def check_goals_for_user(context: CallbackContext, user: User, goals: List[Goal], time_end: datetime,
+                         time_string: str):
+    # the buttons carry everything needed to record the answer, so no dialog state is kept
+    outbound = get_outbound_queue(context.bot)
+    intro = f'Please select whether or not you have met your goals during the last {time_string}'
+    timestamp = int(time_end.timestamp())
+    if MERGE_GOAL_CHECK_PROMPTS:
+        keyboard = [goal_check_buttons(context.bot, user, goal, timestamp, f'{goal.title}: ') for goal in goals]
+        outbound.send_message(user.chat_id, f'{intro}:', reply_markup=InlineKeyboardMarkup(keyboard))
+        return
+
+    outbound.send_message(user.chat_id, intro)
+    for goal in goals:
+        keyboard = [goal_check_buttons(context.bot, user, goal, timestamp)]
+        outbound.send_message(user.chat_id, f'Did you meet your goal {goal.title}?',
+                              reply_markup=InlineKeyboardMarkup(keyboard))
+
+
+@timed_job
+async def check_goals(context: CallbackContext):
+    """Fires once per cron expression and hands the subscribed users on to batch jobs"""
+    cron = context.job.data['cron']
+    members = goal_check_scheduler.members(cron)
+    if len(members) == 0:
         print(f"No goals found for job {context.job.name}")
         return
 
-    cron = croniter(goals[0].cron, datetime.now())
-    time_end: datetime = cron.get_prev(ret_type=datetime)
-    time_start: datetime = cron.get_prev(ret_type=datetime)
-    time_period = (time_end - time_start)
+    time_end, time_string = CronSchedule.of(cron).period(datetime.now())
+    for start in range(0, len(members), GOAL_CHECK_BATCH_SIZE):
+        context.job_queue.run_once(check_goals_batch, 0, name=f'{context.job.name}:batch',
+                                   data={'members': members[start:start + GOAL_CHECK_BATCH_SIZE],
+                                         'time_end': time_end, 'time_string': time_string})
 
-    if time_period.total_seconds() / 60 < 120:
-        time_string = f'{int(time_period.total_seconds() / 60)} minutes'
-    elif time_period.seconds / 3600 < 24:
-        time_string = f'{int(time_period.total_seconds() / 3600)} hours'
-    else:
-        time_string = f'{time_period.days} days'
-        if time_period.seconds >= 3600:
-            time_string += f', {int(time_period.seconds / 3600)} hours'
-
-    context.bot.send_message(user.chat_id,
-                             f'Please select whether or not you have met your goals during the last {time_string}')
-    chat_data = context.dispatcher.chat_data[user.chat_id]
-    if 'dialogs' not in chat_data:
-        chat_data['dialogs'] = {}
-
-    dialog_data = {
-        'timestamp': time_end.timestamp()
-    }
-    for goal in goals:
-        dialog_id = ''.join(random.choice(string.ascii_letters) for _ in range(24))
-        chat_data['dialogs'][dialog_id] = {**dialog_data, **{'goal': goal.title}}
-        keyboard = [
-            [InlineKeyboardButton("yes", callback_data=f'goal_check:{dialog_id}:true'),
-             InlineKeyboardButton("no", callback_data=f'goal_check:{dialog_id}:false')]
-        ]
-        context.bot.send_message(user.chat_id, f'Did you meet your goal {goal.title}?',
-                                 reply_markup=InlineKeyboardMarkup(keyboard))
 
+@timed_job
+async def check_goals_batch(context: CallbackContext):
+    users = context.bot_data['users']
+    for user_id, goals in context.job.data['members']:
+        if user_id not in users:
+            continue
+        check_goals_for_user(context, users[user_id], goals, context.job.data['time_end'],
+                             context.job.data['time_string'])
+
+
+class GoalCheckScheduler:
+    """Schedules goal checks with a single job per distinct cron expression
+
+    Each cron expression keeps an index of the users (and their goals) that are checked on that schedule, so adding
+    or removing goals only updates the index. Jobs are created for new expressions and removed once an expression
+    has no members anymore.
+    """
+
+    def __init__(self):
+        self._members: Dict[str, Dict[int, List[Goal]]] = {}
+        self._jobs: Dict[str, Job] = {}
+        self._lock = Lock()
+
+    def update(self, job_queue: JobQueue, user_id: int, goals: List[Goal], cron: str):
+        with self._lock:
+            members = self._members.setdefault(cron, {})
+            if len(goals) == 0:
+                members.pop(user_id, None)
+            else:
+                members[user_id] = list(goals)
+
+            if len(members) == 0:
+                del self._members[cron]
+                job = self._jobs.pop(cron, None)
+                if job is not None:
+                    job.schedule_removal()
+            elif cron not in self._jobs:
+                trigger = CronSchedule.of(cron).trigger
+                self._jobs[cron] = job_queue.run_custom(check_goals, {'trigger': trigger}, data={'cron': cron},
+                                                        name=f'goal_check:{cron}')
+
+    def members(self, cron: str) -> List[Tuple[int, List[Goal]]]:
+        with self._lock:
+            return list(self._members.get(cron, {}).items())
+
+    def schedules(self) -> List[str]:
+        with self._lock:
+            return list(self._members.keys())
 
-def schedule_all_goal_checks(context: Union[CallbackContext, Dispatcher]):
+
+goal_check_scheduler = GoalCheckScheduler()
+
+
+def schedule_all_goal_checks(context: Union[CallbackContext, Application]):
 
     for user in context.bot_data['users']:
         schedule_all_goal_checks_for_user(context, user)
 
 
-def schedule_all_goal_checks_for_user(context: Union[CallbackContext, Dispatcher], user: User):
+def schedule_all_goal_checks_for_user(context: Union[CallbackContext, Application], user: User):
     goal: Goal
     goals: List[Goal]
 
@@ -75,54 +135,88 @@ def schedule_all_goal_checks_for_user(context: Union[CallbackContext, Dispatcher
         schedule_goal_check(context, user, grouped_goals, grouped_goals[0].cron)
 
 
-def schedule_goal_check(context: Union[CallbackContext, Dispatcher], user: User, goals: List[Goal], cron: str):
-    job_name = f'{user.id}:{cron}'
-    existing_jobs = context.job_queue.get_jobs_by_name(job_name)
-    if len(existing_jobs) != 0:
-        for job in existing_jobs:
-            job.schedule_removal()
-    if len(goals) == 0:
-        return
-    trigger = CronTrigger.from_crontab(cron)
-    job = context.job_queue.run_custom(check_goals, {'trigger': trigger},
-                                       context={'user_id': user.id, 'goals': goals},
-                                       name=job_name)
-    user.jobs.append(job)
+def schedule_goal_check(context: Union[CallbackContext, Application], user: User, goals: List[Goal], cron: str):
+    goal_check_scheduler.update(context.job_queue, user.id, goals, cron)
 
 
-def handle_goal_check_response(update: Update, context: CallbackContext):
+async def handle_goal_check_response(update: Update, context: CallbackContext):
+    """Handles the buttons of goal checks sent before the callback data was signed"""
     query = update.callback_query
     uid = query.from_user.id
-    try:
-        _, dialog_id, choice = query.data.split(':')
-
-        if 'dialogs' not in context.chat_data or dialog_id not in context.chat_data['dialogs']:
-            query.answer('Could not find that dialog. Closing automatically...')
-            query.edit_message_reply_markup(reply_markup=None)
-            return
+    _, dialog_id, choice = query.data.split(':')
 
-        goal_title = context.chat_data['dialogs'][dialog_id]['goal']
-        timestamp = context.chat_data['dialogs'][dialog_id]['timestamp']
-
-        del context.chat_data['dialogs'][dialog_id]
-    except ValueError as e:
-        print(e)
-        _, uid, goal_title, timestamp, choice = query.data.split(':')
+    dialog = DialogStore.of(context.chat_data).pop(dialog_id, None)
+    if dialog is None:
+        await query.answer('Could not find that dialog. Closing automatically...')
+        await query.edit_message_reply_markup(reply_markup=None)
+        return
 
+    goal_title = dialog['goal']
     if uid not in context.bot_data['users'] \
             or goal_title not in (g.title for g in context.bot_data['users'][uid].goals):
         print(f"ERROR: Could not find goal for goal check response '{update.message}'!")
-        context.bot.send_message(update.effective_chat.id,
-                                 'Sorry, something went wrong. Please contact the bot developer')
+        await context.bot.send_message(update.effective_chat.id,
+                                       'Sorry, something went wrong. Please contact the bot developer')
+        return
+
+    goal = context.bot_data['users'][uid].find_goal_by_title(goal_title)
+    await record_goal_check_answer(query, context, uid, goal, float(dialog['timestamp']), choice == 'true',
+                                   f':{dialog_id}:' if dialog.get('merged', False) else None)
+
+
+async def handle_signed_goal_check_response(update: Update, context: CallbackContext):
+    query = update.callback_query
+    uid = query.from_user.id
+    fields = verify(context.bot, uid, query.data)
+    if fields is None or len(fields) != 4:
+        await query.answer('This button is not valid (anymore)')
         return
+    _, key, timestamp, choice = fields
 
-    goal = next(goal for goal in context.bot_data['users'][uid].goals if goal.title == goal_title)
-    goal.add_data(1 if choice == 'true' else 0, datetime.fromtimestamp(float(timestamp)))
-    query.answer()
-    query.edit_message_text(query.message.text + (u' \u2705' if goal.data[-1]['value'] else u' \u274c'))
-    if choice == 'true':
+    goal = find_goal(context.bot_data['users'][uid], key) if uid in context.bot_data['users'] else None
+    if goal is None:
+        await query.answer('Could not find that goal. Closing automatically...')
+        await query.edit_message_reply_markup(reply_markup=None)
+        return
+
+    timestamp = float(int(timestamp, 36))
+    # merged goal checks have one keyboard row per goal
+    row_prefix = f'gc:{key}:' if len(query.message.reply_markup.inline_keyboard) > 1 else None
+    # goal checks from before the (trimmed) history would be dropped at once, so they have expired
+    if goal.has_data_at(timestamp) or goal.is_before_history(timestamp):
+        await query.answer('You have already answered this goal check' if goal.has_data_at(timestamp)
+                           else 'This goal check has expired')
+        keyboard = [] if row_prefix is None else \
+            [row for row in query.message.reply_markup.inline_keyboard
+             if not any(row_prefix in (button.callback_data or '') for button in row)]
+        await query.edit_message_reply_markup(reply_markup=InlineKeyboardMarkup(keyboard) if len(keyboard) > 0
+                                              else None)
+        return
+    await record_goal_check_answer(query, context, uid, goal, timestamp, choice == 'y', row_prefix)
+
+
+async def record_goal_check_answer(query: CallbackQuery, context: CallbackContext, uid: int, goal: Goal,
+                                   timestamp: float, met: bool, merged_row_marker: Optional[str]):
+    value = 1 if met else 0
+    goal.add_data(value, datetime.fromtimestamp(timestamp))
+    await record_answer(context, uid, goal, timestamp, value)
+    await query.answer()
+
+    outbound = get_outbound_queue(context.bot)
+    chat_id = query.message.chat_id
+    result = u' \u2705' if value else u' \u274c'
+    if merged_row_marker is not None:
+        # only the answered goal's row is removed from the keyboard of a merged goal check
+        keyboard = [row for row in query.message.reply_markup.inline_keyboard
+                    if not any(merged_row_marker in (button.callback_data or '') for button in row)]
+        outbound.send(Priority.INTERACTIVE, chat_id, 'edit_message_text', f'{query.message.text}\n{goal.title}{result}',
+                      chat_id=chat_id, message_id=query.message.message_id,
+                      reply_markup=InlineKeyboardMarkup(keyboard) if len(keyboard) > 0 else None)
+    else:
+        outbound.send(Priority.INTERACTIVE, chat_id, 'edit_message_text', query.message.text + result,
+                      chat_id=chat_id, message_id=query.message.message_id)
+    if met:
         sticker = random.choice(reaction_stickers['approval'])
     else:
         sticker = random.choice(reaction_stickers['disapproval'])
-    query.message.reply_sticker(sticker)
-
+    outbound.send(Priority.INTERACTIVE, chat_id, 'send_sticker', chat_id, sticker)
@@ -1,25 +1,46 @@
+import asyncio
 import os
-import re
-from telegram import Update, ParseMode, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
-from telegram.ext import Updater, MessageHandler, Filters, CommandHandler, CallbackContext, PollHandler, \
-    PollAnswerHandler, PicklePersistence, ConversationHandler, CallbackQueryHandler
-from typing import Dict, Callable, List
-from common import admin_id, initialize, chat_types, cron_pattern, goal_score_types, markdown_v2_escape
+import secrets
+import signal
+from urllib.parse import urlparse
+from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton, ReplyKeyboardRemove
+from telegram.constants import ParseMode
+from telegram.ext import Application, ApplicationBuilder, CommandHandler, CallbackContext, ContextTypes, \
+    ConversationHandler, CallbackQueryHandler, TypeHandler
+from typing import List, Optional
+from common import initialize, chat_types
 from interactions import authorized, show_auth_dialog, authorize_user, schedule_all_goal_checks, add_goal_handler, \
-    handle_goal_check_response, schedule_goal_check
-from stats import handle_stats
-from model import Goal, User
-import random
-import string
+    handle_goal_check_response, handle_signed_goal_check_response, schedule_goal_check, sweep_dialogs, \
+    DIALOG_SWEEP_INTERVAL, handle_export
+from interactions.callbacks import sign, verify, goal_key, find_goal
+from stats import handle_stats, get_renderer
+from persistence import SQLitePersistence, BotData, import_pickle
+from messaging import stop_outbound_queue, WebhookServer
+from metrics import instrument_application, start_metrics_server, stop_metrics_server, timed_job
+from sharding import ShardRouter
+from model import DialogStore, Goal, User
 
 bot_token = os.environ['TELEGRAM_API_TOKEN']
+# e.g. a local Bot API server
+bot_api_url = os.environ['TELEGRAM_API_URL'] if 'TELEGRAM_API_URL' in os.environ else None
+# files are then sent as paths, so the server has to be able to read the files written by the bot
+bot_api_local_mode = os.environ['TELEGRAM_API_LOCAL_MODE'].lower() in ['1', 'true', 'yes'] \
+    if 'TELEGRAM_API_LOCAL_MODE' in os.environ else False
 
 DELETE_SELECTION = 1
+COMPACTION_INTERVAL = 60
+# the number of updates that are handled at the same time
+CONCURRENT_UPDATES = int(os.environ['CONCURRENT_UPDATES']) if 'CONCURRENT_UPDATES' in os.environ else 256
+# the connections used for requests to the Bot API, requests beyond that wait for a free connection (httpx scans the
+# whole pool for every request, which costs more CPU than the connections save once there are hundreds of them)
+BOT_API_CONNECTIONS = int(os.environ['BOT_API_CONNECTIONS']) if 'BOT_API_CONNECTIONS' in os.environ else 16
+# with more than one shard, the users are distributed over that many worker processes
+SHARD_COUNT = int(os.environ['SHARD_COUNT']) if 'SHARD_COUNT' in os.environ else 1
 
 
 @authorized
 @chat_types('private')
-def start(update: Update, context: CallbackContext):
+async def start(update: Update, context: CallbackContext):
 
     context.chat_data['goal_data'] = None
     uid = update.effective_user.id
@@ -32,76 +53,105 @@ def start(update: Update, context: CallbackContext):
         if update.effective_user.first_name is not None:
             user.name = update.effective_user.first_name + f'{update.effective_user.last_name}' \
                 if update.effective_user.last_name is not None else ''
+    context.bot_data['users'].mark_dirty(uid)
 
-    update.effective_message.reply_html('Welcome to the Drill Sergeant. Send /add to add a goal or /help to get more '
-                                        'information.', reply_markup=ReplyKeyboardRemove())
+    await update.effective_message.reply_html('Welcome to the Drill Sergeant. Send /add to add a goal or /help to get '
+                                              'more information.', reply_markup=ReplyKeyboardRemove())
 
 
 @chat_types('private')
 @authorized
-def delete_dialog(update: Update, context: CallbackContext):
+async def delete_dialog(update: Update, context: CallbackContext):
     keyboard: List[List[InlineKeyboardButton]] = [[]]
     uid = update.effective_user.id
     if len(context.bot_data['users'][uid].goals) == 0:
-        update.message.reply_text("You have no goals registered")
+        await update.message.reply_text("You have no goals registered")
         return
 
-    dialog_id = ''.join(random.choice(string.ascii_letters) for _ in range(24))
-    if 'dialogs' not in context.chat_data:
-        context.chat_data['dialogs'] = {}
-    context.chat_data['dialogs'][dialog_id] = {
-        'goals': [g.title for g in context.bot_data['users'][uid].goals]
-    }
-    for i, goal_title in enumerate(context.chat_data['dialogs'][dialog_id]['goals']):
+    for goal in context.bot_data['users'][uid].goals:
         if len(keyboard[-1]) == 4:
             keyboard.append([])
-        keyboard[-1].append(InlineKeyboardButton(goal_title, callback_data=f'goal_delete:{dialog_id}:{i}'))
-    keyboard.append([InlineKeyboardButton('Cancel', callback_data=f'goal_delete:{dialog_id}:CANCEL')])
+        keyboard[-1].append(InlineKeyboardButton(goal.title,
+                                                 callback_data=sign(context.bot, uid, 'gd', goal_key(goal))))
+    keyboard.append([InlineKeyboardButton('Cancel', callback_data=sign(context.bot, uid, 'gd', 'CANCEL'))])
 
-    update.message.reply_text('Select the goal to delete', reply_markup=InlineKeyboardMarkup(keyboard))
+    await update.message.reply_text('Select the goal to delete', reply_markup=InlineKeyboardMarkup(keyboard))
 
 
 @chat_types('private')
 @authorized
-def delete_goal(update: Update, context: CallbackContext):
+async def delete_goal_signed(update: Update, context: CallbackContext):
+    query = update.callback_query
+    user_id = query.from_user.id
+    fields = verify(context.bot, user_id, query.data)
+    if fields is None or len(fields) != 2:
+        await query.answer('This button is not valid (anymore)')
+        return
+
+    await query.edit_message_reply_markup()
+    if fields[1] == 'CANCEL':
+        await query.answer()
+        return
+
+    user = context.bot_data['users'][user_id]
+    goal = find_goal(user, fields[1])
+    if goal is None:
+        await query.answer('The goal does not exist (anymore)')
+        return
+    remove_goal(context, user, goal)
+    await query.answer('The goal has been deleted.')
+    await query.message.reply_text(f'The goal \'{goal.title}\' has been deleted')
+
+
+def remove_goal(context: CallbackContext, user: User, goal: Goal):
+    schedule = goal.cron
+    user.remove_goal(goal)
+    context.bot_data['users'].mark_dirty(user)
+    schedule_goal_check(context, user, [g for g in user.goals if g.cron == schedule], schedule)
+
+
+@chat_types('private')
+@authorized
+async def delete_goal(update: Update, context: CallbackContext):
+    """Handles the buttons of delete dialogs sent before the callback data was signed"""
     query = update.callback_query
     _, dialog_id, goal_id = query.data.split(':')
-    if 'dialogs' not in context.chat_data or dialog_id not in context.chat_data['dialogs']:
-        query.answer('Could not find dialog. Closing...')
-        query.edit_message_reply_markup()
+    dialogs = DialogStore.of(context.chat_data)
+    if dialog_id not in dialogs:
+        await query.answer('Could not find dialog. Closing...')
+        await query.edit_message_reply_markup()
+        return
 
     if goal_id == 'CANCEL':
-        query.answer()
-        query.edit_message_reply_markup()
-        del context.chat_data['dialogs'][dialog_id]
+        await query.answer()
+        await query.edit_message_reply_markup()
+        del dialogs[dialog_id]
         return
 
-    goal_title = context.chat_data['dialogs'][dialog_id]['goals'][int(goal_id)]
+    goal_title = dialogs[dialog_id]['goals'][int(goal_id)]
     user_id = query.from_user.id
 
-    query.edit_message_reply_markup()
+    await query.edit_message_reply_markup()
 
     user = context.bot_data['users'][int(user_id)]
-    goal = user.find_goal_by_title(goal_title)
-    schedule = goal.cron
-    user.remove_goal(goal)
-    schedule_goal_check(context, user, [g for g in user.goals if g.cron == schedule], schedule)
-    query.answer('The goal has been deleted.')
-    query.message.reply_text(f'The goal \'{goal_title}\' has been deleted')
+    remove_goal(context, user, user.find_goal_by_title(goal_title))
+    del dialogs[dialog_id]
+    await query.answer('The goal has been deleted.')
+    await query.message.reply_text(f'The goal \'{goal_title}\' has been deleted')
 
 
 @chat_types('private')
 @authorized
-def debug(update: Update, context: CallbackContext):
+async def debug(update: Update, context: CallbackContext):
     user = context.bot_data['users'][update.effective_user.id]
-    update.message.reply_text(str(user))
+    await update.message.reply_text(str(user))
     # for goal in user.goals:
     #     update.message.reply_text(str(goal))
 
 
 @chat_types('private')
 @authorized
-def show_info(update: Update, context: CallbackContext):
+async def show_info(update: Update, context: CallbackContext):
     user = context.bot_data['users'][update.effective_user.id]
     text = f"You are registered as {user.name} (id: {user.id})\n\n"
     text += f"You have {len(user.goals)} goals registered:\n"
@@ -109,17 +159,17 @@ def show_info(update: Update, context: CallbackContext):
     for goal in user.goals:
         text += f"{str(goal)}\n---\n"
 
-    update.message.reply_text(text)
+    await update.message.reply_text(text)
 
 
-def cancel_all(update: Update, context: CallbackContext):
+async def cancel_all(update: Update, context: CallbackContext):
     for key in list(context.chat_data.keys()):
         del context.chat_data[key]
-    update.message.reply_text('All ongoing processes have been canceled', reply_markup=ReplyKeyboardRemove())
+    await update.message.reply_text('All ongoing processes have been canceled', reply_markup=ReplyKeyboardRemove())
     return ConversationHandler.END
 
 
-def show_help_message(update: Update, _):
+async def show_help_message(update: Update, _):
     msg = f"Drill Sergeant lets you register Goals and supports you with achieving them\\. In order to do so, it " \
           f"will ask you whether or not you have been able to meet your goals and calculates a score to help you " \
           f"track your progress\\.\n" \
@@ -128,47 +178,148 @@ def show_help_message(update: Update, _):
           f"/help Show an overview over available commands\n" \
           f"/add Add a new goal\n" \
           f"/delete Delete an existing goal\n" \
-          f"/stats List your goals and show how you're doing so far\n" \
+          f"/stats List your goals and show how you're doing so far \\(e\\.g\\. /stats 365 for the last year\\)\n" \
           f"/info  List your goals and their configuration\n" \
+          f"/export Download your goals and answers as CSV and JSON Lines \\(e\\.g\\. /export csv\\)\n" \
           f"/debug Show debug information\n" \
           f"/authorize Show the authorization/group registration dialog"
 
-    update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN_V2)
+    await update.message.reply_text(msg, parse_mode=ParseMode.MARKDOWN_V2)
 
 
-def print_message(update: Update, context: CallbackContext):
+async def print_message(update: Update, context: CallbackContext):
     from common import reaction_stickers
     for emotion in reaction_stickers.keys():
-        update.message.reply_text(emotion)
+        await update.message.reply_text(emotion)
         for sticker in reaction_stickers[emotion]:
-            update.message.reply_sticker(sticker)
+            await update.message.reply_sticker(sticker)
+
+
+@timed_job
+async def flush_persistence(context: CallbackContext):
+    await context.application.persistence.flush()
+
+
+async def start_bot(application: Application):
+    initialize(application)
+    schedule_all_goal_checks(application)
+    get_renderer().warm_up()
+    await start_metrics_server()
+
+
+async def stop_bot(_: Application):
+    # runs before the application shuts down, so queued messages can still be sent
+    get_renderer().shutdown()
+    await stop_outbound_queue(timeout=10)
+    await stop_metrics_server()
+
+
+async def serve(application: Application, server, stopped: Optional[asyncio.Event] = None):
+    """Runs the application on the updates received by the server (e.g. a :class:`WebhookServer`) until ``stopped`` is
+    set or the process is asked to stop"""
+    stopped = asyncio.Event() if stopped is None else stopped
+    for stop_signal in (signal.SIGINT, signal.SIGTERM):
+        asyncio.get_running_loop().add_signal_handler(stop_signal, stopped.set)
+
+    await application.initialize()
+    if application.post_init is not None:
+        await application.post_init(application)
+    await application.start()
+    await server.start()
+    try:
+        await stopped.wait()
+    finally:
+        await server.stop(timeout=10)
+        await application.stop()
+        if application.post_stop is not None:
+            await application.post_stop(application)
+        await application.shutdown()
+
+
+def application_builder() -> ApplicationBuilder:
+    builder = ApplicationBuilder().token(bot_token).concurrent_updates(CONCURRENT_UPDATES) \
+        .connection_pool_size(BOT_API_CONNECTIONS).pool_timeout(None)
+    if bot_api_url is not None:
+        builder = builder.base_url(bot_api_url).local_mode(bot_api_local_mode)
+    return builder
+
+
+def build_application(persistence: SQLitePersistence, updater: bool = True) -> Application:
+    builder = application_builder().persistence(persistence).context_types(ContextTypes(bot_data=BotData)) \
+        .post_init(start_bot).post_stop(stop_bot)
+    if not updater:
+        builder = builder.updater(None)
+    application = builder.build()
+
+    application.add_handler(CommandHandler('start', start))
+    application.add_handler(CommandHandler('authorize', show_auth_dialog))
+    application.add_handler(add_goal_handler)
+    application.add_handler(CommandHandler('stats', handle_stats))
+    application.add_handler(CommandHandler('delete', delete_dialog))
+    application.add_handler(CommandHandler('help', show_help_message))
+    application.add_handler(CommandHandler('debug', debug))
+    application.add_handler(CommandHandler('info', show_info))
+    application.add_handler(CommandHandler('export', handle_export))
+    application.add_handler(CommandHandler('cancel', cancel_all))
+
+    application.add_handler(CallbackQueryHandler(handle_goal_check_response, pattern=r'^goal_check:.*$'))
+    application.add_handler(CallbackQueryHandler(delete_goal, pattern=r'^goal_delete:.*$'))
+    application.add_handler(CallbackQueryHandler(handle_signed_goal_check_response, pattern=r'^gc:.*$'))
+    application.add_handler(CallbackQueryHandler(delete_goal_signed, pattern=r'^gd:.*$'))
+    application.add_handler(CallbackQueryHandler(authorize_user, pattern=r'^auth_dialog:.*$'))
+
+    # application.add_handler(MessageHandler(filters.Sticker.ALL, print_message))
+
+    application.job_queue.run_repeating(flush_persistence, interval=COMPACTION_INTERVAL, name='compaction')
+    application.job_queue.run_repeating(sweep_dialogs, interval=DIALOG_SWEEP_INTERVAL, name='dialog_sweeper')
+    instrument_application(application)
+    return application
+
+
+def build_router_application(router: ShardRouter) -> Application:
+    """The front process of a sharded deployment, which only forwards the updates to the shards"""
+    async def start_router(application: Application):
+        await router.start(application)
+        await start_metrics_server()
+
+    async def stop_router(application: Application):
+        await router.stop(application)
+        await stop_metrics_server()
+
+    application = application_builder().post_init(start_router).post_stop(stop_router).build()
+    application.add_handler(TypeHandler(Update, router.route))
+    instrument_application(application, state=False)
+    return application
 
 
 if __name__ == '__main__':
-    persistence = PicklePersistence(
-        filename=os.environ['PICKLE_PATH'] if 'PICKLE_PATH' in os.environ else 'driserbot_state')
-    updater = Updater(token=bot_token, use_context=True, persistence=persistence)
-
-    initialize(updater.dispatcher)
-    schedule_all_goal_checks(updater.dispatcher)
-
-    updater.dispatcher.add_handler(CommandHandler('start', start))
-    updater.dispatcher.add_handler(CommandHandler('authorize', show_auth_dialog))
-    updater.dispatcher.add_handler(add_goal_handler)
-    updater.dispatcher.add_handler(CommandHandler('stats', handle_stats))
-    updater.dispatcher.add_handler(CommandHandler('delete', delete_dialog))
-    updater.dispatcher.add_handler(CommandHandler('help', show_help_message))
-    updater.dispatcher.add_handler(CommandHandler('debug', debug))
-    updater.dispatcher.add_handler(CommandHandler('info', show_info))
-    updater.dispatcher.add_handler(CommandHandler('cancel', cancel_all))
-
-    updater.dispatcher.add_handler(CallbackQueryHandler(handle_goal_check_response, pattern=r'^goal_check:.*$'))
-    updater.dispatcher.add_handler(CallbackQueryHandler(delete_goal, pattern=r'^goal_delete:.*$'))
-    updater.dispatcher.add_handler(CallbackQueryHandler(authorize_user, pattern=r'^auth_dialog:.*$'))
-
-    # updater.dispatcher.add_handler(MessageHandler(Filters.sticker, print_message))
-
-    updater.start_polling()
-    updater.idle()
-
-    PicklePersistence(filename='driserbot_state').get_bot_data()
\ No newline at end of file
+    pickle_path = os.environ['PICKLE_PATH'] if 'PICKLE_PATH' in os.environ else 'driserbot_state'
+    database_path = os.environ['DATABASE_PATH'] if 'DATABASE_PATH' in os.environ else 'driserbot_state.sqlite'
+    import_required = not os.path.exists(database_path) and os.path.exists(pickle_path)
+    journal_path = os.environ['JOURNAL_PATH'] if 'JOURNAL_PATH' in os.environ else f'{database_path}.journal'
+    # webhook mode: Telegram delivers the updates to this (public) url, which has to reach the port of the server
+    webhook_url = os.environ['WEBHOOK_URL'] if 'WEBHOOK_URL' in os.environ else None
+    webhook_secret_token = os.environ['WEBHOOK_SECRET_TOKEN'] if 'WEBHOOK_SECRET_TOKEN' in os.environ \
+        else secrets.token_urlsafe(32)
+    persistence = SQLitePersistence(database_path, journal_path=journal_path)
+    if import_required:
+        import_pickle(pickle_path, persistence)
+    router = None
+    if SHARD_COUNT > 1:
+        # the shards open their own databases (split from this one when they are started first)
+        persistence.close()
+        router = ShardRouter(SHARD_COUNT, database_path, journal_path)
+        application = build_router_application(router)
+    else:
+        application = build_application(persistence)
+
+    if webhook_url is not None:
+        # the router forwards the updates received by the webhook to the shards without decoding them
+        asyncio.run(serve(application, WebhookServer(application, webhook_secret_token,
+                                                     path=urlparse(webhook_url).path or '/', url=webhook_url,
+                                                     forward=router.route_data if router is not None else None)))
+    else:
+        application.run_polling()
+
+    if SHARD_COUNT == 1:
+        persistence.close()
@@ -0,0 +1,2 @@
+from .outbound import OutboundQueue, Priority, TokenBucket, get_outbound_queue, stop_outbound_queue
+from .webhook import WebhookServer
@@ -0,0 +1,253 @@
+import asyncio
+import heapq
+import itertools
+import os
+import time
+from collections import OrderedDict
+from enum import IntEnum
+from typing import Callable, Dict, List, Optional, Set, Tuple
+
+from telegram import Bot
+from telegram.error import BadRequest, RetryAfter, NetworkError
+from metrics import outbound_sent, outbound_failed, outbound_retried, outbound_pending
+
+# Telegram allows about 30 messages per second overall, one per second in a private chat (with short bursts) and 20
+# per minute in a group
+GLOBAL_RATE = float(os.environ['OUTBOUND_GLOBAL_RATE']) if 'OUTBOUND_GLOBAL_RATE' in os.environ else 30.
+CHAT_RATE = float(os.environ['OUTBOUND_CHAT_RATE']) if 'OUTBOUND_CHAT_RATE' in os.environ else 1.
+CHAT_BURST = float(os.environ['OUTBOUND_CHAT_BURST']) if 'OUTBOUND_CHAT_BURST' in os.environ else 2.
+GROUP_RATE = float(os.environ['OUTBOUND_GROUP_RATE']) if 'OUTBOUND_GROUP_RATE' in os.environ else 20. / 60
+# the number of requests that may be waiting for a response from Telegram at the same time
+OUTBOUND_CONCURRENCY = int(os.environ['OUTBOUND_CONCURRENCY']) if 'OUTBOUND_CONCURRENCY' in os.environ else 16
+OUTBOUND_MAX_RETRIES = int(os.environ['OUTBOUND_MAX_RETRIES']) if 'OUTBOUND_MAX_RETRIES' in os.environ else 5
+
+
+class Priority(IntEnum):
+    INTERACTIVE = 0
+    SCHEDULED = 1
+
+
+class TokenBucket:
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now: float) -> float:
+        """Seconds until a token is available (0 if there is one right now)"""
+        self.refill(now)
+        # a token that is only short by a rounding error would mean waiting for less time than the clock resolves
+        return 0. if self.tokens >= 1 - 1e-9 else (1 - self.tokens) / self.rate
+
+    def pause(self, now: float, seconds: float):
+        self.refill(now)
+        self.tokens = min(self.tokens, 0.) - seconds * self.rate
+
+
+class OutboundMessage:
+    __slots__ = ('priority', 'chat_id', 'method', 'args', 'kwargs', 'future', 'enqueued', 'attempts')
+
+    def __init__(self, priority: Priority, chat_id: int, method: str, args: Tuple, kwargs: Dict):
+        self.priority = priority
+        self.chat_id = chat_id
+        self.method = method
+        self.args = args
+        self.kwargs = kwargs
+        self.future: asyncio.Future = asyncio.get_running_loop().create_future()
+        self.enqueued = time.monotonic()
+        self.attempts = 0
+
+
+class OutboundQueue:
+    """Sends bot API requests from a prioritized queue within Telegram's rate limits
+
+    Requests are taken in order of priority (and arrival). A global token bucket limits the overall rate, a bucket per
+    chat limits the rate per chat; a request for a chat that is out of tokens is put aside until that chat has a token
+    again, so it does not hold up other chats. ``RetryAfter`` errors pause the chat for the requested time before
+    the request is retried, network errors are retried with exponential backoff.
+
+    The queue runs on the event loop it is first used from; up to ``concurrency`` requests are awaited at the same
+    time, any number of requests can be queued.
+    """
+
+    def __init__(self, bot: Bot, global_rate: float = GLOBAL_RATE, chat_rate: float = CHAT_RATE,
+                 chat_burst: float = CHAT_BURST, group_rate: float = GROUP_RATE,
+                 concurrency: int = OUTBOUND_CONCURRENCY, max_retries: int = OUTBOUND_MAX_RETRIES,
+                 max_chats: int = 10000):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.max_retries = max_retries
+        self.max_chats = max_chats
+        # no burst capacity for the global limit, a burst plus the refill during the same second would exceed it
+        self._global = TokenBucket(global_rate, 1.)
+        self._chats: OrderedDict[int, TokenBucket] = OrderedDict()
+        self._ready: List[Tuple[int, int, OutboundMessage]] = []
+        self._waiting: List[Tuple[float, int, int, OutboundMessage]] = []
+        self._sequence = itertools.count()
+        self._concurrency = concurrency
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._wakeup: Optional[asyncio.Event] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+        self._in_flight: Set[asyncio.Task] = set()
+        self._running = True
+
+    def send(self, priority: Priority, chat_id: int, method: str, /, *args, **kwargs) -> asyncio.Future:
+        """Queues a call of ``await bot.<method>(*args, **kwargs)``, which is rate limited as a message to the given
+        chat, and returns a future for its result. Must be called from the event loop."""
+        if not self._running:
+            raise RuntimeError('The outbound queue has been stopped')
+        message = OutboundMessage(priority, chat_id, method, args, kwargs)
+        heapq.heappush(self._ready, (priority, next(self._sequence), message))
+        if self._dispatcher is None:
+            self._slots = asyncio.Semaphore(self._concurrency)
+            self._wakeup = asyncio.Event()
+            self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+        self._wakeup.set()
+        return message.future
+
+    def send_message(self, chat_id: int, text: str, priority: Priority = Priority.SCHEDULED,
+                     **kwargs) -> asyncio.Future:
+        return self.send(priority, chat_id, 'send_message', chat_id, text, **kwargs)
+
+    def pending(self) -> int:
+        return len(self._ready) + len(self._waiting) + len(self._in_flight)
+
+    async def stop(self, timeout: Optional[float] = None):
+        """Stops the queue once all queued requests have been sent (or once ``timeout`` seconds have passed)"""
+        self._running = False
+        if self._dispatcher is None:
+            return
+        self._wakeup.set()
+        _, pending = await asyncio.wait([self._dispatcher, *self._in_flight], timeout=timeout)
+        for task in pending:
+            task.cancel()
+
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            # group chats have negative ids
+            bucket = TokenBucket(self.group_rate, 1.) if chat_id < 0 else TokenBucket(self.chat_rate, self.chat_burst)
+            self._chats[chat_id] = bucket
+            if len(self._chats) > self.max_chats:
+                self._trim_chats()
+        else:
+            self._chats.move_to_end(chat_id)
+        return bucket
+
+    def _trim_chats(self):
+        # buckets that are full again carry no state and can be dropped
+        now = time.monotonic()
+        for chat_id in list(itertools.islice(self._chats, len(self._chats) - self.max_chats)):
+            bucket = self._chats[chat_id]
+            bucket.refill(now)
+            if bucket.tokens >= bucket.capacity:
+                del self._chats[chat_id]
+
+    async def _next_message(self) -> Optional[OutboundMessage]:
+        """Waits until a request may be sent and returns it (or None once stopped and drained)"""
+        while True:
+            self._wakeup.clear()
+            now = time.monotonic()
+            while len(self._waiting) > 0 and self._waiting[0][0] <= now:
+                _, priority, sequence, message = heapq.heappop(self._waiting)
+                heapq.heappush(self._ready, (priority, sequence, message))
+
+            timeout = self._waiting[0][0] - now if len(self._waiting) > 0 else None
+            if len(self._ready) > 0:
+                global_wait = self._global.wait_time(now)
+                if global_wait > 0:
+                    timeout = global_wait if timeout is None else min(timeout, global_wait)
+                else:
+                    priority, sequence, message = heapq.heappop(self._ready)
+                    chat_wait = self._chat_bucket(message.chat_id).wait_time(now)
+                    if chat_wait > 0:
+                        heapq.heappush(self._waiting, (now + chat_wait, priority, sequence, message))
+                        continue
+                    self._global.tokens -= 1
+                    self._chats[message.chat_id].tokens -= 1
+                    return message
+            elif not self._running and len(self._waiting) == 0 and len(self._in_flight) == 0:
+                return None
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _dispatch(self):
+        while True:
+            message = await self._next_message()
+            if message is None:
+                return
+            await self._slots.acquire()
+            task = asyncio.get_running_loop().create_task(self._deliver(message))
+            self._in_flight.add(task)
+
+    def _retry(self, message: OutboundMessage, delay: float, error: Exception, pause_chat: bool):
+        if message.attempts > self.max_retries:
+            self._fail(message, error)
+            return
+        now = time.monotonic()
+        if pause_chat:
+            self._chat_bucket(message.chat_id).pause(now, delay)
+        heapq.heappush(self._waiting, (now + delay, message.priority, next(self._sequence), message))
+
+    async def _deliver(self, message: OutboundMessage):
+        message.attempts += 1
+        method: Callable = getattr(self.bot, message.method)
+        try:
+            result = await method(*message.args, **message.kwargs)
+        except RetryAfter as e:
+            print(f'outbound: flood limit hit for chat {message.chat_id}, retrying in {e.retry_after}s')
+            outbound_retried.labels('flood_limit').inc()
+            self._retry(message, float(e.retry_after), e, pause_chat=True)
+        except BadRequest as e:
+            self._fail(message, e)
+        except NetworkError as e:
+            outbound_retried.labels('network_error').inc()
+            self._retry(message, min(2. ** message.attempts, 60.), e, pause_chat=False)
+        except Exception as e:
+            self._fail(message, e)
+        else:
+            outbound_sent.labels(message.method).inc()
+            if not message.future.done():
+                message.future.set_result(result)
+        finally:
+            self._in_flight.discard(asyncio.current_task())
+            self._slots.release()
+            self._wakeup.set()
+
+    @staticmethod
+    def _fail(message: OutboundMessage, error: Exception):
+        print(f'outbound: {message.method} to chat {message.chat_id} failed: {error!r}')
+        outbound_failed.labels(message.method).inc()
+        if not message.future.done():
+            message.future.set_exception(error)
+            # the error has been reported above, most senders never await the result
+            message.future.exception()
+
+
+_queue: Optional[OutboundQueue] = None
+outbound_pending.set_function(lambda: 0 if _queue is None else _queue.pending())
+
+
+def get_outbound_queue(bot: Bot) -> OutboundQueue:
+    global _queue
+    if _queue is None:
+        _queue = OutboundQueue(bot)
+    return _queue
+
+
+async def stop_outbound_queue(timeout: Optional[float] = None):
+    global _queue
+    if _queue is not None:
+        await _queue.stop(timeout)
+        _queue = None
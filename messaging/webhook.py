@@ -0,0 +1,211 @@
+import asyncio
+import hmac
+import json
+import os
+import time
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional, Set, Tuple
+
+from telegram import Update
+from telegram.ext import Application
+
+WEBHOOK_LISTEN = os.environ['WEBHOOK_LISTEN'] if 'WEBHOOK_LISTEN' in os.environ else '0.0.0.0'
+WEBHOOK_PORT = int(os.environ['WEBHOOK_PORT']) if 'WEBHOOK_PORT' in os.environ else 8443
+# updates that have been received but not handed to the application yet, further updates are answered with a 503 (and
+# redelivered by Telegram later)
+WEBHOOK_QUEUE_SIZE = int(os.environ['WEBHOOK_QUEUE_SIZE']) if 'WEBHOOK_QUEUE_SIZE' in os.environ else 1000
+WEBHOOK_BATCH_SIZE = int(os.environ['WEBHOOK_BATCH_SIZE']) if 'WEBHOOK_BATCH_SIZE' in os.environ else 100
+WEBHOOK_IDLE_TIMEOUT = float(os.environ['WEBHOOK_IDLE_TIMEOUT']) if 'WEBHOOK_IDLE_TIMEOUT' in os.environ else 75.
+# the number of connections Telegram opens to deliver updates
+WEBHOOK_MAX_CONNECTIONS = int(os.environ['WEBHOOK_MAX_CONNECTIONS']) \
+    if 'WEBHOOK_MAX_CONNECTIONS' in os.environ else 40
+# Telegram's updates are far smaller, anything bigger is rejected without reading it
+max_body_size = 1024 * 1024
+secret_token_header = 'x-telegram-bot-api-secret-token'
+status_texts = {200: 'OK', 400: 'Bad Request', 403: 'Forbidden', 404: 'Not Found', 405: 'Method Not Allowed',
+                411: 'Length Required', 413: 'Payload Too Large', 503: 'Service Unavailable'}
+
+
+class WebhookServer:
+    """Receives updates from Telegram's webhook with a minimal HTTP/1.1 server
+
+    Requests to ``path`` must carry the ``secret_token`` in the ``X-Telegram-Bot-Api-Secret-Token`` header. Received
+    updates are acknowledged right away and queued; once ``queue_size`` updates are waiting, further requests are
+    answered with 503, which makes Telegram deliver them again later. The queue is drained in batches of up to
+    ``batch_size`` updates, and at most ``concurrency`` updates are processed by the application at the same time.
+    ``GET /healthz`` reports whether the application is running and the counters of the server. If a (public) ``url``
+    is given, the webhook is registered with Telegram once the server has been started.
+
+    If ``forward`` is given (e.g. :meth:`sharding.ShardRouter.route_data`), the updates are handed to it, in the order
+    they have been received and without decoding them, instead of being processed by the application.
+    """
+
+    def __init__(self, application: Application, secret_token: str, path: str = '/', listen: str = WEBHOOK_LISTEN,
+                 port: int = WEBHOOK_PORT, queue_size: int = WEBHOOK_QUEUE_SIZE, batch_size: int = WEBHOOK_BATCH_SIZE,
+                 concurrency: Optional[int] = None, idle_timeout: float = WEBHOOK_IDLE_TIMEOUT,
+                 url: Optional[str] = None, forward: Optional[Callable[[Dict], Awaitable]] = None):
+        self.application = application
+        self.forward = forward
+        self.url = url
+        self.secret_token = secret_token
+        self.path = path
+        self.listen = listen
+        self.port = port
+        self.batch_size = batch_size
+        self.concurrency = concurrency if concurrency is not None else max(1, application.concurrent_updates)
+        self.idle_timeout = idle_timeout
+        self.counters = {'received': 0, 'processed': 0, 'rejected': 0, 'unauthorized': 0, 'invalid': 0}
+        # seconds from receiving an update to the end of its processing, of the most recent updates
+        self.latencies: Deque[float] = deque(maxlen=1000)
+        self._queue: asyncio.Queue = asyncio.Queue(queue_size)
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._in_flight: Set[asyncio.Task] = set()
+        self._connections: Set[asyncio.StreamWriter] = set()
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._dispatcher: Optional[asyncio.Task] = None
+
+    async def start(self):
+        self._slots = asyncio.Semaphore(self.concurrency)
+        self._dispatcher = asyncio.get_running_loop().create_task(self._dispatch())
+        self._server = await asyncio.start_server(self._serve_connection, self.listen, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        print(f'webhook: listening on {self.listen}:{self.port}{self.path}')
+        if self.url is not None:
+            await self.register(self.url)
+
+    async def register(self, url: str, max_connections: int = WEBHOOK_MAX_CONNECTIONS):
+        """Tells Telegram to deliver the updates to the given (public) url of this server"""
+        await self.application.bot.set_webhook(url, secret_token=self.secret_token, max_connections=max_connections,
+                                               allowed_updates=Update.ALL_TYPES)
+
+    async def stop(self, timeout: Optional[float] = None):
+        """Stops accepting updates and waits until the queued updates have been processed"""
+        self._server.close()
+        for writer in list(self._connections):
+            writer.close()
+        await self._server.wait_closed()
+        try:
+            await asyncio.wait_for(self._drain(), timeout)
+        except asyncio.TimeoutError:
+            print(f'webhook: {self._queue.qsize()} queued updates have not been processed')
+        self._dispatcher.cancel()
+
+    def stats(self) -> Dict:
+        latencies = sorted(self.latencies)
+        return dict(self.counters, queued=self._queue.qsize(), in_flight=len(self._in_flight),
+                    latency_p50=latencies[len(latencies) // 2] if latencies else None,
+                    latency_p99=latencies[int(len(latencies) * .99)] if latencies else None)
+
+    async def _drain(self):
+        while not self._queue.empty() or len(self._in_flight) > 0:
+            await asyncio.sleep(0.01)
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections.add(writer)
+        try:
+            while True:
+                request_line = await asyncio.wait_for(reader.readline(), self.idle_timeout)
+                if not request_line:
+                    return
+                method, target, version = request_line.decode('latin-1').split()
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b'\r\n', b'\n', b''):
+                        break
+                    name, _, value = line.decode('latin-1').partition(':')
+                    headers[name.strip().lower()] = value.strip()
+
+                keep_alive = version == 'HTTP/1.1' and headers.get('connection', '').lower() != 'close'
+                length = int(headers.get('content-length', 0))
+                if 'transfer-encoding' in headers or length > max_body_size:
+                    # the connection can't be reused without reading the body
+                    status, body, keep_alive = (411 if 'transfer-encoding' in headers else 413), {}, False
+                else:
+                    status, body = self._handle(method, target, headers,
+                                                await reader.readexactly(length) if length > 0 else b'')
+                self._respond(writer, status, body, keep_alive)
+                await writer.drain()
+                if not keep_alive:
+                    return
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    def _handle(self, method: str, target: str, headers: Dict[str, str], body: bytes) -> Tuple[int, Dict]:
+        if target == '/healthz':
+            if method != 'GET':
+                return 405, {}
+            return (200 if self.application.running else 503), dict(self.stats(), running=self.application.running)
+        if target != self.path:
+            return 404, {}
+        if method != 'POST':
+            return 405, {}
+        if not hmac.compare_digest(headers.get(secret_token_header, ''), self.secret_token):
+            self.counters['unauthorized'] += 1
+            return 403, {}
+        try:
+            data = json.loads(body)
+        except ValueError:
+            self.counters['invalid'] += 1
+            return 400, {}
+        try:
+            self._queue.put_nowait((time.monotonic(), data))
+        except asyncio.QueueFull:
+            self.counters['rejected'] += 1
+            return 503, {}
+        self.counters['received'] += 1
+        return 200, {}
+
+    @staticmethod
+    def _respond(writer: asyncio.StreamWriter, status: int, body: Dict, keep_alive: bool):
+        payload = json.dumps(body).encode() if body else b''
+        head = f'HTTP/1.1 {status} {status_texts[status]}\r\nContent-Length: {len(payload)}\r\n'
+        if payload:
+            head += 'Content-Type: application/json\r\n'
+        if status == 503:
+            head += 'Retry-After: 1\r\n'
+        if not keep_alive:
+            head += 'Connection: close\r\n'
+        writer.write(head.encode('latin-1') + b'\r\n' + payload)
+
+    async def _dispatch(self):
+        while True:
+            batch = [await self._queue.get()]
+            while len(batch) < self.batch_size and not self._queue.empty():
+                batch.append(self._queue.get_nowait())
+            for received, data in batch:
+                if self.forward is not None:
+                    await self._forward(received, data)
+                    continue
+                try:
+                    update = Update.de_json(data, self.application.bot)
+                except (KeyError, TypeError, ValueError) as e:
+                    print(f'webhook: could not decode update: {e!r}')
+                    self.counters['invalid'] += 1
+                    continue
+                await self._slots.acquire()
+                task = asyncio.get_running_loop().create_task(self._process(received, update))
+                self._in_flight.add(task)
+
+    async def _forward(self, received: float, data: Dict):
+        try:
+            await self.forward(data)
+        except Exception as e:
+            print(f'webhook: forwarding update {data.get("update_id")} failed: {e!r}')
+        finally:
+            self.counters['processed'] += 1
+            self.latencies.append(time.monotonic() - received)
+
+    async def _process(self, received: float, update: Update):
+        try:
+            await self.application.process_update(update)
+        except Exception as e:
+            print(f'webhook: processing update {update.update_id} failed: {e!r}')
+        finally:
+            self._in_flight.discard(asyncio.current_task())
+            self._slots.release()
+            self.counters['processed'] += 1
+            self.latencies.append(time.monotonic() - received)
@@ -0,0 +1,5 @@
+from .registry import Registry, Counter, Gauge, Histogram, registry
+from .instrumentation import timed_handler, timed_job, instrument_application, handler_seconds, handler_errors, \
+    job_seconds, job_errors, job_lag, outbound_sent, outbound_failed, outbound_retried, outbound_pending, \
+    persistence_flush_seconds, render_seconds, renders_rejected
+from .server import MetricsServer, start_metrics_server, stop_metrics_server, METRICS_PORT
@@ -0,0 +1,119 @@
+import functools
+import time
+from datetime import datetime, timezone
+from typing import Callable, Dict
+
+from apscheduler.events import EVENT_JOB_SUBMITTED, JobSubmissionEvent
+from telegram.ext import Application, ApplicationHandlerStop, BaseHandler, CallbackContext, ConversationHandler
+from metrics.registry import registry
+
+handler_seconds = registry.histogram('driserbot_handler_duration_seconds', 'Time spent in update handlers',
+                                     ['handler'])
+handler_errors = registry.counter('driserbot_handler_errors_total', 'Exceptions raised by update handlers',
+                                  ['handler'])
+job_seconds = registry.histogram('driserbot_job_duration_seconds', 'Time spent in job callbacks', ['job'])
+job_errors = registry.counter('driserbot_job_errors_total', 'Exceptions raised by job callbacks', ['job'])
+job_lag = registry.histogram('driserbot_job_lag_seconds', 'Delay between the scheduled and the actual start of jobs',
+                             ['job'], buckets=(.001, .01, .1, .5, 1., 5., 10., 30., 60., 300.))
+outbound_sent = registry.counter('driserbot_outbound_sent_total', 'Requests sent through the outbound queue',
+                                 ['method'])
+outbound_failed = registry.counter('driserbot_outbound_failed_total',
+                                   'Requests of the outbound queue that failed for good', ['method'])
+outbound_retried = registry.counter('driserbot_outbound_retried_total', 'Retries of outbound requests',
+                                    ['reason'])
+outbound_pending = registry.gauge('driserbot_outbound_pending', 'Requests waiting in the outbound queue')
+persistence_flush_seconds = registry.histogram('driserbot_persistence_flush_duration_seconds',
+                                               'Duration of persistence flushes')
+render_seconds = registry.histogram('driserbot_chart_render_duration_seconds', 'Duration of chart renders')
+renders_rejected = registry.counter('driserbot_chart_renders_rejected_total',
+                                    'Chart renders rejected because the renderer was busy')
+users = registry.gauge('driserbot_users', 'Registered users')
+goals = registry.gauge('driserbot_goals', 'Goals of all users')
+dialogs = registry.gauge('driserbot_dialogs', 'Open chat dialogs')
+
+# the lag of submitted jobs by job id, until their callback picks it up
+_job_lags: Dict[str, float] = {}
+# lags of jobs whose callback isn't timed are never picked up
+max_job_lags = 10000
+
+
+def timed_handler(callback: Callable, name: str = None) -> Callable:
+    """Wraps a handler callback to record its duration and errors (labelled with ``name`` or the callback's name)"""
+    if hasattr(callback, 'metrics_name'):
+        return callback
+    name = callback.__name__ if name is None else name
+    duration = handler_seconds.labels(name)
+    errors = handler_errors.labels(name)
+
+    @functools.wraps(callback)
+    async def timed(update, context):
+        start = time.perf_counter()
+        try:
+            return await callback(update, context)
+        except ApplicationHandlerStop:
+            raise
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            duration.observe(time.perf_counter() - start)
+    timed.metrics_name = name
+    return timed
+
+
+def timed_job(callback: Callable) -> Callable:
+    """Decorates a job callback to record its duration, errors and lag (see :func:`instrument_application`)"""
+    name = callback.__name__
+    duration = job_seconds.labels(name)
+    errors = job_errors.labels(name)
+    lag = job_lag.labels(name)
+
+    @functools.wraps(callback)
+    async def timed(context: CallbackContext):
+        submission_lag = _job_lags.pop(context.job.id, None) if context.job is not None else None
+        if submission_lag is not None:
+            lag.observe(submission_lag)
+        start = time.perf_counter()
+        try:
+            return await callback(context)
+        except Exception:
+            errors.inc()
+            raise
+        finally:
+            duration.observe(time.perf_counter() - start)
+    timed.metrics_name = name
+    return timed
+
+
+def instrument_handler(handler: BaseHandler):
+    if isinstance(handler, ConversationHandler):
+        for child in handler.entry_points + [h for state in handler.states.values() for h in state] \
+                + handler.fallbacks:
+            instrument_handler(child)
+    elif hasattr(handler, 'callback'):
+        handler.callback = timed_handler(handler.callback)
+
+
+def _record_job_lag(event: JobSubmissionEvent):
+    # called by the scheduler right before the job's callback is started
+    if len(_job_lags) >= max_job_lags:
+        _job_lags.clear()
+    _job_lags[event.job_id] = (datetime.now(timezone.utc) - max(event.scheduled_run_times)).total_seconds()
+
+
+def instrument_application(application: Application, state: bool = True):
+    """Records the durations and errors of all registered handlers and the lag of the jobs
+
+    The handlers (including the states of conversations) have to be added before. With ``state``, the gauges of
+    users, goals and dialogs report the state of the application.
+    """
+    for handlers in application.handlers.values():
+        for handler in handlers:
+            instrument_handler(handler)
+    if application.job_queue is not None:
+        application.job_queue.scheduler.add_listener(_record_job_lag, EVENT_JOB_SUBMITTED)
+    if state:
+        users.set_function(lambda: len(application.bot_data.get('users', ())))
+        goals.set_function(lambda: sum(len(user.goals) for user in application.bot_data.get('users', ())))
+        dialogs.set_function(lambda: sum(len(data.get('dialogs', ()))
+                                         for data in list(application.chat_data.values())))
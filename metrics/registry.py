@@ -0,0 +1,192 @@
+import math
+from bisect import bisect_left
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+# seconds, from a fast handler up to a slow render
+default_buckets = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5, 1., 2.5, 5., 10., 30.)
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def escape_label_value(value: str) -> str:
+    return value.replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+class Metric:
+    """A metric with optional labels, rendered in the Prometheus text format
+
+    Observations are recorded on the child of a label combination (see :meth:`labels`), which can be kept to avoid the
+    lookup on every observation. Metrics without labels are observed directly.
+    """
+    type = 'untyped'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        if len(self.label_names) == 0:
+            self._children[()] = self._child()
+
+    def labels(self, *values) -> object:
+        key = tuple(str(value) for value in values)
+        if len(key) != len(self.label_names):
+            raise ValueError(f'{self.name} has the labels {self.label_names}, got {key}')
+        child = self._children.get(key)
+        if child is None:
+            child = self._children.setdefault(key, self._child())
+        return child
+
+    def _child(self):
+        raise NotImplementedError()
+
+    def _label_string(self, key: Tuple[str, ...], extra: str = '') -> str:
+        pairs = [f'{name}="{escape_label_value(value)}"' for name, value in zip(self.label_names, key)]
+        if extra:
+            pairs.append(extra)
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+    def samples(self) -> Iterator[str]:
+        raise NotImplementedError()
+
+    def render(self) -> str:
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        lines.extend(self.samples())
+        return '\n'.join(lines)
+
+
+class CounterValue:
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount: float = 1):
+        self.value += amount
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def _child(self) -> CounterValue:
+        return CounterValue()
+
+    def inc(self, amount: float = 1):
+        self._children[()].inc(amount)
+
+    def samples(self) -> Iterator[str]:
+        for key, child in list(self._children.items()):
+            yield f'{self.name}{self._label_string(key)} {format_value(child.value)}'
+
+
+class GaugeValue:
+    __slots__ = ('value', 'function')
+
+    def __init__(self):
+        self.value = 0
+        self.function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        self.value = value
+
+    def set_function(self, function: Callable[[], float]):
+        """Makes the gauge report the result of ``function``, which is called whenever the metrics are collected"""
+        self.function = function
+
+    def get(self) -> float:
+        return self.value if self.function is None else self.function()
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def _child(self) -> GaugeValue:
+        return GaugeValue()
+
+    def set(self, value: float):
+        self._children[()].set(value)
+
+    def set_function(self, function: Callable[[], float]):
+        self._children[()].set_function(function)
+
+    def samples(self) -> Iterator[str]:
+        for key, child in list(self._children.items()):
+            try:
+                value = child.get()
+            except Exception as e:
+                print(f'metrics: could not collect {self.name}: {e!r}')
+                continue
+            yield f'{self.name}{self._label_string(key)} {format_value(value)}'
+
+
+class HistogramValue:
+    __slots__ = ('bounds', 'counts', 'sum')
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        # per bucket (the last one is +Inf), they are only made cumulative when collected
+        self.counts: List[int] = [0] * (len(bounds) + 1)
+        self.sum = 0.
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.bounds, value)] += 1
+        self.sum += value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                 buckets: Sequence[float] = default_buckets):
+        self.buckets = tuple(sorted(buckets))
+        super().__init__(name, documentation, label_names)
+
+    def _child(self) -> HistogramValue:
+        return HistogramValue(self.buckets)
+
+    def observe(self, value: float):
+        self._children[()].observe(value)
+
+    def samples(self) -> Iterator[str]:
+        for key, child in list(self._children.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), list(child.counts)):
+                cumulative += count
+                le = f'le="{format_value(bound)}"'
+                yield f'{self.name}_bucket{self._label_string(key, le)} {cumulative}'
+            yield f'{self.name}_sum{self._label_string(key)} {format_value(child.sum)}'
+            yield f'{self.name}_count{self._label_string(key)} {cumulative}'
+
+
+class Registry:
+    """The metrics of the process, by name"""
+
+    def __init__(self):
+        self.metrics: Dict[str, Metric] = {}
+
+    def register(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError(f'A metric named {metric.name} is already registered')
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Counter:
+        return self.register(Counter(name, documentation, label_names))
+
+    def gauge(self, name: str, documentation: str, label_names: Sequence[str] = ()) -> Gauge:
+        return self.register(Gauge(name, documentation, label_names))
+
+    def histogram(self, name: str, documentation: str, label_names: Sequence[str] = (),
+                  buckets: Sequence[float] = default_buckets) -> Histogram:
+        return self.register(Histogram(name, documentation, label_names, buckets))
+
+    def render(self) -> str:
+        """All metrics in the Prometheus text exposition format"""
+        return ''.join(metric.render() + '\n' for metric in list(self.metrics.values()))
+
+
+registry = Registry()
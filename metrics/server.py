@@ -0,0 +1,73 @@
+import asyncio
+import os
+from typing import Optional, Set
+
+from metrics.registry import Registry, registry
+
+# the metrics endpoint is only served if a port is configured
+METRICS_PORT = int(os.environ['METRICS_PORT']) if 'METRICS_PORT' in os.environ else None
+METRICS_LISTEN = os.environ['METRICS_LISTEN'] if 'METRICS_LISTEN' in os.environ else '127.0.0.1'
+content_type = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class MetricsServer:
+    """Serves the metrics of the registry in the Prometheus text format on ``GET /metrics``"""
+
+    def __init__(self, metrics: Registry = registry, listen: str = METRICS_LISTEN, port: int = METRICS_PORT):
+        self.registry = metrics
+        self.listen = listen
+        self.port = port
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set[asyncio.StreamWriter] = set()
+
+    async def start(self):
+        self._server = await asyncio.start_server(self._serve_connection, self.listen, self.port)
+        self.port = self._server.sockets[0].getsockname()[1]
+        print(f'metrics: listening on {self.listen}:{self.port}/metrics')
+
+    async def stop(self):
+        self._server.close()
+        for writer in list(self._connections):
+            writer.close()
+        await self._server.wait_closed()
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections.add(writer)
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 10)
+            method, target, _ = request_line.decode('latin-1').split()
+            while await asyncio.wait_for(reader.readline(), 10) not in (b'\r\n', b'\n', b''):
+                pass
+            if target.split('?')[0] != '/metrics':
+                status, body = '404 Not Found', b''
+            elif method != 'GET':
+                status, body = '405 Method Not Allowed', b''
+            else:
+                status, body = '200 OK', self.registry.render().encode()
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\nContent-Length: {len(body)}\r\n'
+                         f'Connection: close\r\n\r\n'.encode('latin-1') + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError, ValueError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+
+_server: Optional[MetricsServer] = None
+
+
+async def start_metrics_server(port: Optional[int] = METRICS_PORT) -> Optional[MetricsServer]:
+    """Starts serving the metrics if a port is configured"""
+    global _server
+    if _server is None and port is not None:
+        _server = MetricsServer(port=port)
+        await _server.start()
+    return _server
+
+
+async def stop_metrics_server():
+    global _server
+    if _server is not None:
+        await _server.stop()
+        _server = None
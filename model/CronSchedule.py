@@ -0,0 +1,99 @@
+import re
+from datetime import datetime
+from threading import Lock
+from typing import Dict, Optional, Tuple
+from apscheduler.triggers.cron import CronTrigger
+from croniter import croniter
+import cron_descriptor
+
+cron_descriptor_options = cron_descriptor.Options()
+cron_descriptor_options.use_24hour_time_format = True
+# cron_descriptor_options.verbose = True #TODO: Reenable once 'every day' duplication is fixed
+
+interval_patterns = [
+    ('minutes', re.compile(r'\*(/0*1)? \* \* \* \*')),
+    ('hours', re.compile(r'(\*|\d+)(/0*1)? \*(/0*1)? \* \* \*')),
+    ('days', re.compile(r'(\*|\d+)(/0*1)? (\*|\d+)(/0*1)? \*(/0*1)? \* \*')),
+    ('months', re.compile(r'(\*|\d+)(/0*1)? (\*|\d+)(/0*1)? (\*|\d+)(/0*1)? \*(/0*1)? \*')),
+    ('weeks', re.compile(r'(\*|\d+)(/0*1)? (\*|\d+)(/0*1)? (\*|\d+)(/0*1)? \* [a-zA-Z]+'))
+]
+
+
+class CronSchedule:
+    """A parsed cron expression. Instances are interned, use :meth:`of` to get the schedule for an expression."""
+
+    __slots__ = ('expression', 'trigger', '_description', '_interval', '_period')
+
+    _instances: Dict[str, 'CronSchedule'] = {}
+    _lock = Lock()
+
+    def __init__(self, expression: str):
+        self.expression = expression
+        self.trigger = CronTrigger.from_crontab(expression)
+        self._description: Optional[str] = None
+        self._interval: Optional[str] = None
+        self._period: Optional[Tuple[datetime, datetime, datetime, str]] = None
+
+    @classmethod
+    def of(cls, expression: str) -> 'CronSchedule':
+        """Returns the schedule for the given expression, raises a ValueError if it is invalid"""
+        schedule = cls._instances.get(expression)
+        if schedule is None:
+            with cls._lock:
+                schedule = cls._instances.get(expression)
+                if schedule is None:
+                    schedule = cls(expression)
+                    cls._instances[schedule.expression] = schedule
+        return schedule
+
+    @property
+    def description(self) -> str:
+        if self._description is None:
+            self._description = str(cron_descriptor.ExpressionDescriptor(self.expression, cron_descriptor_options))
+        return self._description
+
+    @property
+    def interval(self) -> str:
+        """The unit of the schedule's interval as used in the stats ('minutes', 'hours', ...)"""
+        if self._interval is None:
+            self._interval = next((label for label, pattern in interval_patterns
+                                   if pattern.fullmatch(self.expression) is not None), 'intervals')
+        return self._interval
+
+    def period(self, now: datetime) -> Tuple[datetime, str]:
+        """Returns the end of the last complete period before ``now`` and a description of the period's length
+
+        The result is reused until the schedule fires the next time.
+        """
+        cached = self._period
+        if cached is not None and cached[0] < now < cached[1]:
+            return cached[0], cached[3]
+
+        schedule = croniter(self.expression, now)
+        time_end: datetime = schedule.get_prev(ret_type=datetime)
+        time_start: datetime = schedule.get_prev(ret_type=datetime)
+        time_next: datetime = croniter(self.expression, time_end).get_next(ret_type=datetime)
+        time_period = (time_end - time_start)
+
+        if time_period.total_seconds() / 60 < 120:
+            time_string = f'{int(time_period.total_seconds() / 60)} minutes'
+        elif time_period.seconds / 3600 < 24:
+            time_string = f'{int(time_period.total_seconds() / 3600)} hours'
+        else:
+            time_string = f'{time_period.days} days'
+            if time_period.seconds >= 3600:
+                time_string += f', {int(time_period.seconds / 3600)} hours'
+        self._period = (time_end, time_next, time_start, time_string)
+        return time_end, time_string
+
+    def __eq__(self, other):
+        return isinstance(other, CronSchedule) and other.expression == self.expression
+
+    def __hash__(self):
+        return hash(self.expression)
+
+    def __reduce__(self):
+        return CronSchedule.of, (self.expression,)
+
+    def __repr__(self):
+        return f"CronSchedule('{self.expression}')"
@@ -0,0 +1,100 @@
+import os
+import time
+from collections.abc import MutableMapping
+from threading import Lock
+from typing import Dict, Iterator, List, Optional, Tuple
+
+DIALOG_TTL = float(os.environ['DIALOG_TTL']) if 'DIALOG_TTL' in os.environ else 7 * 24 * 3600.
+DIALOG_MAX_PER_CHAT = int(os.environ['DIALOG_MAX_PER_CHAT']) if 'DIALOG_MAX_PER_CHAT' in os.environ else 200
+
+
+class DialogStore(MutableMapping):
+    """The open dialogs (inline keyboards waiting for an answer) of a chat, indexed by dialog id.
+
+    Every dialog expires ``ttl`` seconds after it has been added (the expiry is kept in the dialog as ``'expires'``);
+    expired dialogs are treated as missing and removed by :meth:`pop_expired`. If a chat has more than
+    ``max_dialogs`` dialogs, the oldest ones are dropped. Dialogs may store the ``'message_id'`` of their message,
+    so the keyboards of dropped dialogs can be closed.
+    """
+
+    __slots__ = ('_dialogs', '_evicted', '_lock', 'ttl', 'max_dialogs')
+
+    def __init__(self, dialogs: Optional[Dict[str, Dict]] = None, ttl: float = DIALOG_TTL,
+                 max_dialogs: int = DIALOG_MAX_PER_CHAT):
+        self._dialogs: Dict[str, Dict] = {}
+        self._evicted: List[Tuple[str, Dict]] = []
+        self._lock = Lock()
+        self.ttl = ttl
+        self.max_dialogs = max_dialogs
+        for dialog_id, dialog in (dialogs or {}).items():
+            self[dialog_id] = dialog
+
+    @staticmethod
+    def of(chat_data: Dict) -> 'DialogStore':
+        """Returns the dialog store of the given chat data, creating it (or converting a plain dict) if needed"""
+        dialogs = chat_data.get('dialogs')
+        if not isinstance(dialogs, DialogStore):
+            dialogs = chat_data['dialogs'] = DialogStore(dialogs)
+        return dialogs
+
+    def __setitem__(self, dialog_id: str, dialog: Dict):
+        if 'expires' not in dialog:
+            dialog['expires'] = time.time() + self.ttl
+        with self._lock:
+            self._dialogs.pop(dialog_id, None)
+            self._dialogs[dialog_id] = dialog
+            while len(self._dialogs) > self.max_dialogs:
+                oldest = next(iter(self._dialogs))
+                self._evicted.append((oldest, self._dialogs.pop(oldest)))
+
+    def __getitem__(self, dialog_id: str) -> Dict:
+        dialog = self._dialogs[dialog_id]
+        if dialog['expires'] <= time.time():
+            raise KeyError(dialog_id)
+        return dialog
+
+    def __delitem__(self, dialog_id: str):
+        with self._lock:
+            del self._dialogs[dialog_id]
+
+    def __contains__(self, dialog_id) -> bool:
+        dialog = self._dialogs.get(dialog_id)
+        return dialog is not None and dialog['expires'] > time.time()
+
+    def __iter__(self) -> Iterator[str]:
+        """Iterates all stored dialog ids, including those that have expired but have not been removed yet"""
+        with self._lock:
+            return iter(list(self._dialogs))
+
+    def __len__(self) -> int:
+        return len(self._dialogs)
+
+    def items(self) -> List[Tuple[str, Dict]]:
+        with self._lock:
+            return list(self._dialogs.items())
+
+    def set_message(self, dialog_id: str, message_id: int):
+        if dialog_id in self._dialogs:
+            self._dialogs[dialog_id]['message_id'] = message_id
+
+    def pop_expired(self, now: Optional[float] = None) -> List[Tuple[str, Dict]]:
+        """Removes and returns all expired dialogs and the dialogs that have been dropped because of the limit"""
+        now = time.time() if now is None else now
+        with self._lock:
+            expired, self._evicted = self._evicted, []
+            for dialog_id in [dialog_id for dialog_id, dialog in self._dialogs.items() if dialog['expires'] <= now]:
+                expired.append((dialog_id, self._dialogs.pop(dialog_id)))
+        return expired
+
+    def __getstate__(self):
+        return {'dialogs': self._dialogs}
+
+    def __setstate__(self, state):
+        self._dialogs = state['dialogs']
+        self._evicted = []
+        self._lock = Lock()
+        self.ttl = DIALOG_TTL
+        self.max_dialogs = DIALOG_MAX_PER_CHAT
+
+    def __repr__(self):
+        return f"DialogStore({self._dialogs!r})"
@@ -1,57 +1,297 @@
+from array import array
+from bisect import bisect_left, bisect_right
 from datetime import datetime
-from typing import List, Dict, Union
+from itertools import accumulate, chain, repeat
+from operator import sub, truediv
+from typing import List, Dict, Optional, Union, Iterable, Mapping, Tuple
 from common.constants import goal_score_types
-import cron_descriptor
+from model.GoalData import GoalDataView
+from model.GoalRollups import GoalRollups, floating_averages, period_bounds, period_of
+from model.CronSchedule import CronSchedule
+import secrets
+import sys
 
-cron_descriptor_options = cron_descriptor.Options()
-cron_descriptor_options.use_24hour_time_format = True
-# cron_descriptor_options.verbose = True #TODO: Reenable once 'every day' duplication is fixed
+
+def rolling_scores(values: bytearray, window_range: int) -> Tuple[int, int]:
+    """The sum of the values within the window and the number of trailing non-zero values"""
+    window_sum = int(sum(values[-window_range:], 0))
+    streak = 0
+    for value in reversed(values):
+        if value == 0:
+            break
+        streak += 1
+    return window_sum, streak
+
+
+def new_goal_key() -> str:
+    """A random key, which tells the goal apart from the other (and the former) goals of its user in callback data"""
+    return secrets.token_hex(6)
 
 
 class Goal:
+    # the version of the state returned by __getstate__, older states are upgraded by persistence.migrations
+    state_version = 5
+    __slots__ = ('title', 'key', '_cron', '_schedule', 'score_type', 'score_range', 'chat_id', 'waiting_for_data',
+                 '_times', '_values', '_lead', '_lead_streak', '_pinned', '_rollups', '_window_sum', '_streak',
+                 '_prefix', '_runs')
 
     def __init__(self, title: str = None, cron: str = None, score_type: str = None, score_range: int = -1,
                  chat_id: int = -1, data: List[Dict] = {}):
         self.title: str = title
+        self.key: str = new_goal_key()
         self.cron: str = cron
         self.score_type: str = score_type
         self.score_range: int = score_range
-        self.data: List[Dict] = list(data)
         self.chat_id: int = chat_id
         self.waiting_for_data = False
+        self._set_data(data)
+
+    @property
+    def cron(self) -> str:
+        return self._cron
+
+    @cron.setter
+    def cron(self, cron: str):
+        self._cron = None if cron is None else sys.intern(cron)
+        self._schedule = None
+
+    @property
+    def schedule(self) -> CronSchedule:
+        # parsed on first use, so goals with an invalid expression can still be loaded
+        if self._schedule is None:
+            self._schedule = CronSchedule.of(self._cron)
+        return self._schedule
+
+    @property
+    def data(self) -> GoalDataView:
+        return GoalDataView(self)
+
+    @property
+    def times(self) -> array:
+        return self._times
+
+    @property
+    def values(self) -> bytearray:
+        return self._values
+
+    @property
+    def lead(self) -> bytearray:
+        """The last values that have been dropped from the history, as far as the scores of the data points in the
+        history depend on them"""
+        return self._lead
+
+    @property
+    def lead_streak(self) -> int:
+        """The streak at the last value dropped from the history"""
+        return self._lead_streak
+
+    @property
+    def pinned(self) -> Optional[Dict[float, Tuple[int, float, int]]]:
+        """The scores (by time) of data points that differ from the scores derived from the values
+
+        These have been recorded by former versions of the bot and are kept until they are dropped from the history.
+        """
+        return self._pinned
+
+    @property
+    def rollups(self) -> Optional[GoalRollups]:
+        """The data points dropped from the history, counted per day, week and month"""
+        return self._rollups
+
+    def _index(self) -> Tuple[array, array]:
+        """Prefix sums over the lead and the values and the streak at every data point, built on first use"""
+        if self._prefix is None:
+            self._prefix = array('i', accumulate(self._lead + self._values, initial=0))
+            runs = array('i')
+            streak = self._lead_streak
+            for value in self._values:
+                streak = streak + 1 if value else 0
+                runs.append(streak)
+            self._runs = runs
+        return self._prefix, self._runs
+
+    def score_at(self, index: int, score_type: str) -> Union[int, float]:
+        """The score of the data point at ``index`` (negative indices count from the end) in constant time"""
+        kind = goal_score_types.index(score_type)
+        if index < 0:
+            index += len(self._times)
+        if not 0 <= index < len(self._times):
+            raise IndexError('data point index out of range')
+        if self._pinned is not None and self._times[index] in self._pinned:
+            return self._pinned[self._times[index]][kind]
+        prefix, runs = self._index()
+        if kind == 0:
+            return runs[index]
+        end = len(self._lead) + index + 1
+        amount = prefix[end] - prefix[max(0, end - self.window_range)]
+        return amount if kind == 2 else amount / min(self.window_range, end)
+
+    def scores(self, score_type: str) -> array:
+        """The scores of all data points"""
+        kind = goal_score_types.index(score_type)
+        prefix, runs = self._index()
+        count = len(self._times)
+        if kind == 0:
+            scores = array('i', runs)
+        else:
+            lead, window_range = len(self._lead), self.window_range
+            # the windows of the first data points start before the first value
+            clipped = max(0, min(count, window_range - lead - 1))
+            starts = prefix[:1] * clipped
+            if clipped < count:
+                starts += prefix[lead + clipped + 1 - window_range:lead + count + 1 - window_range]
+            scores = array('i', map(sub, prefix[lead + 1:], starts))
+            if kind == 1:
+                scores = array('d', map(truediv, scores, chain(range(lead + 1, window_range), repeat(window_range))))
+        if self._pinned is not None:
+            for timestamp, pinned in self._pinned.items():
+                position = bisect_left(self._times, timestamp)
+                if position < count and self._times[position] == timestamp:
+                    scores[position] = pinned[kind]
+        return scores
+
+    def chart_series(self, since: float, resolution: Optional[str] = None) -> Tuple[array, array]:
+        """The times and floating averages to chart
+
+        Without a resolution, these are all data points, preceded by the periods of the rollups from ``since`` on.
+        Otherwise the data points are counted per day, week or month as well and only the periods are charted.
+
+        Charts of goals whose history covers the charted range are the same as before the rollups were kept. Goals
+        answered more often than daily (or checked after a break) have fewer days in their history, the days of the
+        range before it are charted from the rollups (which were discarded before).
+        """
+        periods = {} if self._rollups is None else self._rollups.periods(resolution)
+        if resolution is not None:
+            for timestamp, value in zip(self._times, self._values):
+                counts = periods.setdefault((resolution, period_of(timestamp, resolution)), [0, 0])
+                counts[0] += 1
+                counts[1] += int(value > 0)
+        # periods are charted at their middle, but never after the data points
+        limit = float('inf') if len(self._times) == 0 else self._times[0] if resolution is None else self._times[-1]
+        charted = sorted((min(sum(period_bounds(period, tier)) / 2, limit), counts)
+                         for (tier, period), counts in periods.items())
+        times, scores = array('d'), array('d')
+        for (timestamp, _), average in zip(charted, floating_averages([counts[0] for _, counts in charted],
+                                                                       [counts[1] for _, counts in charted],
+                                                                       self.window_range)):
+            if timestamp >= since:
+                times.append(timestamp)
+                scores.append(average)
+        if resolution is None:
+            times.extend(self._times)
+            scores.extend(self.scores(goal_score_types[1]))
+        return times, scores
+
+    def _set_data(self, data: Iterable[Mapping]):
+        self._times = array('d')
+        self._values = bytearray()
+        self._lead = bytearray()
+        self._lead_streak = 0
+        self._pinned = None
+        self._rollups = None
+        self._prefix = self._runs = None
+        for d in data:
+            self._times.append(d['time'])
+            self._values.append(d['value'])
+        self.reset_rolling_scores()
+
+    @property
+    def window_range(self) -> int:
+        return 100 if self.score_range == -1 else self.score_range
 
     def add_data(self, value: int, time_end: datetime):
-        data_point = {'value': value, 'time': time_end.timestamp(), 'score': -1}
-        self.data.append(data_point)
-        self.data[-1]['score'] = self.calculate_score()
-        score_range = max(100, self.score_range)
-        start = max(len(self.data) - score_range, 0)
-        self.data = sorted(self.data, key=lambda d: d['time'])[start:]
+        timestamp = time_end.timestamp()
+        if self.is_before_history(timestamp):
+            # the values dropped from the history are not kept in time order with an answer older than all of them
+            return
+        count = len(self._times)
+        window_range = self.window_range
+        # the value that leaves the window, which may have been dropped from the history already
+        position = count - window_range
+        leaving = self._values[position] if position >= 0 else \
+            self._lead[position] if -position <= len(self._lead) else 0
+
+        amount = self._window_sum + value - leaving
+        streak = self._streak + 1 if value else 0
+        if count == 0 or timestamp >= self._times[-1]:
+            position = count
+            self._window_sum = amount
+            self._streak = streak
+            if self._prefix is not None:
+                self._prefix.append(self._prefix[-1] + value)
+                self._runs.append(streak)
+        else:
+            position = bisect_right(self._times, timestamp)
+            if position > count - window_range:
+                self._window_sum = amount
+            if position >= count - self._streak:
+                self._streak = self._streak + 1 if value else count - position
+            # the scores of the following data points change as well
+            self._prefix = self._runs = None
+        self._times.insert(position, timestamp)
+        self._values.insert(position, value)
+
+        history_range = max(100, self.score_range)
+        if len(self._times) > history_range:
+            self._drop_history(len(self._times) - history_range)
+
+    def _drop_history(self, count: int):
+        dropped = self._values[:count]
+        if self._rollups is None:
+            self._rollups = GoalRollups()
+        for timestamp, value in zip(self._times[:count], dropped):
+            self._rollups.add(timestamp, value)
+            self._lead_streak = self._lead_streak + 1 if value else 0
+        self._lead += dropped
+        # the scores of the remaining data points only depend on the last window_range - 1 dropped values
+        expired = max(0, len(self._lead) - self.window_range + 1)
+        del self._lead[:expired]
+        del self._times[:count]
+        del self._values[:count]
+        if self._prefix is not None:
+            del self._prefix[:expired]
+            del self._runs[:count]
+        if self._pinned is not None:
+            self._pinned = {timestamp: scores for timestamp, scores in self._pinned.items()
+                            if len(self._times) > 0 and timestamp >= self._times[0]} or None
+
+    def is_before_history(self, timestamp: float) -> bool:
+        """Whether an answer at the timestamp is older than the history, which has been trimmed already (and would
+        therefore be dropped at once), so it is not recorded"""
+        trimmed = len(self._times) >= max(100, self.score_range) or len(self._lead) > 0 or self._rollups is not None
+        return trimmed and len(self._times) > 0 and timestamp < self._times[0]
+
+    def has_data_at(self, timestamp: float) -> bool:
+        position = bisect_left(self._times, timestamp)
+        return position < len(self._times) and self._times[position] == timestamp
+
+    def reset_rolling_scores(self):
+        self._window_sum, self._streak = rolling_scores(self._values, self.window_range)
+        if self._streak == len(self._values):
+            # the streak started before the history
+            self._streak += self._lead_streak
 
     def calculate_score_days(self) -> int:
-        score = 0
-        end = len(self.data) if self.score_range == -1 else self.score_range
-        for item in reversed(self.data[:end]):
-            if item['value'] == 0:
-                return score
-            score += 1
-        return score
+        return self._streak
 
     def calculate_score_floating_average(self, score_range: int = -1) -> float:
+        if len(self._values) == 0:
+            return 0.
         if score_range == -1:
-            score_range = 100. if self.score_range == -1 else self.score_range
-        score_range = min(score_range, len(self.data))
+            return self._window_sum / min(self.window_range, len(self._values))
+        score_range = min(score_range, len(self._values))
         return self.calculate_score_floating_amount(score_range=score_range) / score_range
 
     def calculate_score_floating_amount(self, score_range: int = -1, offset=0) -> int:
+        if score_range == -1 and offset == 0:
+            return self._window_sum
         if score_range == -1:
-            score_range = 100 if self.score_range == -1 else self.score_range
-        score_range = min(score_range, len(self.data))
+            score_range = self.window_range
+        score_range = min(score_range, len(self._values))
         if offset > score_range:
             return 0
-        data_slice = self.data[-score_range:] if offset == 0 else self.data[-score_range:-offset]
-        result = int(sum((d['value'] for d in data_slice), 0))
-        return result
+        prefix, _ = self._index()
+        return prefix[len(prefix) - 1 - offset] - prefix[len(prefix) - 1 - score_range]
 
     def calculate_score(self) -> Dict[str, Union[int, float]]:
         scores = {
@@ -65,42 +305,53 @@ class Goal:
     def __getstate__(self):
         return {
             'title': self.title,
+            'key': self.key,
             'cron': self.cron,
             'score_type': self.score_type,
             'score_range': self.score_range,
-            'data': self.data,
-            'waiting_for_data': self.waiting_for_data
+            'chat_id': self.chat_id,
+            'times': self._times,
+            'values': self._values,
+            'lead': self._lead,
+            'lead_streak': self._lead_streak,
+            'pinned': self._pinned,
+            'rollups': self._rollups,
+            'window_sum': self._window_sum,
+            'streak': self._streak,
+            'waiting_for_data': self.waiting_for_data,
+            'version': self.state_version
         }
 
     def __setstate__(self, state):
         self.title = state['title']
+        self.key = state['key']
         self.cron = state['cron']
         self.score_type = state['score_type']
         self.score_range = state['score_range']
-        if len(state['data']) > 0 and not isinstance(state['data'][0]['score'], dict):
-            self.data = list(map(lambda d: {'value': d['value'], 'time': d['time'], 'score': {
-                goal_score_types[0]: d['score'] if goal_score_types[0] == self.score_type else 0,
-                goal_score_types[1]: d['score'] if goal_score_types[1] == self.score_type else 0.,
-                goal_score_types[2]: d['score'] if goal_score_types[2] == self.score_type else 0
-            }}, state['data']))
-        else:
-            self.data = state['data']
-
-        score_range = 100. if self.score_range == -1 else self.score_range
-        score_range = min(score_range, len(self.data))
-        for i in range(len(self.data)):
-            if self.data[i]['score'][goal_score_types[2]] != 0 and self.data[i]['score'][goal_score_types[1]] == 0.:
-                self.data[i]['score'][goal_score_types[1]] = self.data[i]['score'][goal_score_types[2]] / float(score_range)
+        self.chat_id = state['chat_id']
         self.waiting_for_data = state['waiting_for_data']
+        self._times = state['times']
+        self._values = state['values']
+        self._lead = state['lead']
+        self._lead_streak = state['lead_streak']
+        self._pinned = state['pinned']
+        self._rollups = state['rollups']
+        self._window_sum = state['window_sum']
+        self._streak = state['streak']
+        self._prefix = self._runs = None
 
     def __str__(self):
         summary = f"Title: {self.title}\n" \
-                  f"Schedule: {cron_descriptor.ExpressionDescriptor(self.cron, cron_descriptor_options)}\n" \
+                  f"Schedule: {self.schedule.description}\n" \
                   f"Score: {self.score_type.replace('x/10', f'x/{self.score_range}')}"
         if self.score_range != -1:
             summary += f"\nScore Range: {self.score_range}"
         return summary
 
     def __repr__(self):
+        # formatted like the data points, with the scores derived at once
+        data = ', '.join(repr({'value': value, 'time': timestamp, 'score': dict(zip(goal_score_types, scores))})
+                         for timestamp, value, *scores in zip(self._times, self._values,
+                                                              *map(self.scores, goal_score_types)))
         return f"Goal(title='{self.title}', cron='{self.cron}', score_type='{self.score_type}', " \
-               f"score_range={self.score_range})\n  data:\n  [{', '.join(str(i) for i in self.data)}])"
+               f"score_range={self.score_range})\n  data:\n  [{data}])"
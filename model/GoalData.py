@@ -0,0 +1,57 @@
+from collections.abc import Mapping, Sequence
+from types import MappingProxyType
+from typing import Union
+from common.constants import goal_score_types
+
+
+class DataPoint(Mapping):
+    """Read-only, dict-like view on a single data point of a goal"""
+
+    __slots__ = ('_goal', '_index')
+
+    def __init__(self, goal, index: int):
+        self._goal = goal
+        self._index = index
+
+    def __getitem__(self, key: str):
+        if key == 'value':
+            return self._goal._values[self._index]
+        if key == 'time':
+            return self._goal._times[self._index]
+        if key == 'score':
+            return MappingProxyType({score_type: self._goal.score_at(self._index, score_type)
+                                     for score_type in goal_score_types})
+        raise KeyError(key)
+
+    def __iter__(self):
+        return iter(('value', 'time', 'score'))
+
+    def __len__(self):
+        return 3
+
+    def __repr__(self):
+        return repr({'value': self['value'], 'time': self['time'], 'score': dict(self['score'])})
+
+
+class GoalDataView(Sequence):
+    """Read-only sequence of the data points of a goal, sorted by time"""
+
+    __slots__ = ('_goal',)
+
+    def __init__(self, goal):
+        self._goal = goal
+
+    def __getitem__(self, index: Union[int, slice]):
+        if isinstance(index, slice):
+            return [DataPoint(self._goal, i) for i in range(*index.indices(len(self)))]
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError('data point index out of range')
+        return DataPoint(self._goal, index)
+
+    def __len__(self):
+        return len(self._goal._times)
+
+    def __repr__(self):
+        return repr(list(self))
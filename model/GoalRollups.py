@@ -0,0 +1,149 @@
+import os
+from array import array
+from bisect import bisect_right
+from datetime import date, datetime
+from itertools import accumulate
+from typing import Dict, Iterator, List, Optional, Tuple
+
+# how long data points dropped from the recent history of a goal are kept per day, per week and per month
+ROLLUP_DAYS = int(os.environ['GOAL_ROLLUP_DAYS']) if 'GOAL_ROLLUP_DAYS' in os.environ else 180
+ROLLUP_WEEKS = int(os.environ['GOAL_ROLLUP_WEEKS']) if 'GOAL_ROLLUP_WEEKS' in os.environ else 104
+ROLLUP_MONTHS = int(os.environ['GOAL_ROLLUP_MONTHS']) if 'GOAL_ROLLUP_MONTHS' in os.environ else 120
+resolutions = ['day', 'week', 'month']
+resolution_days = {'day': 1, 'week': 7, 'month': 30.4}
+
+
+def period_of(timestamp: float, resolution: str) -> int:
+    """The number of the (local) day, week or month of a timestamp"""
+    day = datetime.fromtimestamp(timestamp).toordinal()
+    return day if resolution == 'day' else coarser_period(day, 'day', resolution)
+
+
+def coarser_period(period: int, resolution: str, coarser: str) -> int:
+    if resolution == coarser:
+        return period
+    # weeks start on monday, ordinal 1 is a monday; weeks belong to the month they start in
+    day = period if resolution == 'day' else period * 7 + 1
+    if coarser == 'week':
+        return (day - 1) // 7
+    start = date.fromordinal(day)
+    return start.year * 12 + start.month - 1
+
+
+def period_bounds(period: int, resolution: str) -> Tuple[float, float]:
+    """The timestamps of the start and the end of a period"""
+    if resolution == 'month':
+        year, month = divmod(period, 12)
+        start, end = datetime(year, month + 1, 1), datetime(year + (month + 1) // 12, (month + 1) % 12 + 1, 1)
+    else:
+        days = 1 if resolution == 'day' else 7
+        first_day = period if resolution == 'day' else period * 7 + 1
+        start, end = datetime.fromordinal(first_day), datetime.fromordinal(first_day + days)
+    return start.timestamp(), end.timestamp()
+
+
+class Rollup:
+    """Numbers of answers and successes of consecutive periods, the oldest first"""
+    __slots__ = ('first', 'answers', 'successes')
+
+    def __init__(self):
+        self.first = 0
+        self.answers = array('H')
+        self.successes = array('H')
+
+    def add(self, period: int, answers: int, successes: int):
+        if len(self.answers) == 0:
+            self.first = period
+        if period < self.first:
+            padding = array('H', bytes(2 * (self.first - period)))
+            self.answers[:0] = padding
+            self.successes[:0] = padding
+            self.first = period
+        elif period >= self.first + len(self.answers):
+            padding = array('H', bytes(2 * (period - self.first - len(self.answers) + 1)))
+            self.answers.extend(padding)
+            self.successes.extend(padding)
+        index = period - self.first
+        # the counts saturate, a period can't have more answers than a goal check per minute yields anyway
+        self.answers[index] = min(self.answers[index] + answers, 0xFFFF)
+        self.successes[index] = min(self.successes[index] + successes, 0xFFFF)
+
+    def drop(self, count: int) -> List[Tuple[int, int, int]]:
+        """Removes the oldest periods and returns those with answers"""
+        dropped = [(self.first + index, answers, successes) for index, (answers, successes)
+                   in enumerate(zip(self.answers[:count], self.successes[:count])) if answers > 0]
+        del self.answers[:count]
+        del self.successes[:count]
+        self.first += count
+        return dropped
+
+    def periods(self) -> Iterator[Tuple[int, int, int]]:
+        for index, (answers, successes) in enumerate(zip(self.answers, self.successes)):
+            if answers > 0:
+                yield self.first + index, answers, successes
+
+    def __len__(self):
+        return len(self.answers)
+
+
+class GoalRollups:
+    """The data points dropped from the recent history of a goal, as numbers of answers and successes per period
+
+    Data points are counted per day at first. Days more than ROLLUP_DAYS before the latest one are merged into their
+    week, older weeks (ROLLUP_WEEKS) into their month and months beyond ROLLUP_MONTHS are forgotten, so the memory
+    used per goal is bounded.
+    """
+    __slots__ = ('days', 'weeks', 'months')
+
+    def __init__(self):
+        self.days = Rollup()
+        self.weeks = Rollup()
+        self.months = Rollup()
+
+    def add(self, timestamp: float, value: int):
+        day = period_of(timestamp, 'day')
+        # data points older than the days kept (answers recorded out of order) are counted in their week or month
+        if len(self.days) == 0 or day >= self.days.first:
+            self.days.add(day, 1, int(value > 0))
+        elif len(self.weeks) == 0 or coarser_period(day, 'day', 'week') >= self.weeks.first:
+            self.weeks.add(coarser_period(day, 'day', 'week'), 1, int(value > 0))
+        else:
+            self.months.add(coarser_period(day, 'day', 'month'), 1, int(value > 0))
+        self._compact()
+
+    def _compact(self):
+        if len(self.days) > ROLLUP_DAYS:
+            for day, answers, successes in self.days.drop(len(self.days) - ROLLUP_DAYS):
+                self.weeks.add(coarser_period(day, 'day', 'week'), answers, successes)
+        if len(self.weeks) > ROLLUP_WEEKS:
+            for week, answers, successes in self.weeks.drop(len(self.weeks) - ROLLUP_WEEKS):
+                self.months.add(coarser_period(week, 'week', 'month'), answers, successes)
+        if len(self.months) > ROLLUP_MONTHS:
+            self.months.drop(len(self.months) - ROLLUP_MONTHS)
+
+    def periods(self, resolution: Optional[str] = None) -> Dict[Tuple[str, int], List[int]]:
+        """The numbers of answers and successes by period, periods finer than ``resolution`` are merged"""
+        merged: Dict[Tuple[str, int], List[int]] = {}
+        for tier, rollup in zip(resolutions, (self.days, self.weeks, self.months)):
+            target = tier if resolution is None or resolutions.index(tier) >= resolutions.index(resolution) \
+                else resolution
+            for period, answers, successes in rollup.periods():
+                counts = merged.setdefault((target, coarser_period(period, tier, target)), [0, 0])
+                counts[0] += answers
+                counts[1] += successes
+        return merged
+
+    def __len__(self):
+        return len(self.days) + len(self.weeks) + len(self.months)
+
+
+def floating_averages(answers: List[int], successes: List[int], window_range: int) -> List[float]:
+    """The success rate of each period together with the periods before it, as far as needed for window_range
+    answers (like the floating average of the data points)"""
+    answer_sums = list(accumulate(answers, initial=0))
+    success_sums = list(accumulate(successes, initial=0))
+    averages = []
+    for end in range(1, len(answer_sums)):
+        start = max(0, bisect_right(answer_sums, answer_sums[end] - window_range) - 1)
+        averages.append((success_sums[end] - success_sums[start]) / (answer_sums[end] - answer_sums[start]))
+    return averages
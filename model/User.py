@@ -1,8 +1,11 @@
 from model import Goal
+from model.Goal import new_goal_key
 from typing import List
 
 
 class User:
+    __slots__ = ('id', 'name', 'goals', 'authorized', 'chat_id', 'jobs', 'goal_polls')
+
     def __init__(self, user_id: int):
         self.id = user_id
         self.name: str = str(user_id)
@@ -13,6 +16,8 @@ class User:
         self.goal_polls = {}
 
     def add_goal(self, goal: Goal):
+        while any(g.key == goal.key for g in self.goals):
+            goal.key = new_goal_key()
         self.goals.append(goal)
 
     def remove_goal(self, goal: Goal):
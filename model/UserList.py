@@ -1,29 +1,101 @@
+from threading import Lock
 from model import User
-from typing import List, Union
+from typing import Callable, Dict, Iterable, Iterator, List, Set, Union
 
 
-class UserList(List[User]):
+class UserList:
+    """Collection of users indexed by user id.
+
+    Iterates in ascending id order like the sorted list it replaces. Pickles created by the former list based
+    implementation are restored through ``append``/``extend``, so existing state files load unchanged.
+    """
+
+    __slots__ = ('_users', '_ordered', '_dirty', '_deferred', '_dirty_lock', '_listeners')
+
+    def __new__(cls, *args, **kwargs):
+        instance = super().__new__(cls)
+        instance._users: Dict[int, User] = {}
+        instance._ordered = True
+        instance._dirty: Set[int] = set()
+        instance._deferred: Set[int] = set()
+        instance._dirty_lock = Lock()
+        instance._listeners: List[Callable[[int], None]] = []
+        return instance
+
+    def __init__(self, users: Iterable[User] = ()):
+        self.extend(users)
 
     def append(self, user: User) -> None:
-        super().append(user)
-        self.sort()
+        if self._ordered and len(self._users) > 0 and user.id not in self._users \
+                and user.id < next(reversed(self._users)):
+            self._ordered = False
+        self._users[user.id] = user
+        self.mark_dirty(user.id)
+
+    def extend(self, users: Iterable[User]) -> None:
+        for user in users:
+            self.append(user)
+
+    def remove(self, user: Union[User, int]) -> None:
+        user_id = user if isinstance(user, int) else user.id
+        del self._users[user_id]
+        self.mark_dirty(user_id)
+
+    def mark_dirty(self, user: Union[User, int], deferred: bool = False) -> None:
+        """Flags a user whose data (including its goals) has changed and needs to be persisted
 
-    def sort(self: List[User], *, key: None = lambda u: u.id, reverse: bool = False) -> None:
-        super().sort(key=key, reverse=reverse)
+        Deferred changes are already durable elsewhere (e.g. in the answer journal) and only need to be written with
+        the next full flush.
+        """
+        user_id = user if isinstance(user, int) else user.id
+        with self._dirty_lock:
+            (self._deferred if deferred else self._dirty).add(user_id)
+        for listener in self._listeners:
+            listener(user_id)
 
-    def __getitem__(self, user_id):
+    def add_listener(self, listener: Callable[[int], None]) -> None:
+        """Registers ``listener(user_id)`` to be called whenever a user is flagged as changed"""
+        self._listeners.append(listener)
+
+    def pop_dirty(self, include_deferred: bool = True) -> Set[int]:
+        with self._dirty_lock:
+            dirty, self._dirty = self._dirty, set()
+            if include_deferred:
+                dirty |= self._deferred
+                self._deferred = set()
+        return dirty
+
+    def restore_dirty(self, user_ids: Iterable[int]) -> None:
+        """Flags users returned by :meth:`pop_dirty` again, e.g. because writing them failed"""
+        with self._dirty_lock:
+            self._dirty.update(user_ids)
+
+    def sort(self) -> None:
+        if not self._ordered:
+            self._users = dict(sorted(self._users.items()))
+            self._ordered = True
+
+    def __getitem__(self, user_id: int) -> User:
         if not isinstance(user_id, int):
             raise ValueError('Invalid user id (must be int)!')
 
-        return next((user for user in self if user.id == user_id))
+        return self._users[user_id]
 
-    def __contains__(self, item: Union[User, int]):
+    def __contains__(self, item: Union[User, int]) -> bool:
         if isinstance(item, int):
-            try:
-                next(u for u in self if u.id == item)
-                return True
-            except StopIteration:
-                return False
+            return item in self._users
+
+        return self._users.get(getattr(item, 'id', None)) is item
+
+    def __iter__(self) -> Iterator[User]:
+        self.sort()
+        return iter(list(self._users.values()))
+
+    def __len__(self) -> int:
+        return len(self._users)
 
-        return super().__contains__(item)
+    def __reduce__(self):
+        return self.__class__, (list(self),)
 
+    def __repr__(self):
+        return f"UserList({list(self)!r})"
@@ -1,3 +1,5 @@
+from .CronSchedule import CronSchedule
 from .Goal import Goal
 from .User import User
-from .UserList import UserList
\ No newline at end of file
+from .UserList import UserList
+from .DialogStore import DialogStore
@@ -0,0 +1,6 @@
+from .sqlite_persistence import SQLitePersistence, BotData, record_answer
+from .journal import AnswerJournal
+from .migrations import migrate, unpickle, SCHEMA_VERSION
+from .import_pickle import import_pickle
+from .export import export_formats, export_rows, export_snapshot, write_export, read_export
+from .import_exports import import_exports
@@ -0,0 +1,146 @@
+import csv
+import io
+import json
+import os
+from array import array
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from common.constants import goal_score_types, max_score_range
+from model import CronSchedule, Goal, User
+
+# the number of characters after which the exported document is handed over to the writer
+EXPORT_CHUNK_SIZE = int(os.environ['EXPORT_CHUNK_SIZE']) if 'EXPORT_CHUNK_SIZE' in os.environ else 65536
+
+export_fields = ('user_id', 'goal', 'title', 'cron', 'score_type', 'score_range', 'chat_id', 'time', 'value')
+
+# the columns of ``export_fields`` that are the same for all data points of a goal, its times and its values
+GoalExport = Tuple[Tuple, array, bytes]
+
+
+def goal_columns(user: User, position: int, goal: Goal) -> Tuple:
+    """The columns of ``export_fields`` that are the same for all data points of a goal"""
+    return user.id, position, goal.title, goal.cron, goal.score_type, goal.score_range, goal.chat_id
+
+
+def export_snapshot(user: User) -> List[GoalExport]:
+    """A copy of the goals of the user to export, which the handlers may change while it is written"""
+    return [(goal_columns(user, position, goal), array('d', goal.times), bytes(goal.values))
+            for position, goal in enumerate(user.goals)]
+
+
+def export_rows(goals: List[GoalExport]) -> Iterator[Tuple]:
+    """One row (with the columns of ``export_fields``) per data point in the history of each goal of a snapshot
+
+    Goals without data points are exported as a single row without a time and a value.
+    """
+    for head, times, values in goals:
+        if len(times) == 0:
+            yield head + (None, None)
+        for timestamp, value in zip(times, values):
+            yield head + (timestamp, value)
+
+
+def export_csv(goals: List[GoalExport]) -> Iterator[str]:
+    """The data points of a snapshot as CSV (with a header), in chunks of about ``EXPORT_CHUNK_SIZE`` characters"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+    writer.writerow(export_fields)
+    for row in export_rows(goals):
+        writer.writerow(row)
+        if buffer.tell() >= EXPORT_CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def export_jsonl(goals: List[GoalExport]) -> Iterator[str]:
+    """The data points of a snapshot as JSON Lines, in chunks of about ``EXPORT_CHUNK_SIZE`` characters"""
+    lines, size = [], 0
+    for columns, times, values in goals:
+        # the goal's columns are encoded once, the object is completed with the time and value of each data point
+        head = json.dumps(dict(zip(export_fields, columns)), ensure_ascii=False)[:-1]
+        if len(times) == 0:
+            lines.append(f'{head}, "time": null, "value": null}}\n')
+        for timestamp, value in zip(times, values):
+            line = f'{head}, "time": {timestamp!r}, "value": {value}}}\n'
+            lines.append(line)
+            size += len(line)
+            if size >= EXPORT_CHUNK_SIZE:
+                yield ''.join(lines)
+                lines, size = [], 0
+    yield ''.join(lines)
+
+
+def write_export(path: str, export_format: str, goals: List[GoalExport]):
+    """Writes a snapshot in an export format to a file, chunk by chunk"""
+    with open(path, 'w', encoding='utf-8') as f:
+        f.writelines(export_formats[export_format](goals))
+
+
+export_formats: Dict[str, Callable[[List[GoalExport]], Iterator[str]]] = {
+    'csv': export_csv,
+    'jsonl': export_jsonl
+}
+
+
+def parse_row(record: Dict[str, Any]) -> Dict[str, Any]:
+    """A row of an export (as read from CSV or JSON Lines) with the values converted to their types
+
+    Raises a ValueError if a column is missing or invalid.
+    """
+    try:
+        row = {
+            'user_id': int(record['user_id']),
+            'goal': int(record['goal']),
+            'title': str(record['title']),
+            'cron': str(record['cron']),
+            'score_type': str(record['score_type']),
+            'score_range': int(record['score_range']),
+            'chat_id': int(record['chat_id']),
+            'time': None if record['time'] in (None, '') else float(record['time']),
+            'value': None if record['value'] in (None, '') else int(record['value'])
+        }
+    except KeyError as e:
+        raise ValueError(f'missing column {e}')
+    except TypeError as e:
+        raise ValueError(e)
+    if row['score_type'] not in goal_score_types:
+        raise ValueError(f"unknown score type '{row['score_type']}'")
+    # the same rules as for goals added by /add_goal
+    if row['score_type'] == goal_score_types[0] and row['score_range'] != -1:
+        raise ValueError(f"invalid score range {row['score_range']} (has to be -1 for '{goal_score_types[0]}')")
+    if row['score_type'] != goal_score_types[0] and not 0 < row['score_range'] <= max_score_range:
+        raise ValueError(f"invalid score range {row['score_range']} (has to be between 1 and {max_score_range})")
+    try:
+        CronSchedule.of(row['cron'])
+    except ValueError as e:
+        raise ValueError(f"invalid cron expression '{row['cron']}' ({e})")
+    if (row['time'] is None) != (row['value'] is None):
+        raise ValueError('time and value have to be given both or not at all')
+    if row['value'] is not None and not 0 <= row['value'] <= 255:
+        raise ValueError(f"invalid value {row['value']}")
+    return row
+
+
+def read_export(path: str) -> Iterator[Tuple[int, Optional[Dict[str, Any]], Optional[str]]]:
+    """The line number and either the parsed row or the error for every row of an export file (.csv or .jsonl)"""
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            reader = csv.DictReader(f)
+            for record in reader:
+                try:
+                    yield reader.line_num, parse_row(record), None
+                except ValueError as e:
+                    yield reader.line_num, None, str(e)
+            return
+
+        for line_number, line in enumerate(f, 1):
+            if line.strip() == '':
+                continue
+            try:
+                record = json.loads(line)
+                if not isinstance(record, dict):
+                    raise ValueError('not a JSON object')
+                yield line_number, parse_row(record), None
+            except ValueError as e:
+                yield line_number, None, str(e)
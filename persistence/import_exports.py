@@ -0,0 +1,93 @@
+import os
+import sys
+from datetime import datetime
+from typing import Any, Callable, Dict, Optional
+from model import Goal, User, UserList
+from persistence.export import read_export
+from persistence.sqlite_persistence import SQLitePersistence
+
+# the number of imported rows after which the changed users are written to the database
+IMPORT_BATCH_SIZE = int(os.environ['IMPORT_BATCH_SIZE']) if 'IMPORT_BATCH_SIZE' in os.environ else 10000
+
+
+def import_row(users: UserList, row: Dict[str, Any]) -> str:
+    """Adds the goal and the data point of a row (see :func:`persistence.export.parse_row`) to the users
+
+    Returns 'imported' if anything has been added, 'present' if the row exists already and 'skipped' if its data point
+    is older than the (trimmed) history of the goal, so it can't be added anymore.
+    """
+    if row['user_id'] not in users:
+        # like a user that has not been authorized yet
+        users.append(User(row['user_id']))
+    user = users[row['user_id']]
+    goal = next((g for g in user.goals if g.title == row['title']), None)
+    status = 'present'
+    if goal is None:
+        goal = Goal(row['title'], row['cron'], row['score_type'], row['score_range'], row['chat_id'])
+        user.add_goal(goal)
+        status = 'imported'
+    if row['time'] is not None and not goal.has_data_at(row['time']):
+        if goal.is_before_history(row['time']):
+            return 'skipped'
+        goal.add_data(row['value'], datetime.fromtimestamp(row['time']))
+        status = 'imported'
+    if status == 'imported':
+        users.mark_dirty(user.id)
+    return status
+
+
+def import_exports(directory: str, persistence: SQLitePersistence, batch_size: int = IMPORT_BATCH_SIZE,
+                   owns_user: Optional[Callable[[int], bool]] = None):
+    """Adds the goals and data points of the exports (.csv and .jsonl files written by /export) in a directory to the
+    bot data of a persistence
+
+    Goals are matched by user and title. Data points of existing goals are merged into them (keeping their
+    configuration) and users that do not exist yet are added without being authorized. Rows of users for which
+    ``owns_user`` returns False (e.g. those of other shards) are skipped.
+
+    The files are read row by row and the changed users are written after every ``batch_size`` rows, so an import
+    that has been interrupted can simply be repeated (data points that exist already are skipped).
+    """
+    users: UserList = persistence.load_bot_data()['users']
+    paths = sorted(os.path.join(directory, name) for name in os.listdir(directory)
+                   if name.endswith('.csv') or name.endswith('.jsonl'))
+    counts = {'imported': 0, 'present': 0, 'skipped': 0}
+    invalid = pending = 0
+    for path in paths:
+        for line_number, row, error in read_export(path):
+            if error is not None:
+                print(f'{path}:{line_number}: {error}')
+                invalid += 1
+                continue
+            if owns_user is not None and not owns_user(row['user_id']):
+                continue
+            counts[import_row(users, row)] += 1
+            pending += 1
+            if pending >= batch_size:
+                persistence.checkpoint()
+                pending = 0
+    persistence.checkpoint()
+    print(f"Imported {counts['imported']} rows from {len(paths)} files into {persistence.filename} "
+          f"({counts['present']} already present, {counts['skipped']} older than the goal's history, "
+          f"{invalid} invalid)")
+
+
+if __name__ == '__main__':
+    # imports exports into the database(s) of a stopped bot
+    if len(sys.argv) < 2:
+        print('usage: python -m persistence.import_exports <export directory> [database path]')
+        sys.exit(1)
+    source = sys.argv[1]
+    target = sys.argv[2] if len(sys.argv) > 2 else os.environ.get('DATABASE_PATH', 'driserbot_state.sqlite')
+    shard_count = int(os.environ['SHARD_COUNT']) if 'SHARD_COUNT' in os.environ else 1
+    if shard_count > 1 and os.path.exists(f'{target}.shard0'):
+        # the database has been split into the databases of the shards already
+        from sharding import shard_of
+        targets = [(f'{target}.shard{shard}', lambda uid, shard=shard: shard_of(uid, shard_count) == shard)
+                   for shard in range(shard_count)]
+    else:
+        targets = [(target, None)]
+    for database_path, owned in targets:
+        sqlite_persistence = SQLitePersistence(database_path)
+        import_exports(source, sqlite_persistence, owns_user=owned)
+        sqlite_persistence.close()
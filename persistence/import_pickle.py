@@ -0,0 +1,36 @@
+import os
+import sys
+from persistence.migrations import MigratingUnpickler
+from persistence.sqlite_persistence import SQLitePersistence
+
+
+def import_pickle(pickle_path: str, persistence: SQLitePersistence):
+    """Copies the state stored by PicklePersistence (single file mode) into an SQLitePersistence
+
+    Goals stored by former versions of the bot are upgraded while they are unpickled.
+    """
+    with open(pickle_path, 'rb') as f:
+        state = MigratingUnpickler(f).load()
+
+    persistence.save_bot_data(state.get('bot_data', {}))
+    for chat_id, chat_data in state.get('chat_data', {}).items():
+        persistence.save_chat_data(chat_id, chat_data)
+    for user_id, user_data in state.get('user_data', {}).items():
+        persistence.save_user_data(user_id, user_data)
+    for name, conversations in (state.get('conversations') or {}).items():
+        for key, conversation_state in conversations.items():
+            persistence.save_conversation(name, key, conversation_state)
+    persistence.checkpoint()
+    print(f"Imported {len(state.get('bot_data', {}).get('users', []))} users and "
+          f"{len(state.get('chat_data', {}))} chats from {pickle_path}")
+
+
+if __name__ == '__main__':
+    source = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('PICKLE_PATH', 'driserbot_state')
+    target = sys.argv[2] if len(sys.argv) > 2 else os.environ.get('DATABASE_PATH', 'driserbot_state.sqlite')
+    if os.path.exists(target):
+        print(f'{target} already exists, refusing to overwrite it')
+        sys.exit(1)
+    sqlite_persistence = SQLitePersistence(target)
+    import_pickle(source, sqlite_persistence)
+    sqlite_persistence.close()
@@ -0,0 +1,160 @@
+import asyncio
+import json
+import os
+import time
+from threading import Condition, Thread
+from typing import Iterator, List, NamedTuple, Optional, Tuple
+
+
+class JournalEntry(NamedTuple):
+    sequence: int
+    user_id: int
+    goal_title: str
+    time: float
+    value: int
+    # the goal is identified by its key, entries written before the goals had one only have the title
+    goal_key: Optional[str] = None
+
+
+class AnswerJournal:
+    """Append-only log of goal check answers.
+
+    Entries are written as JSON lines. :meth:`append` returns once the entry has been fsynced; appends arriving while
+    a sync is in progress are committed together by the next sync (group commit), so concurrent answers share the
+    cost of a single fsync. :meth:`append_async` waits for the fsync without blocking the event loop, so any number
+    of answers can be waiting for the same commit.
+
+    Compaction closes the current file as a segment (``<path>.<last sequence number>``) and continues with a new one,
+    segments are deleted once all of their entries have been compacted. Appends only wait for the rename, never for
+    rewriting the journal.
+    """
+
+    def __init__(self, path: str, commit_delay: float = 0.002, sequence: int = 0):
+        self.path = path
+        self.commit_delay = commit_delay
+        # compaction may have dropped every entry, so the numbering continues after the given (e.g. the last
+        # compacted) sequence number, which readers skip entries up to
+        self.sequence = sequence
+        self.compacted = sequence
+        for entry in self.read():
+            self.sequence = max(self.sequence, entry.sequence)
+        self._file = open(path, 'ab')
+        self._condition = Condition()
+        self._written = self.sequence
+        self._synced = self.sequence
+        self._closed = False
+        self._waiters: List[Tuple[int, asyncio.AbstractEventLoop, asyncio.Future]] = []
+        self._committer = Thread(target=self._commit_loop, name='answer-journal', daemon=True)
+        self._committer.start()
+
+    def append(self, user_id: int, goal_key: str, goal_title: str, timestamp: float, value: int) -> int:
+        with self._condition:
+            sequence = self._write(user_id, goal_key, goal_title, timestamp, value)
+            while self._synced < sequence:
+                self._condition.wait()
+        return sequence
+
+    async def append_async(self, user_id: int, goal_key: str, goal_title: str, timestamp: float, value: int) -> int:
+        loop = asyncio.get_running_loop()
+        synced = loop.create_future()
+        with self._condition:
+            sequence = self._write(user_id, goal_key, goal_title, timestamp, value)
+            self._waiters.append((sequence, loop, synced))
+        await synced
+        return sequence
+
+    def _write(self, user_id: int, goal_key: str, goal_title: str, timestamp: float, value: int) -> int:
+        # called with the condition held
+        if self._closed:
+            raise ValueError('The journal has been closed')
+        self.sequence += 1
+        entry = JournalEntry(self.sequence, user_id, goal_title, timestamp, value, goal_key)
+        self._file.write(json.dumps(entry._asdict(), ensure_ascii=False).encode() + b'\n')
+        self._written = self.sequence
+        self._condition.notify_all()
+        return self.sequence
+
+    def segments(self) -> List[Tuple[int, str]]:
+        """The sequence numbers of the last entries and the paths of the segments closed by compaction, oldest first"""
+        directory, name = os.path.split(os.path.abspath(self.path))
+        segments = []
+        for file_name in os.listdir(directory):
+            sequence = file_name[len(name) + 1:]
+            if file_name.startswith(f'{name}.') and sequence.isdigit():
+                segments.append((int(sequence), os.path.join(directory, file_name)))
+        return sorted(segments)
+
+    def read(self, after: int = 0) -> Iterator[JournalEntry]:
+        # segments are kept until all of their entries have been compacted
+        after = max(after, self.compacted)
+        for sequence, path in self.segments():
+            if sequence > after:
+                yield from self._read_file(path, after)
+        if os.path.exists(self.path):
+            yield from self._read_file(self.path, after)
+
+    @staticmethod
+    def _read_file(path: str, after: int) -> Iterator[JournalEntry]:
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = JournalEntry(**json.loads(line))
+                except (ValueError, TypeError):
+                    # a torn write at the end of the journal (the process died while appending)
+                    break
+                if entry.sequence > after:
+                    yield entry
+
+    def compact(self, upto: int):
+        """Drops all entries up to (and including) the given sequence number, e.g. after they have been written to
+        a snapshot"""
+        with self._condition:
+            while self._synced < self._written:
+                self._condition.wait()
+            if self._file.tell() > 0:
+                self._file.close()
+                os.replace(self.path, f'{self.path}.{self.sequence}')
+                self._file = open(self.path, 'ab')
+            self.compacted = max(self.compacted, upto)
+        # the entries of the segments are only needed until they have been compacted
+        for sequence, path in self.segments():
+            if sequence <= upto:
+                os.remove(path)
+
+    def close(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._committer.join()
+        self._file.close()
+
+    def _commit_loop(self):
+        while True:
+            with self._condition:
+                while self._synced == self._written and not self._closed:
+                    self._condition.wait()
+                if self._closed and self._synced == self._written:
+                    return
+            # give concurrent writers the chance to join this commit
+            time.sleep(self.commit_delay)
+            with self._condition:
+                sequence = self._written
+                self._file.flush()
+                file_descriptor = self._file.fileno()
+            os.fsync(file_descriptor)
+            with self._condition:
+                self._synced = max(self._synced, sequence)
+                self._condition.notify_all()
+                synced = [waiter for waiter in self._waiters if waiter[0] <= self._synced]
+                self._waiters = [waiter for waiter in self._waiters if waiter[0] > self._synced]
+            for _, loop, future in synced:
+                try:
+                    loop.call_soon_threadsafe(_resolve, future)
+                except RuntimeError:
+                    # the event loop has been closed in the meantime, nobody is waiting anymore
+                    pass
+
+
+def _resolve(future: asyncio.Future):
+    if not future.done():
+        future.set_result(None)
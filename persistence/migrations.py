@@ -0,0 +1,266 @@
+import io
+import os
+import pickle
+import sqlite3
+import sys
+import zlib
+from array import array
+from typing import Any, Callable, Dict, List
+from common import goal_score_types
+from model import Goal
+from model.Goal import rolling_scores
+
+# version 1 is the schema of databases without a version stamp (see SCHEMA), every migration upgrades by one version
+SCHEMA_VERSION = 5
+schema_migrations: Dict[int, Callable[[sqlite3.Cursor], None]] = {}
+# upgrades of pickled goal states, by the version they upgrade from
+goal_state_migrations: Dict[int, Callable[[Dict], Dict]] = {}
+
+
+def schema_migration(version: int):
+    """Registers ``func(cursor)`` as the migration of the database schema to ``version``"""
+    def register(func: Callable[[sqlite3.Cursor], None]):
+        schema_migrations[version] = func
+        return func
+    return register
+
+
+def goal_state_migration(version: int):
+    """Registers ``func(state) -> state`` as the upgrade of goal states of ``version`` to the next version"""
+    def register(func: Callable[[Dict], Dict]):
+        goal_state_migrations[version] = func
+        return func
+    return register
+
+
+def schema_version(connection: sqlite3.Connection) -> int:
+    return max(connection.execute('PRAGMA user_version').fetchone()[0], 1)
+
+
+def migrate(connection: sqlite3.Connection, filename: str = '') -> int:
+    """Upgrades the database to :data:`SCHEMA_VERSION`, each migration in a transaction of its own, and returns the
+    version the database had"""
+    version = schema_version(connection)
+    if version > SCHEMA_VERSION:
+        raise RuntimeError(f'The database {filename} has schema version {version}, this version of the bot only '
+                           f'supports up to {SCHEMA_VERSION}')
+    for target in range(version + 1, SCHEMA_VERSION + 1):
+        print(f'Migrating {filename or "the database"} to schema version {target}')
+        cursor = connection.cursor()
+        cursor.execute('BEGIN')
+        try:
+            schema_migrations[target](cursor)
+            # PRAGMA doesn't accept parameters
+            cursor.execute(f'PRAGMA user_version = {int(target)}')
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        else:
+            cursor.execute('COMMIT')
+        finally:
+            cursor.close()
+    if version < SCHEMA_VERSION:
+        # returns the space of dropped tables and columns
+        connection.execute('VACUUM')
+    return version
+
+
+@schema_migration(2)
+def store_rolling_scores(cursor: sqlite3.Cursor):
+    """Stores the window sum and the streak of the goals, which were recalculated from the data points on every load"""
+    cursor.execute('ALTER TABLE goals ADD COLUMN window_sum INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('ALTER TABLE goals ADD COLUMN streak INTEGER NOT NULL DEFAULT 0')
+    values: Dict[tuple, bytearray] = {}
+    for uid, position, value in cursor.execute('SELECT user_id, goal_position, value FROM data_points '
+                                               'ORDER BY user_id, goal_position, time, rowid'):
+        values.setdefault((uid, position), bytearray()).append(value)
+    for uid, position, score_range in cursor.execute('SELECT user_id, position, score_range FROM goals').fetchall():
+        window_sum, streak = rolling_scores(values.get((uid, position), bytearray()),
+                                            100 if score_range == -1 else score_range)
+        cursor.execute('UPDATE goals SET window_sum = ?, streak = ? WHERE user_id = ? AND position = ?',
+                       (window_sum, streak, uid, position))
+
+
+@schema_migration(3)
+def drop_stored_scores(cursor: sqlite3.Cursor):
+    """Only stores the time and the value of the data points (see :func:`derive_scores`)"""
+    cursor.execute('ALTER TABLE goals ADD COLUMN lead BLOB')
+    cursor.execute('ALTER TABLE goals ADD COLUMN lead_streak INTEGER NOT NULL DEFAULT 0')
+    cursor.execute('ALTER TABLE goals ADD COLUMN pinned BLOB')
+    points: Dict[tuple, List[tuple]] = {}
+    for uid, position, *point in cursor.execute('SELECT user_id, goal_position, time, value, streak, average, amount '
+                                                'FROM data_points ORDER BY user_id, goal_position, time, rowid'):
+        points.setdefault((uid, position), []).append(point)
+    for uid, position, title, cron, score_type, score_range, chat_id, waiting_for_data, window_sum, streak in \
+            cursor.execute('SELECT user_id, position, title, cron, score_type, score_range, chat_id, '
+                           'waiting_for_data, window_sum, streak FROM goals').fetchall():
+        times, values, streaks, averages, amounts = list(zip(*points.get((uid, position), []))) or [()] * 5
+        state = derive_scores({'title': title, 'cron': cron, 'score_type': score_type, 'score_range': score_range,
+                               'chat_id': chat_id, 'waiting_for_data': bool(waiting_for_data),
+                               'window_sum': window_sum, 'streak': streak, 'times': array('d', times),
+                               'values': bytearray(values),
+                               'scores': (array('i', streaks), array('d', averages), array('i', amounts))})
+        pinned = None if state['pinned'] is None else pickle.dumps(state['pinned'], pickle.HIGHEST_PROTOCOL)
+        cursor.execute('UPDATE goals SET window_sum = ?, streak = ?, lead = ?, lead_streak = ?, pinned = ? '
+                       'WHERE user_id = ? AND position = ?',
+                       (state['window_sum'], state['streak'], bytes(state['lead']) or None, state['lead_streak'],
+                        pinned, uid, position))
+    cursor.execute('CREATE TABLE data_points_v3 (user_id INTEGER NOT NULL, goal_position INTEGER NOT NULL, '
+                   'time REAL NOT NULL, value INTEGER NOT NULL)')
+    cursor.execute('INSERT INTO data_points_v3 SELECT user_id, goal_position, time, value FROM data_points '
+                   'ORDER BY rowid')
+    cursor.execute('DROP TABLE data_points')
+    cursor.execute('ALTER TABLE data_points_v3 RENAME TO data_points')
+    cursor.execute('CREATE INDEX data_points_by_goal ON data_points (user_id, goal_position)')
+
+
+@schema_migration(4)
+def add_rollups(cursor: sqlite3.Cursor):
+    """Keeps the data points dropped from the history of goals as rollups (see GoalRollups)"""
+    cursor.execute('ALTER TABLE goals ADD COLUMN rollups BLOB')
+
+
+def legacy_goal_key(title: str) -> str:
+    """The key goals were identified by in callback data before they had a key of their own"""
+    return f'{zlib.crc32(title.encode()):08x}'
+
+
+@schema_migration(5)
+def add_goal_keys(cursor: sqlite3.Cursor):
+    """Stores the key of every goal, the keys of existing goals are those their buttons have been signed with"""
+    cursor.execute("ALTER TABLE goals ADD COLUMN key TEXT NOT NULL DEFAULT ''")
+    for uid, position, title in cursor.execute('SELECT user_id, position, title FROM goals').fetchall():
+        cursor.execute('UPDATE goals SET key = ? WHERE user_id = ? AND position = ?',
+                       (legacy_goal_key(title), uid, position))
+
+
+def goal_state_version(state: Dict) -> int:
+    if 'version' in state:
+        return state['version']
+    # goals of the first versions stored a dict per data point
+    return 0 if 'data' in state else 1
+
+
+def upgrade_goal_state(state: Dict) -> Dict:
+    for version in range(goal_state_version(state), Goal.state_version):
+        state = goal_state_migrations[version](state)
+    return state
+
+
+@goal_state_migration(0)
+def convert_data_points(state: Dict) -> Dict:
+    """Converts the dicts per data point (with a scalar score of the goal's score type at first) into arrays"""
+    score_type = state['score_type']
+    data: List[Dict] = state['data']
+    score_range = min(100. if state['score_range'] == -1 else state['score_range'], len(data))
+    times, values = array('d'), bytearray()
+    streaks, averages, amounts = array('i'), array('d'), array('i')
+    for point in data:
+        score = point['score']
+        if not isinstance(score, dict):
+            score = {
+                goal_score_types[0]: int(score) if goal_score_types[0] == score_type else 0,
+                goal_score_types[1]: score if goal_score_types[1] == score_type else 0.,
+                goal_score_types[2]: int(score) if goal_score_types[2] == score_type else 0
+            }
+        average = score[goal_score_types[1]]
+        if score[goal_score_types[2]] != 0 and average == 0.:
+            average = score[goal_score_types[2]] / float(score_range)
+        times.append(point['time'])
+        values.append(point['value'])
+        streaks.append(score[goal_score_types[0]])
+        averages.append(average)
+        amounts.append(score[goal_score_types[2]])
+    state = {key: value for key, value in state.items() if key != 'data'}
+    state.update(times=times, values=values, scores=(streaks, averages, amounts))
+    return state
+
+
+@goal_state_migration(1)
+def add_rolling_scores(state: Dict) -> Dict:
+    window_sum, streak = rolling_scores(state['values'], 100 if state['score_range'] == -1 else state['score_range'])
+    return dict(state, chat_id=state.get('chat_id', -1), window_sum=window_sum, streak=streak, version=2)
+
+
+@goal_state_migration(2)
+def derive_scores(state: Dict) -> Dict:
+    """Drops the scores stored for every data point, they are derived from the values now (see Goal.score_at)
+
+    The values dropped from the history that the first scores depend on are reconstructed from the stored scores.
+    Stored scores that differ from the derived ones nonetheless (answers recorded out of order, data converted by
+    :func:`convert_data_points`) are pinned, so the charts of the history don't change.
+    """
+    times, values = state['times'], state['values']
+    streaks, averages, amounts = state['scores']
+    window_range = 100 if state['score_range'] == -1 else state['score_range']
+    # values have only been dropped once the history was full
+    dropped = len(values) >= max(100, state['score_range'])
+    lead_length = 0
+    for position, average in enumerate(averages if dropped else ()):
+        # the divisor of the first non-zero average is the number of values in its window
+        if average != 0:
+            lead_length = min(window_range - 1, max(0, round(amounts[position] / average) - position - 1))
+            break
+    # a value leaves the window of the data point window_range positions after it
+    lead = bytearray(min(255, max(0, values[position] - amounts[position] + amounts[position - 1]))
+                     if position < len(values) else 0 for position in range(window_range - lead_length, window_range))
+    state = {key: value for key, value in state.items() if key != 'scores'}
+    state.update(lead=lead, lead_streak=max(0, streaks[0] - 1) if dropped and values[0] else 0, pinned=None,
+                 version=3)
+
+    goal = Goal.__new__(Goal)
+    # the scores are derived by the current goal, which has no rollups yet
+    goal.__setstate__(dict(state, rollups=None, key=None))
+    goal.reset_rolling_scores()
+    pinned = {timestamp: stored for timestamp, stored, derived in
+              zip(times, zip(streaks, averages, amounts), zip(*map(goal.scores, goal_score_types)))
+              if stored != derived}
+    state.update(window_sum=goal.calculate_score_floating_amount(), streak=goal.calculate_score_days(),
+                 pinned=pinned or None)
+    return state
+
+
+@goal_state_migration(3)
+def start_rollups(state: Dict) -> Dict:
+    # data points dropped before had been discarded
+    return dict(state, rollups=None, version=4)
+
+
+@goal_state_migration(4)
+def add_goal_key(state: Dict) -> Dict:
+    # buttons sent before keep working
+    return dict(state, key=legacy_goal_key(state['title']), version=5)
+
+
+class MigratingGoal(Goal):
+    """Stands in for :class:`Goal` while unpickling, upgrades the state and turns itself into a goal"""
+    __slots__ = ()
+
+    def __setstate__(self, state):
+        Goal.__setstate__(self, upgrade_goal_state(state))
+        self.__class__ = Goal
+
+
+class MigratingUnpickler(pickle.Unpickler):
+    """Unpickles state written by any former version of the bot"""
+
+    def find_class(self, module: str, name: str) -> Any:
+        if module in ('model.Goal', 'model') and name == 'Goal':
+            return MigratingGoal
+        return super().find_class(module, name)
+
+
+def unpickle(data: bytes) -> Any:
+    return MigratingUnpickler(io.BytesIO(data)).load()
+
+
+if __name__ == '__main__':
+    # migrates a database without starting the bot
+    database_path = sys.argv[1] if len(sys.argv) > 1 else os.environ.get('DATABASE_PATH', 'driserbot_state.sqlite')
+    if not os.path.exists(database_path):
+        print(f'{database_path} does not exist')
+        sys.exit(1)
+    connection = sqlite3.connect(database_path, isolation_level=None)
+    previous_version = migrate(connection, database_path)
+    connection.close()
+    print(f'{database_path} is at schema version {SCHEMA_VERSION} (was {previous_version})')
@@ -0,0 +1,579 @@
+import asyncio
+import hashlib
+import itertools
+import pickle
+import sqlite3
+import time
+from array import array
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from operator import itemgetter
+from threading import Lock, RLock
+from typing import Callable, DefaultDict, Dict, FrozenSet, List, Optional, Tuple, Any, Iterator
+from telegram.ext import BasePersistence, CallbackContext, PersistenceInput
+from metrics import persistence_flush_seconds
+from model import DialogStore, Goal, User, UserList
+from persistence.journal import AnswerJournal
+from persistence.migrations import SCHEMA_VERSION, migrate
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    authorized INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    goal_polls BLOB
+);
+CREATE TABLE IF NOT EXISTS goals (
+    user_id INTEGER NOT NULL,
+    position INTEGER NOT NULL,
+    title TEXT NOT NULL,
+    cron TEXT NOT NULL,
+    score_type TEXT NOT NULL,
+    score_range INTEGER NOT NULL,
+    chat_id INTEGER NOT NULL,
+    waiting_for_data INTEGER NOT NULL,
+    window_sum INTEGER NOT NULL DEFAULT 0,
+    streak INTEGER NOT NULL DEFAULT 0,
+    lead BLOB,
+    lead_streak INTEGER NOT NULL DEFAULT 0,
+    pinned BLOB,
+    rollups BLOB,
+    key TEXT NOT NULL DEFAULT '',
+    PRIMARY KEY (user_id, position)
+);
+CREATE TABLE IF NOT EXISTS data_points (
+    user_id INTEGER NOT NULL,
+    goal_position INTEGER NOT NULL,
+    time REAL NOT NULL,
+    value INTEGER NOT NULL
+);
+CREATE INDEX IF NOT EXISTS data_points_by_goal ON data_points (user_id, goal_position);
+CREATE TABLE IF NOT EXISTS bot_data (key TEXT PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS chat_data (chat_id INTEGER NOT NULL, key TEXT NOT NULL, data BLOB NOT NULL,
+                                      PRIMARY KEY (chat_id, key));
+CREATE TABLE IF NOT EXISTS dialogs (chat_id INTEGER NOT NULL, dialog_id TEXT NOT NULL, data BLOB NOT NULL,
+                                    PRIMARY KEY (chat_id, dialog_id));
+CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE IF NOT EXISTS conversations (name TEXT NOT NULL, key BLOB NOT NULL, state BLOB,
+                                          PRIMARY KEY (name, key));
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value);
+'''
+
+
+ConversationDict = Dict[Tuple[int, ...], object]
+
+
+def dumps(obj: Any) -> bytes:
+    return pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def digest(data: bytes) -> bytes:
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+
+async def record_answer(context: CallbackContext, user_id: int, goal: Goal, timestamp: float, value: int):
+    persistence = context.application.persistence
+    if isinstance(persistence, SQLitePersistence):
+        await persistence.record_answer(context.bot_data['users'], user_id, goal, timestamp, value)
+    else:
+        context.bot_data['users'].mark_dirty(user_id)
+
+
+class BotData(dict):
+    """The type of the bot data (see :class:`telegram.ext.ContextTypes`)
+
+    The application deep copies the bot data before every persistence update. The users are written incrementally
+    from the live objects instead (see :meth:`UserList.mark_dirty`), so the bot data is never copied.
+    """
+
+    def __deepcopy__(self, memo):
+        return self
+
+
+# the row of the user (without its id), the rows of its goals (without the user id and position) and the times and
+# values of each goal
+UserRows = Tuple[Tuple, List[Tuple], List[Tuple[array, bytes]]]
+
+
+def user_rows(user: User) -> UserRows:
+    """Copies of the rows of a user, its goals and their data points"""
+    goals = [(goal.title, goal.cron, goal.score_type, goal.score_range, goal.chat_id, int(goal.waiting_for_data),
+              goal.calculate_score_floating_amount(), goal.calculate_score_days(), bytes(goal.lead) or None,
+              goal.lead_streak, None if goal.pinned is None else dumps(goal.pinned),
+              None if goal.rollups is None else dumps(goal.rollups), goal.key)
+             for goal in user.goals]
+    points = [(array('d', goal.times), bytes(goal.values)) for goal in user.goals]
+    return (user.name, int(user.authorized), user.chat_id, dumps(user.goal_polls)), goals, points
+
+
+class StagedWrite:
+    """The rows of everything that has changed, copied from the live state so they can be written by another thread"""
+    __slots__ = ('user_ids', 'users', 'bot_data', 'chats', 'user_data', 'journal_sequence')
+
+    def __init__(self, journal_sequence: Optional[int] = None):
+        self.user_ids: FrozenSet[int] = frozenset()
+        self.users: Dict[int, Optional[UserRows]] = {}
+        self.bot_data: Dict[str, bytes] = {}
+        self.chats: Dict[int, Dict[Tuple[str, str], bytes]] = {}
+        self.user_data: Dict[int, bytes] = {}
+        self.journal_sequence = journal_sequence
+
+    def empty(self) -> bool:
+        return len(self.users) == 0 and len(self.bot_data) == 0 and len(self.chats) == 0 and \
+            len(self.user_data) == 0 and self.journal_sequence is None
+
+
+class SQLitePersistence(BasePersistence):
+    """Stores users, goals, data points and chat dialogs as rows of an SQLite database (in WAL mode).
+
+    Only users marked dirty in ``bot_data['users']`` (see :meth:`UserList.mark_dirty`) and chat entries whose
+    serialized content changed are written, so the cost of a write grows with what changed instead of the total
+    state. With ``on_flush=True``, writes are deferred until :meth:`flush` is called.
+
+    If a journal path is given, goal check answers are recorded in an :class:`AnswerJournal` (see
+    :meth:`record_answer`) and the affected users are only written on :meth:`flush`, which then compacts the journal.
+    Journal entries that are not part of the database yet are replayed when the bot data is loaded.
+
+    The coroutines called by the application copy the changed rows on the event loop (see :class:`StagedWrite`) and
+    hand the statements over to a single worker thread, so the event loop never waits for SQLite and the worker never
+    reads objects the handlers are changing. The blocking methods (``load_*``, ``save_*`` and :meth:`checkpoint`) can be used directly
+    where there is no event loop, e.g. to import data.
+    """
+
+    def __init__(self, filename: str, store_user_data: bool = True, store_chat_data: bool = True,
+                 store_bot_data: bool = True, on_flush: bool = False, journal_path: Optional[str] = None,
+                 update_interval: float = 5.):
+        super().__init__(store_data=PersistenceInput(bot_data=store_bot_data, chat_data=store_chat_data,
+                                                     user_data=store_user_data, callback_data=False),
+                         update_interval=update_interval)
+        self.filename = filename
+        self.on_flush = on_flush
+        self._lock = RLock()
+        self._connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+        self._connection.execute('PRAGMA synchronous=NORMAL')
+        created = self._connection.execute("SELECT count(*) FROM sqlite_master WHERE type = 'table'").fetchone()[0] == 0
+        self._connection.executescript(SCHEMA)
+        if created:
+            self._connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION}')
+        else:
+            migrate(self._connection, filename)
+
+        self.bot_data: Optional[BotData] = None
+        self.chat_data: Optional[DefaultDict[int, Dict]] = None
+        self.user_data: Optional[DefaultDict[int, Dict]] = None
+        self._written_bot_data: Dict[str, bytes] = {}
+        self._written_chats: DefaultDict[int, Dict[Tuple[str, str], bytes]] = defaultdict(dict)
+        self._written_user_data: Dict[int, bytes] = {}
+        self._dirty_chats = set()
+        self._dirty_user_data = set()
+        self._dirty_lock = Lock()
+        self.journal: Optional[AnswerJournal] = \
+            AnswerJournal(journal_path, sequence=self._journal_sequence()) if journal_path is not None else None
+        self._executor = ThreadPoolExecutor(1, thread_name_prefix='sqlite-persistence')
+
+    async def _run(self, func: Callable, *args) -> Any:
+        return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+
+    async def get_bot_data(self) -> BotData:
+        return await self._run(self.load_bot_data)
+
+    async def get_chat_data(self) -> DefaultDict[int, Dict]:
+        return await self._run(self.load_chat_data)
+
+    async def get_user_data(self) -> DefaultDict[int, Dict]:
+        return await self._run(self.load_user_data)
+
+    async def get_callback_data(self) -> None:
+        return None
+
+    async def get_conversations(self, name: str) -> ConversationDict:
+        return await self._run(self.load_conversations, name)
+
+    # the state is copied into a StagedWrite on the event loop (which changes it) and only the statements are executed
+    # by the worker thread
+    async def update_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        await self._run(self._write_conversation, name, dumps(key), None if new_state is None else dumps(new_state))
+
+    async def update_bot_data(self, data: BotData) -> None:
+        self._set_bot_data(data)
+        if not self.on_flush:
+            await self._run(self._write, self._stage(users=True, include_deferred=False))
+
+    async def update_chat_data(self, chat_id: int, data: Dict) -> None:
+        self._set_chat_data(chat_id, data)
+        if not self.on_flush:
+            await self._run(self._write, self._stage(chats=True))
+
+    async def update_user_data(self, user_id: int, data: Dict) -> None:
+        self._set_user_data(user_id, data)
+        if not self.on_flush:
+            await self._run(self._write, self._stage(user_data=True))
+
+    async def update_callback_data(self, data: Any) -> None:
+        pass
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        self._forget_chat_data(chat_id)
+        await self._run(self._delete_chat_rows, chat_id)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._forget_user_data(user_id)
+        await self._run(self._delete_user_data_row, user_id)
+
+    # the data is only ever changed by this process, there is nothing to refresh
+    async def refresh_bot_data(self, bot_data: BotData) -> None:
+        pass
+
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict) -> None:
+        pass
+
+    async def refresh_user_data(self, user_id: int, user_data: Dict) -> None:
+        pass
+
+    async def flush(self) -> None:
+        start = time.perf_counter()
+        await self._run(self._commit, self._stage_checkpoint())
+        persistence_flush_seconds.observe(time.perf_counter() - start)
+
+    async def record_answer(self, users: UserList, user_id: int, goal: Goal, timestamp: float, value: int):
+        """Makes an answer that has been added to the goal durable"""
+        if self.journal is None:
+            users.mark_dirty(user_id)
+            return
+        # flagged before appending, so that a concurrent flush never drops the entry without writing the user
+        users.mark_dirty(user_id, deferred=True)
+        await self.journal.append_async(user_id, goal.key, goal.title, timestamp, value)
+
+    def load_bot_data(self) -> BotData:
+        with self._lock:
+            if self.bot_data is None:
+                self.bot_data = BotData()
+                for key, data in self._connection.execute('SELECT key, data FROM bot_data'):
+                    self.bot_data[key] = pickle.loads(data)
+                    self._written_bot_data[key] = digest(data)
+                self.bot_data['users'] = self._load_users()
+                if self.journal is not None:
+                    self._replay_journal(self.bot_data['users'])
+            return self.bot_data
+
+    def _journal_sequence(self) -> int:
+        """The sequence number of the last journal entry that is part of the database"""
+        row = self._connection.execute("SELECT value FROM meta WHERE key = 'journal_sequence'").fetchone()
+        return row[0] if row is not None else 0
+
+    def _replay_journal(self, users: UserList):
+        replayed = 0
+        for entry in self.journal.read(after=self._journal_sequence()):
+            if entry.user_id not in users:
+                continue
+            # a goal re-created with the same title has another key, so it gets none of the former goal's answers
+            goal = next((g for g in users[entry.user_id].goals
+                         if (g.key == entry.goal_key if entry.goal_key is not None else g.title == entry.goal_title)),
+                        None)
+            if goal is None or goal.has_data_at(entry.time):
+                continue
+            goal.add_data(entry.value, datetime.fromtimestamp(entry.time))
+            users.mark_dirty(entry.user_id, deferred=True)
+            replayed += 1
+        print(f'Replayed {replayed} goal check answers from {self.journal.path}')
+
+    def _load_users(self) -> UserList:
+        users = {}
+        for uid, name, authorized, chat_id, goal_polls in self._connection.execute(
+                'SELECT id, name, authorized, chat_id, goal_polls FROM users'):
+            user = User(uid)
+            user.name = name
+            user.authorized = bool(authorized)
+            user.chat_id = chat_id
+            user.goal_polls = pickle.loads(goal_polls) if goal_polls is not None else {}
+            users[uid] = user
+
+        goals = {}
+        for row in self._connection.execute('SELECT user_id, position, title, cron, score_type, score_range, chat_id, '
+                                            'waiting_for_data, window_sum, streak, lead, lead_streak, pinned, '
+                                            'rollups, key FROM goals ORDER BY user_id, position'):
+            goals[row[:2]] = {'title': row[2], 'cron': row[3], 'score_type': row[4], 'score_range': row[5],
+                              'chat_id': row[6], 'waiting_for_data': bool(row[7]), 'window_sum': row[8],
+                              'streak': row[9], 'times': array('d'), 'values': bytearray(),
+                              'lead': bytearray(row[10] or b''), 'lead_streak': row[11],
+                              'pinned': pickle.loads(row[12]) if row[12] is not None else None,
+                              'rollups': pickle.loads(row[13]) if row[13] is not None else None,
+                              'key': row[14], 'version': Goal.state_version}
+        # the columns of each goal's data points are copied into its arrays at once
+        for key, points in itertools.groupby(self._connection.execute(
+                'SELECT user_id, goal_position, time, value FROM data_points '
+                'ORDER BY user_id, goal_position, time, rowid'), key=itemgetter(0, 1)):
+            _, _, times, values = zip(*points)
+            state = goals[key]
+            state['times'] = array('d', times)
+            state['values'] = bytearray(values)
+        for (uid, _), state in goals.items():
+            goal = Goal.__new__(Goal)
+            goal.__setstate__(state)
+            users[uid].goals.append(goal)
+
+        user_list = UserList(users.values())
+        user_list.pop_dirty()
+        return user_list
+
+    def load_chat_data(self) -> DefaultDict[int, Dict]:
+        with self._lock:
+            if self.chat_data is None:
+                self.chat_data = defaultdict(dict)
+                for chat_id, key, data in self._connection.execute('SELECT chat_id, key, data FROM chat_data'):
+                    self.chat_data[chat_id][key] = pickle.loads(data)
+                    self._written_chats[chat_id][('chat_data', key)] = digest(data)
+                for chat_id, dialog_id, data in self._connection.execute(
+                        'SELECT chat_id, dialog_id, data FROM dialogs'):
+                    DialogStore.of(self.chat_data[chat_id])[dialog_id] = pickle.loads(data)
+                    self._written_chats[chat_id][('dialogs', dialog_id)] = digest(data)
+            return self.chat_data
+
+    def load_user_data(self) -> DefaultDict[int, Dict]:
+        with self._lock:
+            if self.user_data is None:
+                self.user_data = defaultdict(dict)
+                for user_id, data in self._connection.execute('SELECT user_id, data FROM user_data'):
+                    self.user_data[user_id] = pickle.loads(data)
+                    self._written_user_data[user_id] = digest(data)
+            return self.user_data
+
+    def load_conversations(self, name: str) -> ConversationDict:
+        with self._lock:
+            return {pickle.loads(key): pickle.loads(state) for key, state in self._connection.execute(
+                'SELECT key, state FROM conversations WHERE name = ?', (name,))}
+
+    def save_conversation(self, name: str, key: Tuple[int, ...], new_state: Optional[object]) -> None:
+        self._write_conversation(name, dumps(key), None if new_state is None else dumps(new_state))
+
+    def save_bot_data(self, data: Dict) -> None:
+        self._set_bot_data(data)
+        if not self.on_flush:
+            self._write(self._stage(users=True, include_deferred=False))
+
+    def save_chat_data(self, chat_id: int, data: Dict) -> None:
+        self._set_chat_data(chat_id, data)
+        if not self.on_flush:
+            self._write(self._stage(chats=True))
+
+    def save_user_data(self, user_id: int, data: Dict) -> None:
+        self._set_user_data(user_id, data)
+        if not self.on_flush:
+            self._write(self._stage(user_data=True))
+
+    def delete_chat_data(self, chat_id: int) -> None:
+        self._forget_chat_data(chat_id)
+        self._delete_chat_rows(chat_id)
+
+    def delete_user_data(self, user_id: int) -> None:
+        self._forget_user_data(user_id)
+        self._delete_user_data_row(user_id)
+
+    def checkpoint(self) -> None:
+        """Writes everything that has not been written yet (including deferred users) and compacts the journal"""
+        self._commit(self._stage_checkpoint())
+
+    def close(self) -> None:
+        with self._lock:
+            self.checkpoint()
+            self._connection.close()
+            if self.journal is not None:
+                self.journal.close()
+        self._executor.shutdown()
+
+    def _set_bot_data(self, data: Dict):
+        self.bot_data = data if isinstance(data, BotData) else BotData(data)
+
+    def _set_chat_data(self, chat_id: int, data: Dict):
+        if self.chat_data is None:
+            self.chat_data = defaultdict(dict)
+        self.chat_data[chat_id] = data
+        with self._dirty_lock:
+            self._dirty_chats.add(chat_id)
+
+    def _set_user_data(self, user_id: int, data: Dict):
+        if self.user_data is None:
+            self.user_data = defaultdict(dict)
+        self.user_data[user_id] = data
+        with self._dirty_lock:
+            self._dirty_user_data.add(user_id)
+
+    def _forget_chat_data(self, chat_id: int):
+        if self.chat_data is not None:
+            self.chat_data.pop(chat_id, None)
+        with self._dirty_lock:
+            self._dirty_chats.discard(chat_id)
+
+    def _forget_user_data(self, user_id: int):
+        if self.user_data is not None:
+            self.user_data.pop(user_id, None)
+        with self._dirty_lock:
+            self._dirty_user_data.discard(user_id)
+
+    def _stage(self, users: bool = False, chats: bool = False, user_data: bool = False, include_deferred: bool = True,
+               journal_sequence: Optional[int] = None) -> 'StagedWrite':
+        """Copies what has changed (and is about to be written) from the live state
+
+        Has to be called by the thread changing the state, i.e. the event loop while the application is running.
+        """
+        staged = StagedWrite(journal_sequence)
+        if users and self.bot_data is not None:
+            user_list: Optional[UserList] = self.bot_data.get('users')
+            if user_list is not None:
+                staged.user_ids = frozenset(user_list.pop_dirty(include_deferred=include_deferred))
+                staged.users = {uid: user_rows(user_list[uid]) if uid in user_list else None
+                                for uid in staged.user_ids}
+            staged.bot_data = {key: dumps(value) for key, value in self.bot_data.items() if key != 'users'}
+        if chats and self.chat_data is not None:
+            with self._dirty_lock:
+                dirty, self._dirty_chats = self._dirty_chats, set()
+            for chat_id in dirty:
+                data = self.chat_data.get(chat_id, {})
+                rows = {('chat_data', key): dumps(value) for key, value in data.items() if key != 'dialogs'}
+                rows.update({('dialogs', dialog_id): dumps(dialog)
+                             for dialog_id, dialog in data.get('dialogs', {}).items()})
+                staged.chats[chat_id] = rows
+        if user_data and self.user_data is not None:
+            with self._dirty_lock:
+                dirty, self._dirty_user_data = self._dirty_user_data, set()
+            staged.user_data = {user_id: dumps(self.user_data.get(user_id, {})) for user_id in dirty}
+        return staged
+
+    def _stage_checkpoint(self) -> 'StagedWrite':
+        # the sequence is taken first: every answer up to it has flagged its user already
+        journal_sequence = self.journal.sequence if self.journal is not None else None
+        return self._stage(users=True, chats=True, user_data=True, journal_sequence=journal_sequence)
+
+    def _commit(self, staged: 'StagedWrite'):
+        with self._lock:
+            self._write(staged)
+            self._connection.execute('PRAGMA wal_checkpoint(PASSIVE)')
+            if staged.journal_sequence is not None:
+                self.journal.compact(upto=staged.journal_sequence)
+
+    def _write(self, staged: 'StagedWrite'):
+        """Writes the staged rows in a single transaction
+
+        The digests of the written rows are only recorded once the transaction has been committed. If it fails, the
+        staged users, chats and user data are flagged again, so they are written with the next update.
+        """
+        if staged.empty():
+            return
+        with self._lock:
+            bot_digests, user_data_digests, chat_digests = {}, {}, defaultdict(dict)
+            try:
+                with self._transaction() as cursor:
+                    for uid, rows in staged.users.items():
+                        self._write_user(cursor, uid, rows)
+                    if staged.journal_sequence is not None:
+                        cursor.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('journal_sequence', ?)",
+                                       (staged.journal_sequence,))
+                    for key, data in staged.bot_data.items():
+                        self._write_if_changed(cursor, self._written_bot_data, bot_digests, key, data,
+                                               'INSERT OR REPLACE INTO bot_data (data, key) VALUES (?, ?)', (key,))
+                    for chat_id, rows in staged.chats.items():
+                        self._write_chat(cursor, chat_id, rows, chat_digests[chat_id])
+                    for user_id, data in staged.user_data.items():
+                        self._write_if_changed(cursor, self._written_user_data, user_data_digests, user_id, data,
+                                               'INSERT OR REPLACE INTO user_data (data, user_id) VALUES (?, ?)',
+                                               (user_id,))
+            except BaseException:
+                self._restore(staged)
+                raise
+            self._written_bot_data.update(bot_digests)
+            self._written_user_data.update(user_data_digests)
+            for chat_id, digests in chat_digests.items():
+                self._record_digests(self._written_chats[chat_id], digests)
+
+    def _restore(self, staged: 'StagedWrite'):
+        if len(staged.user_ids) > 0:
+            self.bot_data['users'].restore_dirty(staged.user_ids)
+        with self._dirty_lock:
+            self._dirty_chats.update(staged.chats)
+            self._dirty_user_data.update(staged.user_data)
+
+    @staticmethod
+    def _write_user(cursor: sqlite3.Cursor, uid: int, rows: Optional['UserRows']):
+        cursor.execute('DELETE FROM data_points WHERE user_id = ?', (uid,))
+        cursor.execute('DELETE FROM goals WHERE user_id = ?', (uid,))
+        if rows is None:
+            cursor.execute('DELETE FROM users WHERE id = ?', (uid,))
+            return
+
+        user, goals, points = rows
+        cursor.execute('INSERT OR REPLACE INTO users (id, name, authorized, chat_id, goal_polls) '
+                       'VALUES (?, ?, ?, ?, ?)', (uid, *user))
+        for position, (goal, (times, values)) in enumerate(zip(goals, points)):
+            cursor.execute('INSERT INTO goals (user_id, position, title, cron, score_type, score_range, chat_id, '
+                           'waiting_for_data, window_sum, streak, lead, lead_streak, pinned, rollups, key) '
+                           'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', (uid, position, *goal))
+            cursor.executemany('INSERT INTO data_points (user_id, goal_position, time, value) VALUES (?, ?, ?, ?)',
+                               ((uid, position, *row) for row in zip(times, values)))
+
+    def _write_chat(self, cursor: sqlite3.Cursor, chat_id: int, rows: Dict[Tuple[str, str], bytes], digests: Dict):
+        written = self._written_chats[chat_id]
+        for (table, key), data in rows.items():
+            self._write_if_changed(cursor, written, digests, (table, key), data,
+                                   f'INSERT OR REPLACE INTO {table} (data, chat_id, '
+                                   f'{"key" if table == "chat_data" else "dialog_id"}) VALUES (?, ?, ?)',
+                                   (chat_id, key))
+        for table, key in written.keys() - rows.keys():
+            cursor.execute(f'DELETE FROM {table} WHERE chat_id = ? AND '
+                           f'{"key" if table == "chat_data" else "dialog_id"} = ?', (chat_id, key))
+            digests[(table, key)] = None
+
+    def _write_conversation(self, name: str, key: bytes, state: Optional[bytes]):
+        with self._lock:
+            if state is None:
+                self._connection.execute('DELETE FROM conversations WHERE name = ? AND key = ?', (name, key))
+            else:
+                self._connection.execute('INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)',
+                                         (name, key, state))
+
+    def _delete_chat_rows(self, chat_id: int):
+        with self._lock:
+            self._written_chats.pop(chat_id, None)
+            with self._transaction() as cursor:
+                cursor.execute('DELETE FROM chat_data WHERE chat_id = ?', (chat_id,))
+                cursor.execute('DELETE FROM dialogs WHERE chat_id = ?', (chat_id,))
+
+    def _delete_user_data_row(self, user_id: int):
+        with self._lock:
+            self._written_user_data.pop(user_id, None)
+            self._connection.execute('DELETE FROM user_data WHERE user_id = ?', (user_id,))
+
+    @staticmethod
+    def _write_if_changed(cursor: sqlite3.Cursor, written: Dict, digests: Dict, key: Any, data: bytes, statement: str,
+                          parameters: Tuple):
+        """Writes the data unless its digest is the written one, the new digest is added to ``digests``"""
+        data_digest = digest(data)
+        if written.get(key) != data_digest:
+            cursor.execute(statement, (data, *parameters))
+            digests[key] = data_digest
+
+    @staticmethod
+    def _record_digests(written: Dict, digests: Dict):
+        """Records the digests of a committed transaction, None for deleted rows"""
+        for key, data_digest in digests.items():
+            if data_digest is None:
+                written.pop(key, None)
+            else:
+                written[key] = data_digest
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Cursor]:
+        cursor = self._connection.cursor()
+        cursor.execute('BEGIN')
+        try:
+            yield cursor
+        except BaseException:
+            cursor.execute('ROLLBACK')
+            raise
+        else:
+            cursor.execute('COMMIT')
+        finally:
+            cursor.close()
@@ -0,0 +1,4 @@
+from .ipc import shard_of
+from .peers import ShardPeers, get_peers, shard_call
+from .router import ShardRouter
+from .split import split_database
@@ -0,0 +1,46 @@
+import asyncio
+import os
+import pickle
+import struct
+from typing import Any, Dict, Optional
+
+# the kinds of updates that have no user (as for Update.effective_user), even if they carry a 'from' field
+userless_updates = {'channel_post', 'edited_channel_post', 'poll', 'chat_boost', 'removed_chat_boost',
+                    'message_reaction_count'}
+# frames are pickled tuples, prefixed with their length; they are only exchanged between the processes of one
+# deployment, over unix sockets in a directory that only the bot's user can access
+frame_header = struct.Struct('>I')
+
+
+def write_frame(writer: asyncio.StreamWriter, message: Any):
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    writer.write(frame_header.pack(len(data)) + data)
+
+
+async def read_frame(reader: asyncio.StreamReader) -> Any:
+    size, = frame_header.unpack(await reader.readexactly(frame_header.size))
+    return pickle.loads(await reader.readexactly(size))
+
+
+def socket_path(socket_dir: str, shard: int) -> str:
+    return os.path.join(socket_dir, f'shard{shard}.sock')
+
+
+def shard_of(key: int, count: int) -> int:
+    """The shard owning the given user (or chat) id"""
+    return key % count
+
+
+def update_owner(data: Dict) -> Optional[int]:
+    """The id of the user (or, if there is none, the chat) of an update as received from Telegram, the same as
+    ``update.effective_user.id`` (or ``update.effective_chat.id``) without decoding the update"""
+    kind = next((key for key in data if key != 'update_id'), None)
+    payload = data.get(kind)
+    if not isinstance(payload, dict):
+        return None
+    if kind not in userless_updates:
+        user = payload.get('user' if kind in ('poll_answer', 'message_reaction') else 'from')
+        if user is not None:
+            return user['id']
+    chat = payload['message'].get('chat') if kind == 'callback_query' and 'message' in payload else payload.get('chat')
+    return chat['id'] if chat is not None else None
@@ -0,0 +1,111 @@
+import asyncio
+import itertools
+import os
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+from telegram.ext import Application
+from sharding.ipc import read_frame, socket_path, write_frame
+
+# set by the router for the worker processes it starts
+SHARD_INDEX = int(os.environ['SHARD_INDEX']) if 'SHARD_INDEX' in os.environ else None
+SHARD_COUNT = int(os.environ['SHARD_COUNT']) if 'SHARD_COUNT' in os.environ else 1
+SHARD_SOCKET_DIR = os.environ['SHARD_SOCKET_DIR'] if 'SHARD_SOCKET_DIR' in os.environ else None
+SHARD_CALL_TIMEOUT = float(os.environ['SHARD_CALL_TIMEOUT']) if 'SHARD_CALL_TIMEOUT' in os.environ else 10.
+
+# the functions other shards may call, by name
+shard_calls: Dict[str, Callable] = {}
+
+
+def shard_call(func: Callable):
+    """Registers ``async func(application, *args)`` to be callable on every shard through :meth:`ShardPeers.gather`
+
+    Arguments and results are pickled.
+    """
+    shard_calls[func.__name__] = func
+    return func
+
+
+class ShardPeers:
+    """Calls the registered functions on all shards (including this one) of a sharded deployment
+
+    Connections to the other shards are opened when they are needed first. A shard that can't be reached or doesn't
+    answer within ``timeout`` seconds is left out of the results.
+    """
+
+    def __init__(self, index: int, count: int, socket_dir: str, timeout: float = SHARD_CALL_TIMEOUT):
+        self.index = index
+        self.count = count
+        self.socket_dir = socket_dir
+        self.timeout = timeout
+        self.application: Optional[Application] = None
+        self._ids = itertools.count()
+        self._pending: Dict[int, Tuple[int, asyncio.Future]] = {}
+        self._connections: Dict[int, Tuple[asyncio.StreamWriter, asyncio.Task]] = {}
+        self._connecting: Dict[int, asyncio.Lock] = {}
+
+    async def gather(self, name: str, *args) -> List[Any]:
+        results = await asyncio.gather(*(self.call(shard, name, *args) for shard in range(self.count)),
+                                       return_exceptions=True)
+        for shard, result in enumerate(results):
+            if isinstance(result, Exception):
+                print(f'shard {self.index}: calling {name} on shard {shard} failed: {result!r}')
+        return [result for result in results if not isinstance(result, Exception)]
+
+    async def call(self, shard: int, name: str, *args) -> Any:
+        if shard == self.index:
+            return await shard_calls[name](self.application, *args)
+        writer = await self._connection(shard)
+        call_id = next(self._ids)
+        future = asyncio.get_running_loop().create_future()
+        self._pending[call_id] = (shard, future)
+        try:
+            write_frame(writer, ('call', call_id, name, args))
+            await writer.drain()
+            return await asyncio.wait_for(future, self.timeout)
+        finally:
+            self._pending.pop(call_id, None)
+
+    async def close(self):
+        for writer, receiver in list(self._connections.values()):
+            receiver.cancel()
+            writer.close()
+        self._connections.clear()
+
+    async def _connection(self, shard: int) -> asyncio.StreamWriter:
+        lock = self._connecting.setdefault(shard, asyncio.Lock())
+        async with lock:
+            if shard not in self._connections:
+                reader, writer = await asyncio.open_unix_connection(socket_path(self.socket_dir, shard))
+                receiver = asyncio.get_running_loop().create_task(self._receive(shard, reader))
+                self._connections[shard] = (writer, receiver)
+            return self._connections[shard][0]
+
+    async def _receive(self, shard: int, reader: asyncio.StreamReader):
+        try:
+            while True:
+                _, call_id, error, result = await read_frame(reader)
+                _, future = self._pending.get(call_id, (None, None))
+                if future is None or future.done():
+                    continue
+                if error is not None:
+                    future.set_exception(RuntimeError(f'shard {shard}: {error}'))
+                else:
+                    future.set_result(result)
+        except (asyncio.IncompleteReadError, ConnectionError) as e:
+            writer, _ = self._connections.pop(shard, (None, None))
+            if writer is not None:
+                writer.close()
+            for pending_shard, future in list(self._pending.values()):
+                if pending_shard == shard and not future.done():
+                    future.set_exception(ConnectionError(f'lost the connection to shard {shard}: {e!r}'))
+
+
+_peers: Optional[ShardPeers] = None
+
+
+def get_peers() -> Optional[ShardPeers]:
+    """The other shards if this process is a shard worker, otherwise None"""
+    global _peers
+    if _peers is None and SHARD_INDEX is not None:
+        _peers = ShardPeers(SHARD_INDEX, SHARD_COUNT, SHARD_SOCKET_DIR)
+    return _peers
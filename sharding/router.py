@@ -0,0 +1,175 @@
+import asyncio
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Any, Dict, List, Optional
+
+from telegram import Update
+from telegram.ext import Application, CallbackContext
+from messaging.outbound import GLOBAL_RATE
+from sharding.ipc import shard_of, socket_path, update_owner, write_frame
+from sharding.split import split_database
+
+SHARD_START_TIMEOUT = float(os.environ['SHARD_START_TIMEOUT']) if 'SHARD_START_TIMEOUT' in os.environ else 120.
+SHARD_STOP_TIMEOUT = float(os.environ['SHARD_STOP_TIMEOUT']) if 'SHARD_STOP_TIMEOUT' in os.environ else 30.
+# the directory containing main.py, where the workers are started
+bot_directory = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class ShardRouter:
+    """Runs ``count`` shards in worker processes and forwards every update to the shard owning its user
+
+    Each shard has its own database (``<database_path>.shard<n>``) with the users of the shard, and runs their goal
+    checks. Updates without a user are routed by chat. If the shard databases don't exist yet, the unsharded database
+    is split into them. A shard whose process exits is started again.
+
+    The workers inherit the environment of the router, the global outbound rate is divided between them.
+    """
+
+    def __init__(self, count: int, database_path: str, journal_path: Optional[str] = None,
+                 start_timeout: float = SHARD_START_TIMEOUT, stop_timeout: float = SHARD_STOP_TIMEOUT,
+                 environment: Optional[Dict[str, str]] = None):
+        self.count = count
+        self.database_path = database_path
+        self.journal_path = journal_path
+        self.start_timeout = start_timeout
+        self.stop_timeout = stop_timeout
+        self.environment = dict(os.environ if environment is None else environment)
+        self.routed: List[int] = [0] * count
+        self.socket_dir: Optional[str] = None
+        self._processes: Dict[int, subprocess.Popen] = {}
+        self._writers: Dict[int, asyncio.StreamWriter] = {}
+        self._watchers: Dict[int, asyncio.Task] = {}
+        self._restarting: Dict[int, asyncio.Lock] = {}
+        self._stopping = False
+
+    def shard_path(self, shard: int) -> str:
+        return f'{self.database_path}.shard{shard}'
+
+    def shard_of_update(self, update: Update) -> int:
+        if update.effective_user is not None:
+            return shard_of(update.effective_user.id, self.count)
+        if update.effective_chat is not None:
+            return shard_of(update.effective_chat.id, self.count)
+        return 0
+
+    async def start(self, _: Optional[Application] = None):
+        shard_paths = [self.shard_path(shard) for shard in range(self.count)]
+        if not any(os.path.exists(path) for path in shard_paths) and os.path.exists(self.database_path):
+            print(f'router: splitting {self.database_path} into {self.count} shards')
+            split_database(self.database_path, shard_paths, self.journal_path)
+        self.socket_dir = tempfile.mkdtemp(prefix='driserbot-shards-')
+        for shard in range(self.count):
+            self._spawn(shard)
+        try:
+            await asyncio.gather(*(self._connect(shard) for shard in range(self.count)))
+        except (RuntimeError, TimeoutError):
+            for process in self._processes.values():
+                process.kill()
+            shutil.rmtree(self.socket_dir, ignore_errors=True)
+            raise
+        print(f'router: {self.count} shards ready')
+
+    async def route(self, update: Update, _: Optional[CallbackContext] = None):
+        await self._forward(self.shard_of_update(update), ('update', update.to_dict()), update.update_id)
+
+    async def route_data(self, data: Dict):
+        """Forwards an update as received from Telegram (e.g. by the webhook), which is only decoded by its shard"""
+        owner = update_owner(data)
+        await self._forward(shard_of(owner, self.count) if owner is not None else 0, ('update', data),
+                            data.get('update_id'))
+
+    async def _forward(self, shard: int, message: Any, update_id: Optional[int]):
+        for _ in range(2):
+            writer = self._writers.get(shard)
+            if writer is not None and not writer.is_closing():
+                try:
+                    write_frame(writer, message)
+                    await writer.drain()
+                    self.routed[shard] += 1
+                    return
+                except ConnectionError as e:
+                    print(f'router: lost the connection to shard {shard}: {e!r}')
+            await self._restart(shard)
+        print(f'router: dropped update {update_id}, shard {shard} is not available')
+
+    async def stop(self, _: Optional[Application] = None):
+        """Asks the shards to stop and waits for them to persist their state"""
+        self._stopping = True
+        for shard, writer in list(self._writers.items()):
+            try:
+                write_frame(writer, ('stop',))
+                await writer.drain()
+            except ConnectionError:
+                pass
+        loop = asyncio.get_running_loop()
+        for shard, process in self._processes.items():
+            try:
+                await loop.run_in_executor(None, process.wait, self.stop_timeout)
+            except subprocess.TimeoutExpired:
+                print(f'router: shard {shard} did not stop within {self.stop_timeout}s, terminating it')
+                process.terminate()
+        for watcher in self._watchers.values():
+            watcher.cancel()
+        for writer in self._writers.values():
+            writer.close()
+        shutil.rmtree(self.socket_dir, ignore_errors=True)
+        print(f'router: routed {sum(self.routed)} updates ({", ".join(str(n) for n in self.routed)} per shard)')
+
+    def _spawn(self, shard: int):
+        shard_path = self.shard_path(shard)
+        environment = dict(self.environment, SHARD_INDEX=str(shard), SHARD_COUNT=str(self.count),
+                           SHARD_SOCKET_DIR=self.socket_dir, DATABASE_PATH=shard_path,
+                           JOURNAL_PATH=f'{shard_path}.journal', OUTBOUND_GLOBAL_RATE=str(GLOBAL_RATE / self.count))
+        if 'METRICS_PORT' in self.environment:
+            # the router serves its metrics on the configured port, the shards on the following ones
+            environment['METRICS_PORT'] = str(int(self.environment['METRICS_PORT']) + 1 + shard)
+        self._processes[shard] = subprocess.Popen([sys.executable, '-m', 'sharding.worker'], env=environment,
+                                                  cwd=bot_directory)
+
+    async def _connect(self, shard: int):
+        deadline = time.monotonic() + self.start_timeout
+        while True:
+            exit_code = self._processes[shard].poll()
+            if exit_code is not None:
+                raise RuntimeError(f'Shard {shard} exited with code {exit_code} while starting')
+            try:
+                reader, writer = await asyncio.open_unix_connection(socket_path(self.socket_dir, shard))
+                break
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise TimeoutError(f'Shard {shard} did not start within {self.start_timeout}s')
+                await asyncio.sleep(0.1)
+        self._writers[shard] = writer
+        self._watchers[shard] = asyncio.get_running_loop().create_task(self._watch(shard, reader))
+
+    async def _watch(self, shard: int, reader: asyncio.StreamReader):
+        # shards never send anything to the router, the connection only ends if the shard does
+        await reader.read()
+        self._writers[shard].close()
+        if not self._stopping:
+            print(f'router: shard {shard} has gone away')
+            await self._restart(shard)
+
+    async def _restart(self, shard: int):
+        lock = self._restarting.setdefault(shard, asyncio.Lock())
+        async with lock:
+            writer = self._writers.get(shard)
+            if self._stopping or (writer is not None and not writer.is_closing()
+                                  and self._processes[shard].poll() is None):
+                return
+            if writer is not None:
+                writer.close()
+            process = self._processes[shard]
+            if process.poll() is None:
+                process.kill()
+                await asyncio.get_running_loop().run_in_executor(None, process.wait)
+            print(f'router: restarting shard {shard} (exit code {process.returncode})')
+            self._spawn(shard)
+            try:
+                await self._connect(shard)
+            except (RuntimeError, TimeoutError) as e:
+                print(f'router: {e}')
@@ -0,0 +1,39 @@
+import os
+from typing import List, Optional
+from sharding.ipc import shard_of
+
+
+def split_database(database_path: str, shard_paths: List[str], journal_path: Optional[str] = None):
+    """Distributes the state of an unsharded database over the databases of the shards
+
+    Users, their private chats and user data go to the shard owning the user. Group chats are copied to every shard,
+    with their registered users reduced to those of the shard. The source database is left unchanged.
+    """
+    # imported here, the shard workers import the sharding package before the model
+    from model import UserList
+    from persistence import SQLitePersistence, BotData
+
+    source = SQLitePersistence(database_path,
+                               journal_path=journal_path if journal_path and os.path.exists(journal_path) else None)
+    bot_data = source.load_bot_data()
+    chat_data = source.load_chat_data()
+    user_data = source.load_user_data()
+    count = len(shard_paths)
+
+    for shard, path in enumerate(shard_paths):
+        target = SQLitePersistence(path)
+        users = UserList(user for user in bot_data['users'] if shard_of(user.id, count) == shard)
+        target.save_bot_data(BotData(bot_data, users=users))
+        for chat_id, data in chat_data.items():
+            # private chats have the id of their user, groups have negative ids
+            if chat_id > 0 and shard_of(chat_id, count) != shard:
+                continue
+            if 'users' in data:
+                data = dict(data, users={uid for uid in data['users'] if shard_of(uid, count) == shard})
+            target.save_chat_data(chat_id, data)
+        for user_id, data in user_data.items():
+            if shard_of(user_id, count) == shard:
+                target.save_user_data(user_id, data)
+        target.close()
+        print(f'Moved {len(users)} users to {path}')
+    source.close()
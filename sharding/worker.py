@@ -0,0 +1,105 @@
+import asyncio
+import os
+from typing import Optional, Set
+
+from telegram import Update
+from telegram.ext import Application
+from sharding.ipc import read_frame, socket_path, write_frame
+from sharding.peers import SHARD_INDEX, SHARD_SOCKET_DIR, get_peers, shard_calls
+
+
+class ShardWorker:
+    """Serves the unix socket of a shard
+
+    Updates routed to the shard are put into the update queue of the application, calls of other shards are answered
+    with the result of the registered function (see :func:`sharding.shard_call`). The router sends ``stop`` to shut
+    the worker down, which sets :attr:`stopped`.
+    """
+
+    def __init__(self, application: Application, index: int, socket_dir: str):
+        self.application = application
+        self.index = index
+        self.socket_dir = socket_dir
+        self.stopped = asyncio.Event()
+        self._server: Optional[asyncio.AbstractServer] = None
+        self._connections: Set[asyncio.StreamWriter] = set()
+        self._answering: Set[asyncio.Task] = set()
+
+    async def start(self):
+        # the router considers the shard ready once it can connect
+        self._server = await asyncio.start_unix_server(self._serve_connection, socket_path(self.socket_dir, self.index))
+        print(f'shard {self.index}: ready with {len(self.application.bot_data["users"])} users')
+
+    async def stop(self, timeout: Optional[float] = None):
+        self._server.close()
+        for writer in list(self._connections):
+            writer.close()
+        await self._server.wait_closed()
+        if len(self._answering) > 0:
+            await asyncio.wait(self._answering, timeout=timeout)
+        await get_peers().close()
+
+    async def watch_parent(self):
+        """Stops the worker if the router process is gone"""
+        parent = os.getppid()
+        while not self.stopped.is_set():
+            if os.getppid() != parent:
+                print(f'shard {self.index}: the router has exited, stopping')
+                self.stopped.set()
+            await asyncio.sleep(1)
+
+    async def _serve_connection(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._connections.add(writer)
+        try:
+            while True:
+                message = await read_frame(reader)
+                if message[0] == 'update':
+                    await self.application.update_queue.put(Update.de_json(message[1], self.application.bot))
+                elif message[0] == 'call':
+                    task = asyncio.get_running_loop().create_task(self._answer(writer, *message[1:]))
+                    self._answering.add(task)
+                    task.add_done_callback(self._answering.discard)
+                elif message[0] == 'stop':
+                    self.stopped.set()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self._connections.discard(writer)
+            writer.close()
+
+    async def _answer(self, writer: asyncio.StreamWriter, call_id: int, name: str, args: tuple):
+        try:
+            result, error = await shard_calls[name](self.application, *args), None
+        except Exception as e:
+            print(f'shard {self.index}: {name}{args} failed: {e!r}')
+            result, error = None, repr(e)
+        try:
+            write_frame(writer, ('result', call_id, error, result))
+            await writer.drain()
+        except ConnectionError:
+            pass
+
+
+async def serve_shard(application: Application, worker: ShardWorker):
+    from main import serve
+    watcher = asyncio.get_running_loop().create_task(worker.watch_parent())
+    try:
+        await serve(application, worker, worker.stopped)
+    finally:
+        watcher.cancel()
+
+
+def run_worker():
+    # the bot's handlers and configuration, the router passes the shard's database paths in the environment
+    from main import build_application
+    from persistence import SQLitePersistence
+
+    persistence = SQLitePersistence(os.environ['DATABASE_PATH'], journal_path=os.environ['JOURNAL_PATH'])
+    application = build_application(persistence, updater=False)
+    get_peers().application = application
+    asyncio.run(serve_shard(application, ShardWorker(application, SHARD_INDEX, SHARD_SOCKET_DIR)))
+    persistence.close()
+
+
+if __name__ == '__main__':
+    run_worker()
@@ -1 +1,2 @@
 from .evaluation import get_user_stats, handle_stats
+from .rendering import ChartRenderer, RendererBusy, get_renderer
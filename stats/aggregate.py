@@ -0,0 +1,136 @@
+import os
+from collections import OrderedDict
+from typing import Dict, List, Optional, Set, Tuple
+
+from telegram.ext import Application
+from common import goal_score_types, markdown_v2_escape
+from model import Goal, User, UserList
+
+# the number of groups whose stats are kept up to date, the least recently requested ones are dropped first
+GROUP_STATS_CACHE_SIZE = int(os.environ['STATS_GROUP_CACHE_SIZE']) if 'STATS_GROUP_CACHE_SIZE' in os.environ \
+    else 1024
+
+score_formats = {
+    goal_score_types[0]: " streak of {score} {interval}",
+    goal_score_types[1]: "{score:.2f} % (for the last {range} {interval})",
+    goal_score_types[2]: "{score}/{range:d} {interval}"
+}
+wide_hyphen = '－'
+
+
+def goal_fragments(goal: Goal) -> Tuple[str, str]:
+    """The title and the score of a goal, escaped for MarkdownV2"""
+    try:
+        score_text = '[no data yet]' if len(goal.times) == 0 else score_formats[goal.score_type].format(
+            score=goal.score_at(-1, goal.score_type),
+            range=min(goal.score_range, len(goal.times)),
+            interval=goal.schedule.interval)
+    except ValueError as e:
+        score_text = "<error>"
+        print(e)
+    return markdown_v2_escape(goal.title), markdown_v2_escape(score_text)
+
+
+def format_goal_lines(fragments: List[Tuple[str, str]], bullet_string: str = '-', numbered_offset: int = -1,
+                      last_bullet_string: Optional[str] = None) -> str:
+    bullet = markdown_v2_escape(bullet_string)
+    last_bullet = bullet if last_bullet_string is None else markdown_v2_escape(last_bullet_string)
+    return ''.join(f"{last_bullet if idx == len(fragments) - 1 else bullet}"
+                   f"{'' if numbered_offset == -1 else str(idx + numbered_offset)} *{title}*  {score}\n"
+                   for idx, (title, score) in enumerate(fragments))
+
+
+class MemberStats:
+    """The part of a user in the stats of a group, with the text pre-escaped for MarkdownV2"""
+    __slots__ = ('user_id', 'header', 'fragments', 'goals')
+
+    def __init__(self, user: User):
+        self.user_id = user.id
+        user_name = '<unknown>' if user.name == '' else user.name
+        self.header = f"꜒ *[{markdown_v2_escape(user_name)}](tg://user?id={user.id})*:\n" + \
+            markdown_v2_escape(f"꜔{wide_hyphen * int(len(user.name) / 2)}{wide_hyphen * 2}\n")
+        self.fragments = [goal_fragments(goal) for goal in user.goals]
+        self.goals = list(user.goals)
+
+    def render(self, numbered_offset: int) -> str:
+        return self.header + format_goal_lines(self.fragments, '꜔', numbered_offset, '꜖') + \
+            markdown_v2_escape("\n")
+
+
+class GroupStatsIndex:
+    """Keeps the stats of the registered users of each group (of this shard) up to date
+
+    The stats of a member are calculated when the group's stats are requested first and only calculated again once
+    the user has changed (see :meth:`UserList.mark_dirty`, which is called for every new answer and every added or
+    removed goal) or has been registered for the group again.
+    """
+
+    def __init__(self, max_groups: int = GROUP_STATS_CACHE_SIZE):
+        self.max_groups = max_groups
+        # member ids (in ascending order) and their stats by group, None if the stats have to be calculated again
+        self._groups: OrderedDict[int, Dict[int, Optional[MemberStats]]] = OrderedDict()
+        self._groups_of_user: Dict[int, Set[int]] = {}
+        self._users: Optional[UserList] = None
+
+    def members(self, application: Application, chat_id: int) -> Tuple[List[MemberStats], List[int]]:
+        """The stats of the users registered for the group and the ids of registered users that are unknown"""
+        users: UserList = application.bot_data['users']
+        if users is not self._users:
+            self.clear()
+            users.add_listener(self.user_changed)
+            self._users = users
+        group = self._groups.get(chat_id)
+        if group is None:
+            group = self._add_group(chat_id, application.chat_data.get(chat_id, {}).get('users', ()))
+        else:
+            self._groups.move_to_end(chat_id)
+
+        members, unknown = [], []
+        for uid, stats in group.items():
+            if uid not in users:
+                unknown.append(uid)
+                continue
+            if stats is None:
+                stats = group[uid] = MemberStats(users[uid])
+            members.append(stats)
+        return members, unknown
+
+    def user_changed(self, user_id: int):
+        for chat_id in self._groups_of_user.get(user_id, ()):
+            self._groups[chat_id][user_id] = None
+
+    def registration_changed(self, chat_id: int, user_id: int, registered: bool):
+        group = self._groups.get(chat_id)
+        if group is None:
+            return
+        if registered:
+            group[user_id] = None
+            self._groups[chat_id] = dict(sorted(group.items()))
+            self._groups_of_user.setdefault(user_id, set()).add(chat_id)
+        else:
+            group.pop(user_id, None)
+            self._discard_member(chat_id, user_id)
+
+    def clear(self):
+        self._groups.clear()
+        self._groups_of_user.clear()
+
+    def _add_group(self, chat_id: int, member_ids) -> Dict[int, Optional[MemberStats]]:
+        group = self._groups[chat_id] = {uid: None for uid in sorted(member_ids)}
+        for uid in group:
+            self._groups_of_user.setdefault(uid, set()).add(chat_id)
+        while len(self._groups) > self.max_groups:
+            removed_id, removed = self._groups.popitem(last=False)
+            for uid in removed:
+                self._discard_member(removed_id, uid)
+        return group
+
+    def _discard_member(self, chat_id: int, user_id: int):
+        chats = self._groups_of_user.get(user_id)
+        if chats is not None:
+            chats.discard(chat_id)
+            if len(chats) == 0:
+                del self._groups_of_user[user_id]
+
+
+group_stats = GroupStatsIndex()
@@ -0,0 +1,130 @@
+from datetime import datetime, timedelta
+from io import BytesIO
+from typing import List, Dict
+
+import numpy as np
+from matplotlib.backends.backend_agg import FigureCanvasAgg
+from matplotlib.figure import Figure
+import matplotlib.dates as mdates
+from stats.chart_data import ChartData, ChartFormat, chart_formats
+
+
+def find_averages(all_goals_data: List[Dict[str, np.ndarray]], x_samples: np.ndarray, x_min: float) -> np.ndarray:
+    """Averages the (linearly interpolated) scores of all goals at each of the given timestamps
+
+    Goals are skipped for timestamps before their first data point and hold their last value after it. All goal series
+    are concatenated (each shifted into its own time range), so a single ``searchsorted`` finds the interpolation
+    brackets for all goals and samples.
+    """
+    goals = [goal for goal in all_goals_data if len(goal['x']) > 0]
+    if len(goals) == 0 or len(x_samples) == 0:
+        return np.zeros(len(x_samples))
+
+    lengths = np.array([len(goal['x']) for goal in goals])
+    ends = np.cumsum(lengths)[:, None]
+    starts = ends - lengths[:, None]
+    xs = np.concatenate([goal['x'] for goal in goals]).astype(float)
+    ys = np.concatenate([goal['y'] for goal in goals]).astype(float)
+
+    origin = min(xs.min(), x_samples.min())
+    span = max(xs.max(), x_samples.max()) - origin + 1.
+    offsets = np.arange(len(goals)) * span
+    keys = xs - origin + np.repeat(offsets, lengths)
+    sample_keys = (x_samples - origin)[None, :] + offsets[:, None]
+
+    positions = np.searchsorted(keys, sample_keys, side='right')
+    lower = np.clip(positions - 1, starts, ends - 1)
+    upper = np.clip(positions, starts, ends - 1)
+    x_0, x_1, y_0, y_1 = keys[lower], keys[upper], ys[lower], ys[upper]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        values = np.where(x_1 > x_0, y_0 + (y_1 - y_0) / (x_1 - x_0) * (sample_keys - x_0), y_0)
+
+    before_first = positions == starts
+    after_last = sample_keys > keys[ends - 1]
+    values = np.where(after_last, ys[ends - 1], values)
+    included = ~before_first & ~(after_last & (xs[starts] < x_min))
+
+    counts = included.sum(axis=0)
+    summed = np.where(included, values, 0.).sum(axis=0)
+    return np.divide(summed, counts, out=np.zeros(len(x_samples)), where=counts > 0)
+
+
+def find_average(all_goals_data: List[Dict[str, np.ndarray]], x_curr: float, x_min: float) -> float:
+    return float(find_averages(all_goals_data, np.array([x_curr], dtype=float), x_min)[0])
+
+
+def render_chart(chart: ChartData, chart_format: ChartFormat = ChartFormat()) -> bytes:
+    if chart_format.image_format not in chart_formats:
+        raise ValueError(f'Unsupported chart format: {chart_format.image_format} (supported: {chart_formats})')
+    # The object oriented API is used instead of pyplot, so no global figure state is kept (and leaked) per render
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.subplots()
+    now = datetime.fromtimestamp(chart.created)
+    x_min = now
+    x_max = datetime(1970, 1, 1)
+
+    line_offset = 0.01
+    all_goals_data = []
+    plots = {}
+    goal_count = chart.goal_count
+
+    for idx, label, times, scores in zip(chart.indices, chart.labels, chart.times, chart.scores):
+        data = {'x': np.array(times), 'y': np.array(scores)}
+        all_goals_data.append(data)
+        plots[idx] = ax.plot([datetime.fromtimestamp(t) for t in times],
+                             data['y'] - (line_offset * idx) + (line_offset * 0.5 * goal_count),
+                             label=label, alpha=0.7)
+        if datetime.fromtimestamp(times[0]) < x_min:
+            x_min = datetime.fromtimestamp(times[0])
+        if datetime.fromtimestamp(times[-1]) > x_max:
+            x_max = datetime.fromtimestamp(times[-1])
+
+    for idx, hidden_label, times, scores in zip(chart.indices, chart.hidden_labels, chart.times, chart.scores):
+        latest_ts = datetime.fromtimestamp(times[-1])
+        if x_max > latest_ts:
+            latest_val = scores[-1]
+            ax.plot([latest_ts, x_max],
+                    [latest_val - (line_offset * idx) + (line_offset * 0.5 * goal_count) for _ in range(2)],
+                    label=hidden_label, alpha=0.5, linestyle='dashed', color=plots[idx][0].get_color())
+
+    x_min_ts = min((times[0] for times in chart.times), default=x_min.timestamp())
+    x_max_ts = max((times[-1] for times in chart.times), default=x_max.timestamp())
+    avg_interval = max((x_max - x_min) / 100, timedelta(hours=1))
+    x_samples = np.append(np.arange(x_min_ts, x_max_ts, avg_interval.total_seconds()), x_max_ts)
+    averages = {'x': [datetime.fromtimestamp(x) for x in x_samples],
+                'y': find_averages(all_goals_data, x_samples, x_min_ts)}
+    ax.fill_between(averages['x'], averages['y'], color=[(0.8, 0.1, 0.1, 0.1)], edgecolor=[(0.8, 0.1, 0.1, 0.3)])
+
+    if chart.days <= 100:
+        ax.xaxis.set_major_locator(mdates.DayLocator())
+        ax.xaxis.set_minor_locator(mdates.HourLocator(byhour=range(4, 24, 4)))
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%d. %m'))
+    else:
+        # a tick per day would be unreadable for ranges longer than about 100 days
+        ax.xaxis.set_major_locator(mdates.AutoDateLocator())
+        ax.xaxis.set_major_formatter(mdates.DateFormatter('%m. %Y' if chart.days > 2 * 365 else '%d. %m. %Y'))
+    ax.set_xlim(left=max(now - timedelta(days=chart.days), x_min), right=x_max)
+    ax.set_ylim(bottom=0, top=1.1)
+
+    fig.subplots_adjust(bottom=0.3, wspace=0.33)
+    ax.legend(bbox_to_anchor=(0.5, -0.2), fancybox=False, shadow=False, ncol=min(4, goal_count), loc='upper center')
+    ax.set_xlabel('time')
+    ax.set_ylabel('score')
+    fig.autofmt_xdate()
+
+    buffer = BytesIO()
+    if chart_format.image_format == 'webp':
+        # matplotlib only writes webp itself from 3.6 on, so the chart is re-encoded from png with pillow
+        from PIL import Image
+        fig.savefig(buffer, format='png', bbox_inches='tight', dpi=chart_format.dpi)
+        buffer.seek(0)
+        image = Image.open(buffer)
+        buffer = BytesIO()
+        image.save(buffer, format='webp', quality=chart_format.quality)
+    else:
+        # png is written by agg directly and has no quality setting
+        pil_kwargs = {'quality': chart_format.quality} if chart_format.image_format == 'jpeg' else None
+        fig.savefig(buffer, format=chart_format.image_format, bbox_inches='tight', dpi=chart_format.dpi,
+                    pil_kwargs=pil_kwargs)
+    return buffer.getvalue()
@@ -0,0 +1,29 @@
+import os
+from array import array
+from typing import List, NamedTuple
+
+
+CHART_FORMAT = os.environ['STATS_CHART_FORMAT'] if 'STATS_CHART_FORMAT' in os.environ else 'jpeg'
+CHART_QUALITY = int(os.environ['STATS_CHART_QUALITY']) if 'STATS_CHART_QUALITY' in os.environ else 85
+CHART_DPI = int(os.environ['STATS_CHART_DPI']) if 'STATS_CHART_DPI' in os.environ else 150
+# the number of days shown by default (/stats <days> shows another range)
+CHART_DAYS = float(os.environ['STATS_CHART_DAYS']) if 'STATS_CHART_DAYS' in os.environ else 100.
+chart_formats = ['jpeg', 'png', 'webp']
+
+
+class ChartFormat(NamedTuple):
+    image_format: str = CHART_FORMAT
+    quality: int = CHART_QUALITY
+    dpi: int = CHART_DPI
+
+
+class ChartData(NamedTuple):
+    """Everything needed to render a stats chart. Small and picklable, so it can be sent to a rendering process."""
+    labels: List[str]
+    hidden_labels: List[str]
+    indices: List[int]
+    times: List[array]
+    scores: List[array]
+    goal_count: int
+    created: float
+    days: float = CHART_DAYS
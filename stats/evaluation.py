@@ -1,212 +1,227 @@
-import re
-from datetime import datetime, timedelta
-import tempfile
-
-import setuptools.msvc
-from matplotlib import pyplot, ticker, use as mpl_use, transforms as mpl_transforms, colors as mpl_colors
-import matplotlib.dates as mdates
-from telegram import Update, ParseMode
-from telegram.ext import CallbackContext
-from common import goal_score_types, markdown_v2_escape
+import asyncio
+import os
+import time
+from collections import OrderedDict
+from concurrent.futures.process import BrokenProcessPool
+from datetime import datetime
+from threading import Lock
+
+from telegram import Update
+from telegram.constants import ParseMode
+from telegram.error import BadRequest
+from telegram.ext import Application, CallbackContext
+from common import markdown_v2_escape
 from model import User, Goal
+from model.GoalRollups import resolution_days, resolutions
 from interactions import authorized
-from typing import List, Dict, Union
-
-
-mpl_use('Agg')
-
-
-def find_average(all_goals_data: List[Dict[str, List[Union[datetime, float]]]], x_curr: datetime, x_min: datetime) -> float:
-    summed = 0
-    count = 0
-    for goal in all_goals_data:
-        xs = goal['x']
-        ys = goal['y']
-        if xs[0] > x_curr or len(xs) == 0:
-            continue
-
-        if xs[-1] < x_curr:
-            if xs[0] >= x_min:
-                count += 1
-                summed += ys[-1]
-            continue
-
-        if xs[0] == x_curr:
-            count += 1
-            summed += ys[0]
-            continue
-        elif xs[-1] == x_curr:
-            count += 1
-            summed += ys[-1]
-            continue
-
-        bounds = next((i, i+1) for i, (x0, x1) in enumerate(zip(xs[:-1], xs[1:])) if x0 <= x_curr <= x1)
-        y_0 = ys[bounds[0]]
-        y_1 = ys[bounds[1]]
-        x_0 = xs[bounds[0]]
-        x_1 = xs[bounds[1]]
-        interpolation = ((y_1 - y_0) / (x_1 - x_0).total_seconds()) * (x_curr - x_0).total_seconds() + y_0
-        summed += interpolation
-        count += 1
-
-    if count == 0:
-        return 0
-
-    return summed / count
-
-
-def generate_graph(goals: List[Goal], legend_full_goal_title=True) -> str:
-    fig, ax = pyplot.subplots()
-    x_min = datetime.now()
-    x_max = datetime(1970, 1, 1)
-
-    line_offset = 0.01
-    all_goals_data = []
-    plots = {}
-
+from sharding import get_peers, shard_call
+from stats.aggregate import MemberStats, format_goal_lines, goal_fragments, group_stats
+from stats.chart_data import CHART_DAYS, ChartData
+from stats.rendering import get_renderer, RendererBusy
+from typing import List, Optional, Tuple
+
+
+# opt-in debug mode: additionally writes every rendered chart to this directory
+CHART_DEBUG_DIR = os.environ['STATS_CHART_DEBUG_DIR'] if 'STATS_CHART_DEBUG_DIR' in os.environ else None
+CHART_CACHE_SIZE = int(os.environ['STATS_CACHE_SIZE']) if 'STATS_CACHE_SIZE' in os.environ else 256
+CHART_CACHE_TTL = float(os.environ['STATS_CACHE_TTL']) if 'STATS_CACHE_TTL' in os.environ else 3600.
+CHART_CACHE_BYTES = int(os.environ['STATS_CACHE_BYTES']) if 'STATS_CACHE_BYTES' in os.environ else 1024 * 1024
+# charts of longer ranges show the goals per day, week or month, so that no more periods than this are charted
+CHART_MAX_PERIODS = int(os.environ['STATS_CHART_MAX_PERIODS']) if 'STATS_CHART_MAX_PERIODS' in os.environ else 200
+
+
+class ChartCache:
+    """Remembers the Telegram file ids of charts that have already been uploaded
+
+    Charts are keyed by the goals they show, the version of their data and the day they have been rendered on (the
+    charted range ends at the time of rendering), so a cached chart is only reused on the same day while none of the
+    goals has changed. Entries are evicted least recently used first, once they are older than ``ttl`` seconds, or
+    when the (approximate) memory used by the cache exceeds ``max_bytes``.
+    """
+
+    def __init__(self, max_entries: int = CHART_CACHE_SIZE, ttl: float = CHART_CACHE_TTL,
+                 max_bytes: int = CHART_CACHE_BYTES):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._entries: OrderedDict[Tuple, Tuple[str, float, int]] = OrderedDict()
+        self._lock = Lock()
+
+    @staticmethod
+    def key(goals: List[Goal], legend_full_goal_title: bool, days: float = CHART_DAYS) -> Tuple:
+        # data is only ever added, which changes the length, the last time or (once trimmed) the first time
+        return (legend_full_goal_title, days, datetime.now().toordinal()) + tuple(
+            (goal.chat_id, goal.key, goal.score_range, len(goal.times),
+             goal.times[0] if len(goal.times) > 0 else None, goal.times[-1] if len(goal.times) > 0 else None)
+            for goal in goals)
+
+    def get(self, key: Tuple) -> Optional[str]:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            file_id, created, size = self._entries[key]
+            if time.monotonic() - created > self.ttl:
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+            return file_id
+
+    def put(self, key: Tuple, file_id: str):
+        size = len(file_id) + sum(len(goal[1]) + 128 for goal in key[3:]) + 128
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (file_id, time.monotonic(), size)
+            self.size += size
+            while len(self._entries) > self.max_entries or self.size > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+
+    def discard(self, key: Tuple):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def _remove(self, key: Tuple):
+        self.size -= self._entries.pop(key)[2]
+
+
+chart_cache = ChartCache()
+
+
+def chart_resolution(days: float) -> Optional[str]:
+    """The data points themselves are charted for short ranges, longer ones are charted per day, week or month"""
+    if days <= CHART_MAX_PERIODS:
+        return None
+    return next((resolution for resolution in resolutions if days / resolution_days[resolution] <= CHART_MAX_PERIODS),
+                resolutions[-1])
+
+
+def collect_chart_data(goals: List[Goal], legend_full_goal_title=True, days: float = CHART_DAYS) -> ChartData:
     def shorten_string(s_in, max_len=13):
         if len(s_in) < max_len:
             return s_in
         part_len = int((max_len - 1) / 2)
         return f'${s_in[:part_len]}\u2026${s_in[-part_len:]}'
 
+    now = datetime.now().timestamp()
+    resolution = chart_resolution(days)
+    labels, hidden_labels, indices, times, scores = [], [], [], [], []
     for idx, goal in enumerate(goals):
-        if len(goal.data) == 0:
-            continue
-        data = {'x': [], 'y': []}
-        for dp in goal.data:
-            data['x'].append(datetime.fromtimestamp(dp['time']))
-            data['y'].append(dp['score'][goal_score_types[1]])
-        all_goals_data.append(data)
-        plots[idx] = ax.plot(data['x'],
-                             [val - (line_offset * idx) + (line_offset * 0.5 * len(goals)) for val in data['y']],
-                             label=f"${idx} - ${goal.title if legend_full_goal_title else shorten_string(goal.title)}",
-                             alpha=0.7)
-        if datetime.fromtimestamp(goal.data[0]['time']) < x_min:
-            x_min = datetime.fromtimestamp(goal.data[0]['time'])
-        if datetime.fromtimestamp(goal.data[-1]['time']) > x_max:
-            x_max = datetime.fromtimestamp(goal.data[-1]['time'])
-
-    for idx, goal in enumerate(goals):
-        if len(goal.data) == 0:
+        goal_times, goal_scores = goal.chart_series(now - days * 24 * 3600, resolution)
+        if len(goal_times) == 0:
             continue
-        latest_ts = datetime.fromtimestamp(goal.data[-1]['time'])
-        if x_max > latest_ts:
-            latest_val = goal.data[-1]['score'][goal_score_types[1]]
-            ax.plot([latest_ts, x_max],
-                    [latest_val - (line_offset * idx) + (line_offset * 0.5 * len(goals)) for _ in range(2)],
-                    label=f'_${goal.title}' if legend_full_goal_title else f'_${idx}', alpha=0.5, linestyle='dashed',
-                    color=plots[idx][0].get_color())
-
-    x_curr = x_min
-    averages = {'x': [], 'y': []}
-    avg_interval = max((x_max - x_min) / 100, timedelta(hours=1))
-
-    while x_curr < x_max:
-        averages['x'].append(x_curr)
-        averages['y'].append(find_average(all_goals_data, x_curr, x_min))
-        x_curr = x_curr + avg_interval
-    averages['x'].append(x_max)
-    averages['y'].append(find_average(all_goals_data, x_max, x_min))
-    ax.fill_between(averages['x'], averages['y'], color=[(0.8, 0.1, 0.1, 0.1)], edgecolor=[(0.8, 0.1, 0.1, 0.3)])
-
-    ax.xaxis.set_major_locator(mdates.DayLocator())
-    ax.xaxis.set_minor_locator(mdates.HourLocator(byhour=range(4, 24, 4)))
-    ax.xaxis.set_major_formatter(mdates.DateFormatter('%d. %m'))
-    ax.set_xlim(left=max(datetime.now() - timedelta(days=100), x_min), right=x_max)
-    ax.set_ylim(bottom=0, top=1.1)
-
-    fig.subplots_adjust(bottom=0.3, wspace=0.33)
-    pyplot.legend(bbox_to_anchor=(0.5, -0.2), fancybox=False, shadow=False, ncol=min(4, len(goals)), loc='upper center')
-    pyplot.xlabel('time')
-    pyplot.ylabel('score')
-    fig.autofmt_xdate()
-
-    fig_path = tempfile.mktemp('.jpg')
-    fig.savefig(fig_path, bbox_inches='tight', dpi=150)
-    return fig_path
+        indices.append(idx)
+        labels.append(f"${idx} - ${goal.title if legend_full_goal_title else shorten_string(goal.title)}")
+        hidden_labels.append(f'_${goal.title}' if legend_full_goal_title else f'_${idx}')
+        times.append(goal_times)
+        scores.append(goal_scores)
+    return ChartData(labels, hidden_labels, indices, times, scores, len(goals), now, days)
+
+
+async def generate_graph(goals: List[Goal], legend_full_goal_title=True, days: float = CHART_DAYS) -> bytes:
+    renderer = get_renderer()
+    chart = await renderer.render(collect_chart_data(goals, legend_full_goal_title, days))
+    if CHART_DEBUG_DIR is not None:
+        fig_path = os.path.join(CHART_DEBUG_DIR, f'stats_{time.time_ns()}.{renderer.chart_format.image_format}')
+        with open(fig_path, 'wb') as f:
+            f.write(chart)
+        print(f'chart written to {fig_path}')
+    return chart
+
+
+async def reply_with_stats(update: Update, goals: List[Goal], text: str, legend_full_goal_title: bool,
+                           days: float = CHART_DAYS):
+    cache_key = chart_cache.key(goals, legend_full_goal_title, days)
+    file_id = chart_cache.get(cache_key)
+    if file_id is not None:
+        try:
+            await update.message.reply_photo(file_id, caption=text, parse_mode=ParseMode.MARKDOWN_V2)
+            return
+        except BadRequest as e:
+            print(f'cached chart could not be sent: {e!r}')
+            chart_cache.discard(cache_key)
+
+    try:
+        chart = await generate_graph(goals, legend_full_goal_title, days)
+    except RendererBusy:
+        print('chart renderer is busy, sending stats without chart')
+        chart = None
+    except (asyncio.TimeoutError, BrokenProcessPool) as e:
+        print(f'rendering the stats chart failed: {e!r}')
+        chart = None
+    if chart is None:
+        await update.message.reply_text(text, parse_mode=ParseMode.MARKDOWN_V2)
+    else:
+        message = await update.message.reply_photo(chart, caption=text, parse_mode=ParseMode.MARKDOWN_V2)
+        if message is not None and len(message.photo) > 0:
+            chart_cache.put(cache_key, message.photo[-1].file_id)
 
 
 def get_user_stats(user: User, bullet_string='-', numbered_offset=-1):
     goals = user.goals
     print(goals)
-    stats = {goal: goal.data[-1]['score'][goal.score_type] if len(goal.data) > 0 else 0 for goal in goals}
-    stats_text = ""
-
-    score_formats = {
-        goal_score_types[0]: " streak of {score} {interval}",
-        goal_score_types[1]: "{score:.2f} % (for the last {range} {interval})",
-        goal_score_types[2]: "{score}/{range:d} {interval}"
-    }
-    for idx, goal in enumerate(goals):
-        try:
-            interval = 'intervals'
-
-            print(f'{goal.title}: {goal.cron}')
-            if re.fullmatch(r'\*(/0*1)? \* \* \* \*', goal.cron) is not None:
-                interval = 'minutes'
-            elif re.fullmatch(r'(\*|\d+)(/0*1)? \*(/0*1)? \* \* \*', goal.cron) is not None:
-                interval = 'hours'
-            elif re.fullmatch(r'(\*|\d+)(/0*1)? (\*|\d+)(/0*1)? \*(/0*1)? \* \*', goal.cron) is not None:
-                interval = 'days'
-            elif re.fullmatch(r'(\*|\d+)(/0*1)? (\*|\d+)(/0*1)? (\*|\d+)(/0*1)? \*(/0*1)? \*', goal.cron) is not None:
-                interval = 'months'
-            elif re.fullmatch(r'(\*|\d+)(/0*1)? (\*|\d+)(/0*1)? (\*|\d+)(/0*1)? \* [a-zA-Z]+', goal.cron) is not None:
-                interval = 'weeks'
-
-            score_escaped = '[no data yet]' if len(goal.data) == 0 else score_formats[goal.score_type].format(
-                score=stats[goal],
-                range=min(goal.score_range, len(goal.data)),
-                interval=interval)
-        except ValueError as e:
-            score_escaped = "<error>"
-            print(e)
-        score_escaped = markdown_v2_escape(score_escaped)
-        stats_text += f"{markdown_v2_escape(bullet_string)}" \
-                      f"{'' if numbered_offset == -1 else str(idx + numbered_offset)} *{markdown_v2_escape(goal.title)}*  "
-        stats_text += score_escaped
-        stats_text += "\n"
+    stats_text = format_goal_lines([goal_fragments(goal) for goal in goals], bullet_string, numbered_offset)
     if stats_text == "":
         return "No goals registered"
     return stats_text
 
 
+@shard_call
+async def group_members(application: Application, chat_id: int) -> Tuple[List[MemberStats], List[int]]:
+    """The stats of the users registered for the group and the ids of registered users that are unknown (to this
+    shard)"""
+    return group_stats.members(application, chat_id)
+
+
+async def gather_group_members(context: CallbackContext, chat_id: int) -> Tuple[List[MemberStats], List[int]]:
+    peers = get_peers()
+    if peers is None:
+        return await group_members(context.application, chat_id)
+    # every shard knows the registrations of its own users
+    members, unknown = [], []
+    for shard_members, shard_unknown in await peers.gather('group_members', chat_id):
+        members.extend(shard_members)
+        unknown.extend(shard_unknown)
+    members.sort(key=lambda member: member.user_id)
+    return members, unknown
+
+
+def chart_days(context: CallbackContext) -> float:
+    """The range of the chart in days, ``/stats <days>`` changes the default"""
+    args = getattr(context, 'args', None)
+    try:
+        days = float(args[0]) if args else CHART_DAYS
+    except ValueError:
+        return CHART_DAYS
+    return days if 1 <= days <= 36500 else CHART_DAYS
+
+
 @authorized
-def handle_stats(update: Update, context: CallbackContext):
+async def handle_stats(update: Update, context: CallbackContext):
+    days = chart_days(context)
     if update.effective_chat.type == 'private':
-        text = get_user_stats(context.bot_data['users'][update.effective_user.id])
-        fig_path = generate_graph(context.bot_data['users'][update.effective_user.id].goals, False)
-        update.message.reply_photo(open(fig_path, 'rb'), caption=text, parse_mode=ParseMode.MARKDOWN_V2)
+        user = context.bot_data['users'][update.effective_user.id]
+        await reply_with_stats(update, user.goals, get_user_stats(user), False, days)
         return
     elif update.effective_chat.type in ['group', 'supergroup']:
-        if 'users' not in context.chat_data or len(context.chat_data['users']) == 0:
-            update.message.reply_text('No users have registered for this group')
+        members, unknown = await gather_group_members(context, update.effective_chat.id)
+        if len(members) == 0 and len(unknown) == 0:
+            await update.message.reply_text('No users have registered for this group')
             return
 
         text = ""
         all_goals = []
-        for user_id in context.chat_data['users']:
-            if user_id not in context.bot_data['users']:
-                text += markdown_v2_escape(f"<This user is not registered: {user_id}>\n\n")
-                continue
-
-            user = context.bot_data['users'][user_id]
-            if len(user.goals) == 0:
+        for user_id in unknown:
+            text += markdown_v2_escape(f"<This user is not registered: {user_id}>\n\n")
+        for member in members:
+            if len(member.goals) == 0:
                 print('user has no goals')
                 continue
-            user_name = '<unknown>' if user.name == '' else user.name
-            text += f"\uA712 *[{markdown_v2_escape(user_name)}](tg://user?id={user.id})*:\n"
-            wide_hyphen = '\uff0d'
-            text += markdown_v2_escape(f"\uA714{''.join(wide_hyphen for _ in range(int(len(user.name) / 2)))}"
-                                       f"{wide_hyphen * 2}\n")
-            user_stats = get_user_stats(user, bullet_string='\uA714', numbered_offset=len(all_goals))
-            user_stats = '\uA716'.join(user_stats.rsplit('\uA714', 1))
-            text += user_stats
-            text += markdown_v2_escape(f"\n")
-            all_goals.extend(user.goals)
+            text += member.render(numbered_offset=len(all_goals))
+            all_goals.extend(member.goals)
 
         if text == '':
             text = "I found no goals for this group"
         print(f'=====\ngroup stats:\n{text}\n=====')
-        fig_path = generate_graph(all_goals, legend_full_goal_title=False)
-        update.message.reply_photo(open(fig_path, 'rb'), caption=text, parse_mode=ParseMode.MARKDOWN_V2)
+        await reply_with_stats(update, all_goals, text, legend_full_goal_title=False, days=days)
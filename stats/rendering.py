@@ -0,0 +1,119 @@
+import asyncio
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from threading import BoundedSemaphore, Lock
+from typing import Optional
+
+from metrics import render_seconds, renders_rejected
+from stats.chart_data import ChartData, ChartFormat
+
+
+RENDER_WORKERS = int(os.environ['STATS_RENDER_WORKERS']) if 'STATS_RENDER_WORKERS' in os.environ else 2
+RENDER_QUEUE = int(os.environ['STATS_RENDER_QUEUE']) if 'STATS_RENDER_QUEUE' in os.environ else 8
+RENDER_TIMEOUT = float(os.environ['STATS_RENDER_TIMEOUT']) if 'STATS_RENDER_TIMEOUT' in os.environ else 30.
+# Worker processes are replaced after this many renders, which bounds whatever matplotlib accumulates per process
+RENDER_MAX_TASKS = int(os.environ['STATS_RENDER_MAX_TASKS']) if 'STATS_RENDER_MAX_TASKS' in os.environ else 500
+
+
+class RendererBusy(Exception):
+    pass
+
+
+def render_chart(chart: ChartData, chart_format: ChartFormat) -> bytes:
+    # runs in the worker processes, the bot process itself never imports matplotlib or numpy
+    from stats.chart import render_chart as render
+    return render(chart, chart_format)
+
+
+def warm_up_worker():
+    import stats.chart  # noqa: F401
+
+
+class ChartRenderer:
+    """Renders charts in a pool of worker processes
+
+    At most ``max_queued`` renders can be pending at any time, further requests are rejected with
+    :class:`RendererBusy` instead of piling up. A render that takes longer than ``timeout`` seconds raises an
+    :class:`asyncio.TimeoutError`, it counts as pending until its worker has finished it.
+    """
+
+    def __init__(self, workers: int = RENDER_WORKERS, max_queued: int = RENDER_QUEUE, timeout: float = RENDER_TIMEOUT,
+                 max_tasks_per_worker: int = RENDER_MAX_TASKS, chart_format: ChartFormat = ChartFormat()):
+        self.workers = workers
+        self.chart_format = chart_format
+        self.timeout = timeout
+        self.max_tasks_per_worker = max_tasks_per_worker
+        self._slots = BoundedSemaphore(max_queued)
+        self._lock = Lock()
+        self._executor: Optional[ProcessPoolExecutor] = None
+
+    async def render(self, chart: ChartData) -> bytes:
+        if not self._slots.acquire(blocking=False):
+            renders_rejected.inc()
+            raise RendererBusy('Too many charts are being rendered at the moment')
+        try:
+            executor = self._get_executor()
+            rendered = executor.submit(render_chart, chart, self.chart_format)
+        except BaseException as e:
+            self._slots.release()
+            if isinstance(e, BrokenProcessPool):
+                self._reset_executor(executor)
+            raise
+        # the slot is only released once the worker is done with the chart, even if nobody waits for it anymore
+        rendered.add_done_callback(lambda _: self._slots.release())
+        try:
+            start = time.perf_counter()
+            # on a timeout, a render that has not been started yet is cancelled
+            result = await asyncio.wait_for(asyncio.wrap_future(rendered), self.timeout)
+            render_seconds.observe(time.perf_counter() - start)
+            return result
+        except BrokenProcessPool:
+            self._reset_executor(executor)
+            raise
+
+    def warm_up(self):
+        """Starts the worker processes and loads the charting libraries in the background"""
+        executor = self._get_executor()
+        for _ in range(self.workers):
+            executor.submit(warm_up_worker)
+
+    def shutdown(self):
+        with self._lock:
+            if self._executor is not None:
+                self._executor.shutdown(wait=False, cancel_futures=True)
+                self._executor = None
+
+    def _get_executor(self) -> ProcessPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                # forking a process with running threads (e.g. the persistence worker) is unsafe, so workers are spawned
+                context = multiprocessing.get_context('spawn')
+                try:
+                    self._executor = ProcessPoolExecutor(self.workers, mp_context=context,
+                                                         max_tasks_per_child=self.max_tasks_per_worker)
+                except TypeError:
+                    # max_tasks_per_child is only supported from python 3.11 on
+                    self._executor = ProcessPoolExecutor(self.workers, mp_context=context)
+            return self._executor
+
+    def _reset_executor(self, broken: ProcessPoolExecutor):
+        with self._lock:
+            if self._executor is broken:
+                self._executor = None
+        broken.shutdown(wait=False)
+
+
+_renderer: Optional[ChartRenderer] = None
+_renderer_lock = Lock()
+
+
+def get_renderer() -> ChartRenderer:
+    global _renderer
+    with _renderer_lock:
+        if _renderer is None:
+            _renderer = ChartRenderer()
+        return _renderer
+
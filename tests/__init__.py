@@ -0,0 +1,7 @@
+import os
+
+# importing the model requires the bot configuration to be present
+os.environ.setdefault('BOT_ADMIN_ID', '0')
+os.environ.setdefault('TELEGRAM_API_TOKEN', '0:test')
+
+import common  # noqa: E402,F401 (resolves the common <-> model import cycle)
@@ -0,0 +1,119 @@
+import asyncio
+import os
+import pickle
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+from unittest import mock
+from common import goal_score_types
+from interactions.callbacks import sign, verify, goal_key, find_goal, to_base36
+from interactions.goal_check import handle_signed_goal_check_response
+from model import Goal, User, UserList
+from persistence import SQLitePersistence, BotData
+
+bot = SimpleNamespace(token='1:token')
+
+
+def goal_check_data(user: User, goal: Goal, choice: str = 'y') -> str:
+    return sign(bot, user.id, 'gc', goal_key(goal), to_base36(1612177200), choice)
+
+
+def user_with_goals(*titles: str) -> User:
+    user = User(1)
+    for title in titles:
+        user.add_goal(Goal(title, '0 11 * * *', goal_score_types[1], 10, 1))
+    return user
+
+
+class CallbackTest(unittest.TestCase):
+
+    def test_signed_buttons_find_their_goal(self):
+        user = user_with_goals('run', 'read')
+        for goal in user.goals:
+            fields = verify(bot, user.id, goal_check_data(user, goal))
+            self.assertEqual(fields, ['gc', goal.key, to_base36(1612177200), 'y'])
+            self.assertIs(find_goal(user, fields[1]), goal)
+
+    def test_tampered_buttons_are_rejected(self):
+        user = user_with_goals('run', 'read')
+        run, read = user.goals
+        data = goal_check_data(user, run)
+        payload, _, signature = data.rpartition(':')
+        tampered = [
+            data.replace(run.key, read.key),
+            data[:-len(signature) - 3] + ':n:' + signature,
+            f'{payload}:{signature[:-1]}',
+            f'{payload}:',
+            payload,
+            # signed for another user
+            sign(bot, 2, 'gc', run.key, to_base36(1612177200), 'y')
+        ]
+        for data in tampered:
+            with self.subTest(data=data):
+                self.assertIsNone(verify(bot, user.id, data))
+
+    def test_buttons_signed_with_a_former_key_are_rejected(self):
+        user = user_with_goals('run')
+        with mock.patch('interactions.callbacks.CALLBACK_SIGNING_KEY', 'former key'):
+            data = goal_check_data(user, user.goals[0])
+        with mock.patch('interactions.callbacks.CALLBACK_SIGNING_KEY', 'current key'):
+            self.assertIsNone(verify(bot, user.id, data))
+            self.assertIsNotNone(verify(bot, user.id, goal_check_data(user, user.goals[0])))
+
+    def test_buttons_of_deleted_goals_find_no_goal(self):
+        user = user_with_goals('run', 'read')
+        data = goal_check_data(user, user.goals[0])
+        user.remove_goal(user.goals[0])
+        self.assertIsNone(find_goal(user, verify(bot, user.id, data)[1]))
+
+    def test_buttons_of_goals_recreated_with_the_same_title_find_no_goal(self):
+        user = user_with_goals('run')
+        stale = goal_check_data(user, user.goals[0])
+        user.remove_goal(user.goals[0])
+        user.add_goal(Goal('run', '0 11 * * *', goal_score_types[1], 10, 1))
+        self.assertIsNone(find_goal(user, verify(bot, user.id, stale)[1]))
+        self.assertIs(find_goal(user, verify(bot, user.id, goal_check_data(user, user.goals[0]))[1]), user.goals[0])
+
+    def test_goals_of_a_user_get_distinct_keys(self):
+        user = user_with_goals('run')
+        colliding = Goal('read', '0 11 * * *', goal_score_types[1], 10, 1)
+        colliding.key = user.goals[0].key
+        user.add_goal(colliding)
+        self.assertNotEqual(colliding.key, user.goals[0].key)
+        self.assertIs(find_goal(user, user.goals[0].key), user.goals[0])
+
+    def test_buttons_of_goal_checks_before_the_history_have_expired(self):
+        user = user_with_goals('run')
+        goal = user.goals[0]
+        start = datetime(2021, 1, 1, 11)
+        for day in range(1, 101):
+            goal.add_data(1, start + timedelta(days=day))
+        data = sign(bot, user.id, 'gc', goal_key(goal), to_base36(int(start.timestamp())), 'n')
+        query = SimpleNamespace(from_user=SimpleNamespace(id=user.id), data=data, answer=mock.AsyncMock(),
+                                edit_message_reply_markup=mock.AsyncMock(),
+                                message=SimpleNamespace(reply_markup=SimpleNamespace(inline_keyboard=[[]])))
+        context = SimpleNamespace(bot=bot, bot_data={'users': UserList([user])})
+        record = 'interactions.goal_check.record_goal_check_answer'
+        with mock.patch(record, new=mock.AsyncMock()) as record_answer:
+            for _ in range(2):
+                asyncio.run(handle_signed_goal_check_response(SimpleNamespace(callback_query=query), context))
+        record_answer.assert_not_called()
+        self.assertEqual(query.answer.await_args_list, [mock.call('This goal check has expired')] * 2)
+        self.assertEqual(goal.calculate_score_floating_amount(), 10)
+
+    def test_keys_are_persisted(self):
+        user = user_with_goals('run', 'read')
+        keys = [goal.key for goal in user.goals]
+        self.assertEqual([goal.key for goal in pickle.loads(pickle.dumps(user)).goals], keys)
+        with tempfile.TemporaryDirectory() as directory:
+            persistence = SQLitePersistence(os.path.join(directory, 'state.sqlite'))
+            persistence.save_bot_data(BotData(users=UserList([user])))
+            persistence.close()
+            persistence = SQLitePersistence(os.path.join(directory, 'state.sqlite'))
+            self.assertEqual([goal.key for goal in persistence.load_bot_data()['users'][1].goals], keys)
+            persistence.close()
+
+
+if __name__ == '__main__':
+    unittest.main()
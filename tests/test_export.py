@@ -0,0 +1,144 @@
+import asyncio
+import contextlib
+import io
+import os
+import tempfile
+import threading
+import unittest
+from datetime import timedelta
+from types import SimpleNamespace
+from typing import Dict, List
+from unittest import mock
+from common import goal_score_types
+from interactions.export import handle_export
+from model import Goal, User, UserList
+from persistence import BotData, SQLitePersistence, export_formats, export_snapshot, import_exports, read_export, write_export
+from tests.test_goal_scores import answers, start
+
+
+def exported_user() -> User:
+    user = User(1)
+    user.authorized = True
+    user.chat_id = 1
+    goals = [Goal('plain', '0 11 * * *', goal_score_types[1], 10, 1),
+             Goal('with "quotes", commas\nand ümlauts', '0 8 * * 1-5', goal_score_types[0], -1, -5),
+             Goal('no data yet', '30 20 * * *', goal_score_types[2], 60, 1)]
+    for goal, count in zip(goals, (120, 30, 0)):
+        for day, value in enumerate(answers(count, seed=count)):
+            goal.add_data(value, start + timedelta(days=day, seconds=0.25))
+        user.add_goal(goal)
+    return user
+
+
+class FakeMessage:
+    """Collects the documents sent by the handler"""
+
+    def __init__(self, on_document=None):
+        self.documents: Dict[str, str] = {}
+        self.on_document = on_document
+
+    async def reply_document(self, document, filename: str):
+        with open(document, encoding='utf-8') as f:
+            self.documents[filename] = f.read()
+        if self.on_document is not None:
+            self.on_document()
+
+    async def reply_text(self, text: str):
+        self.documents['text'] = text
+
+
+class ExportTest(unittest.TestCase):
+
+    def assert_same_goals(self, goals: List[Goal], expected: List[Goal]):
+        self.assertEqual([goal.title for goal in goals], [goal.title for goal in expected])
+        for goal, original in zip(goals, expected):
+            self.assertEqual((goal.cron, goal.score_type, goal.score_range, goal.chat_id),
+                             (original.cron, original.score_type, original.score_range, original.chat_id))
+            self.assertEqual(list(goal.times), list(original.times))
+            self.assertEqual(goal.values, original.values)
+
+    def test_exports_are_imported_again(self):
+        user = exported_user()
+        for export_format in export_formats:
+            with self.subTest(export_format=export_format), tempfile.TemporaryDirectory() as directory:
+                write_export(os.path.join(directory, f'export.{export_format}'), export_format, export_snapshot(user))
+                persistence = SQLitePersistence(os.path.join(directory, 'state.sqlite'))
+                with contextlib.redirect_stdout(io.StringIO()):
+                    import_exports(directory, persistence)
+                    # importing again adds nothing
+                    import_exports(directory, persistence)
+                persistence.close()
+
+                persistence = SQLitePersistence(os.path.join(directory, 'state.sqlite'))
+                users: UserList = persistence.load_bot_data()['users']
+                persistence.close()
+                self.assertEqual([u.id for u in users], [user.id])
+                self.assert_same_goals(users[user.id].goals, user.goals)
+
+    def test_handler_exports_a_snapshot_in_a_worker_thread(self):
+        user = exported_user()
+        expected = {export_format: ''.join(export(export_snapshot(user)))
+                    for export_format, export in export_formats.items()}
+        # answers recorded while the documents are sent are not in the documents
+        message = FakeMessage(on_document=lambda: user.goals[0].add_data(1, start + timedelta(days=500)))
+        update = SimpleNamespace(effective_chat=SimpleNamespace(type='private'),
+                                 effective_user=SimpleNamespace(id=user.id), message=message)
+        users = UserList([user])
+        context = SimpleNamespace(args=[], bot_data={'users': users})
+        threads = []
+
+        def recording_write_export(*args):
+            threads.append(threading.get_ident())
+            write_export(*args)
+
+        with mock.patch('interactions.export.write_export', recording_write_export):
+            asyncio.run(handle_export(update, context))
+        self.assertEqual(message.documents, {f'drill_sergeant_1.{export_format}': document
+                                             for export_format, document in expected.items()})
+        self.assertEqual(len(threads), len(export_formats))
+        self.assertNotIn(threading.get_ident(), threads)
+
+    def test_unknown_formats_are_rejected(self):
+        message = FakeMessage()
+        update = SimpleNamespace(effective_chat=SimpleNamespace(type='private'),
+                                 effective_user=SimpleNamespace(id=1), message=message)
+        context = SimpleNamespace(args=['xml'], bot_data={'users': UserList([exported_user()])})
+        asyncio.run(handle_export(update, context))
+        self.assertEqual(list(message.documents), ['text'])
+
+    def test_rows_with_an_invalid_schedule_or_score_range_are_rejected(self):
+        valid = '1,0,run,0 11 * * *,floating average,10,1,1612177200,1'
+        rows = [valid.replace('0 11 * * *', schedule) for schedule in ('0 25 * * *', 'daily')] + \
+            [valid.replace(',10,', f',{score_range},') for score_range in (0, 61, -1)] + \
+            [valid.replace('floating average,10', 'number of successes,10'), valid]
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'export.csv')
+            with open(path, 'w', encoding='utf-8') as f:
+                f.write('user_id,goal,title,cron,score_type,score_range,chat_id,time,value\n' + '\n'.join(rows))
+            errors = [error for _, _, error in read_export(path)]
+        self.assertEqual([error.split(' ')[:2] for error in errors[:-1]],
+                         [['invalid', 'cron']] * 2 + [['invalid', 'score']] * 4)
+        self.assertIsNone(errors[-1])
+
+    def test_rows_older_than_the_history_of_their_goal_are_skipped(self):
+        user = exported_user()
+        goal = user.goals[0]
+        first, last = goal.times[0], goal.times[-1]
+        with tempfile.TemporaryDirectory() as directory:
+            persistence = SQLitePersistence(os.path.join(directory, 'state.sqlite'))
+            persistence.save_bot_data(BotData(users=UserList([user])))
+            with open(os.path.join(directory, 'export.csv'), 'w', encoding='utf-8') as f:
+                f.write('user_id,goal,title,cron,score_type,score_range,chat_id,time,value\n' + ''.join(
+                    f'1,0,plain,0 11 * * *,floating average,10,1,{timestamp},1\n'
+                    for timestamp in (first - 86400, first, last + 86400)))
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                import_exports(directory, persistence)
+            persistence.close()
+        self.assertIn('Imported 1 rows from 1 files', output.getvalue())
+        self.assertIn("1 already present, 1 older than the goal's history, 0 invalid", output.getvalue())
+        self.assertEqual((goal.times[0], goal.times[-1]), (first + 86400, last + 86400))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,149 @@
+import random
+import unittest
+from datetime import timedelta
+from typing import List
+from unittest import mock
+from common import goal_score_types
+from model import Goal
+from model.GoalRollups import GoalRollups, coarser_period, floating_averages, period_bounds, period_of
+from tests.test_goal_scores import answers, derived_scores, start
+
+
+def reference_floating_averages(answer_counts: List[int], successes: List[int], window_range: int) -> List[float]:
+    """Each period together with as many of the periods before it as needed for window_range answers"""
+    averages = []
+    for end in range(len(answer_counts)):
+        first = end
+        while first > 0 and sum(answer_counts[first:end + 1]) < window_range:
+            first -= 1
+        averages.append(sum(successes[first:end + 1]) / sum(answer_counts[first:end + 1]))
+    return averages
+
+
+class GoalRollupsTest(unittest.TestCase):
+
+    @mock.patch.multiple('model.GoalRollups', ROLLUP_DAYS=10, ROLLUP_WEEKS=6, ROLLUP_MONTHS=4)
+    def test_periods_are_compacted_into_the_next_tier(self):
+        rollups = GoalRollups()
+        days = 400
+        values = answers(days, seed=1)
+        for day, value in enumerate(values):
+            rollups.add((start + timedelta(days=day)).timestamp(), value)
+            self.assertLessEqual(len(rollups.days), 10)
+            self.assertLessEqual(len(rollups.weeks), 6)
+            self.assertLessEqual(len(rollups.months), 4)
+
+        last_day = period_of((start + timedelta(days=days - 1)).timestamp(), 'day')
+        self.assertEqual((rollups.days.first, len(rollups.days)), (last_day - 9, 10))
+        # every period is counted in exactly one tier, only the oldest months are forgotten
+        expected = {}
+        for day, value in enumerate(values):
+            period = period_of((start + timedelta(days=day)).timestamp(), 'day')
+            if period >= rollups.days.first:
+                key = ('day', period)
+            elif coarser_period(period, 'day', 'week') >= rollups.weeks.first:
+                key = ('week', coarser_period(period, 'day', 'week'))
+            else:
+                # weeks belong to the month they start in
+                key = ('month', coarser_period(coarser_period(period, 'day', 'week'), 'week', 'month'))
+                if key[1] < rollups.months.first:
+                    continue
+            counts = expected.setdefault(key, [0, 0])
+            counts[0] += 1
+            counts[1] += value
+        self.assertEqual(rollups.periods(), expected)
+        self.assertEqual(sum(answers for answers, _ in rollups.periods('month').values()),
+                         sum(answers for answers, _ in expected.values()))
+
+    @mock.patch.multiple('model.GoalRollups', ROLLUP_DAYS=10, ROLLUP_WEEKS=6, ROLLUP_MONTHS=4)
+    def test_data_points_older_than_the_days_kept_are_counted_in_their_week_or_month(self):
+        rollups = GoalRollups()
+        for day in range(100):
+            rollups.add((start + timedelta(days=day)).timestamp(), 1)
+        before = rollups.periods()
+        for day in (85, 70, 5):
+            timestamp = (start + timedelta(days=day)).timestamp()
+            rollups.add(timestamp, 0)
+            resolution = 'week' if day > 50 else 'month'
+            key = (resolution, period_of(timestamp, resolution))
+            self.assertEqual(rollups.periods()[key], [before[key][0] + 1, before[key][1]])
+            before = rollups.periods()
+
+    def test_coarser_resolutions_merge_the_finer_periods(self):
+        rollups = GoalRollups()
+        for day in range(300):
+            rollups.add((start + timedelta(days=day)).timestamp(), day % 3 > 0)
+        for resolution in ('week', 'month'):
+            periods = rollups.periods(resolution)
+            self.assertEqual({tier for tier, _ in periods}, {resolution})
+            self.assertEqual([sum(counts) for counts in zip(*periods.values())], [300, 200])
+        for (_, week), (answer_count, _) in rollups.periods('week').items():
+            low, high = period_bounds(week, 'week')
+            self.assertEqual(answer_count, sum(low <= (start + timedelta(days=day)).timestamp() < high
+                                               for day in range(300)))
+
+    def test_floating_averages_reach_back_as_far_as_the_window(self):
+        rand = random.Random(1)
+        for window_range in (1, 7, 10, 100):
+            for _ in range(20):
+                answer_counts = [rand.randint(1, 14) for _ in range(rand.randint(1, 40))]
+                successes = [rand.randint(0, count) for count in answer_counts]
+                with self.subTest(window_range=window_range, answers=answer_counts):
+                    self.assertEqual(floating_averages(answer_counts, successes, window_range),
+                                     reference_floating_averages(answer_counts, successes, window_range))
+
+    def test_floating_averages_of_single_answers_are_the_floating_averages_of_the_data_points(self):
+        values = answers(150, seed=2)
+        for window_range in (1, 7, 100):
+            self.assertEqual(floating_averages([1] * len(values), values, window_range),
+                             derived_scores(values, window_range)[goal_score_types[1]])
+
+
+class ChartSeriesTest(unittest.TestCase):
+
+    def goal(self, days: int, per_day: int = 1) -> Goal:
+        goal = Goal('goal', '0 11 * * *', goal_score_types[1], 10, 1)
+        for index, value in enumerate(answers(days * per_day, seed=days)):
+            goal.add_data(value, start + timedelta(days=index // per_day, hours=12 * (index % per_day)))
+        return goal
+
+    def test_charts_of_a_history_covering_the_range_are_the_data_points(self):
+        goal = self.goal(250)
+        self.assertIsNotNone(goal.rollups)
+        times, scores = goal.chart_series(goal.times[0])
+        self.assertEqual(list(times), list(goal.times))
+        self.assertEqual(list(scores), list(goal.scores(goal_score_types[1])))
+
+    def test_rollup_periods_precede_the_data_points_within_the_range(self):
+        # answered twice a day, the 100 data points of the history cover 50 days
+        goal = self.goal(150, per_day=2)
+        since = (start + timedelta(days=80)).timestamp()
+        times, scores = goal.chart_series(since)
+        periods = sorted(goal.rollups.periods().items())
+        charted = [(min(sum(period_bounds(period, tier)) / 2, goal.times[0]), counts)
+                   for (tier, period), counts in periods]
+        averages = floating_averages([counts[0] for _, counts in charted], [counts[1] for _, counts in charted],
+                                     goal.window_range)
+        expected = [(timestamp, average) for (timestamp, _), average in zip(charted, averages) if timestamp >= since]
+        self.assertEqual(len(expected), 20)
+        self.assertEqual(list(zip(times, scores))[:len(expected)], expected)
+        self.assertEqual(list(times[len(expected):]), list(goal.times))
+        self.assertEqual(list(scores[len(expected):]), list(goal.scores(goal_score_types[1])))
+
+    def test_charts_per_period_count_the_data_points_as_well(self):
+        goal = self.goal(300)
+        times, scores = goal.chart_series(0, 'week')
+        periods = goal.rollups.periods('week')
+        for timestamp, value in zip(goal.times, goal.values):
+            counts = periods.setdefault(('week', period_of(timestamp, 'week')), [0, 0])
+            counts[0] += 1
+            counts[1] += value
+        ordered = [counts for _, counts in sorted(periods.items())]
+        self.assertEqual(list(scores), floating_averages([counts[0] for counts in ordered],
+                                                         [counts[1] for counts in ordered], goal.window_range))
+        self.assertLessEqual(times[-1], goal.times[-1])
+        self.assertEqual(list(times), sorted(times))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,192 @@
+import random
+import unittest
+from array import array
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from typing import Dict, List
+from common import goal_score_types
+from model import Goal
+from model.Goal import rolling_scores
+from persistence.migrations import upgrade_goal_state
+
+start = datetime(2021, 1, 1, 11)
+score_ranges = (-1, 1, 7, 10, 150)
+
+
+class StoredScoresGoal:
+    """Scores every data point like the goals did while they stored the scores (goal state version 2)"""
+
+    def __init__(self, score_range: int):
+        self.score_range = score_range
+        self.window_range = 100 if score_range == -1 else score_range
+        self.times, self.values = array('d'), bytearray()
+        self.streaks, self.averages, self.amounts = array('i'), array('d'), array('i')
+        self.window_sum = self.streak = 0
+
+    def add_data(self, value: int, time_end: datetime):
+        timestamp = time_end.timestamp()
+        count = len(self.times)
+        leaving = self.values[count - self.window_range] if count >= self.window_range else 0
+        # the new data point is scored as the most recent one, even if it is older than already recorded data
+        amount = self.window_sum + value - leaving
+        streak = self.streak + 1 if value else 0
+        average = amount / min(self.window_range, count + 1)
+        if count == 0 or timestamp >= self.times[-1]:
+            position = count
+            self.window_sum = amount
+            self.streak = streak
+        else:
+            position = bisect_right(self.times, timestamp)
+            if position > count - self.window_range:
+                self.window_sum = amount
+            if position >= count - self.streak:
+                self.streak = self.streak + 1 if value else count - position
+        self.times.insert(position, timestamp)
+        self.values.insert(position, value)
+        self.streaks.insert(position, streak)
+        self.averages.insert(position, average)
+        self.amounts.insert(position, amount)
+        history_range = max(100, self.score_range)
+        if len(self.times) > history_range:
+            for series in (self.times, self.values, self.streaks, self.averages, self.amounts):
+                del series[:len(series) - history_range]
+
+    def scores(self, score_type: str) -> List:
+        return list((self.streaks, self.averages, self.amounts)[goal_score_types.index(score_type)])
+
+    def state(self) -> Dict:
+        return {'title': 'goal', 'cron': '0 11 * * *', 'score_type': goal_score_types[1],
+                'score_range': self.score_range, 'chat_id': 1, 'waiting_for_data': False,
+                'times': array('d', self.times), 'values': bytearray(self.values),
+                'scores': (array('i', self.streaks), array('d', self.averages), array('i', self.amounts)),
+                'window_sum': self.window_sum, 'streak': self.streak, 'version': 2}
+
+
+def answers(count: int, seed: int) -> List[int]:
+    rand = random.Random(seed)
+    return [int(rand.random() < 0.7) for _ in range(count)]
+
+
+def derived_scores(values: List[int], window_range: int) -> Dict[str, List]:
+    """The scores of every value by their definitions"""
+    streaks, averages, amounts = [], [], []
+    for end in range(1, len(values) + 1):
+        window = values[max(0, end - window_range):end]
+        streaks.append(rolling_scores(bytearray(values[:end]), window_range)[1])
+        amounts.append(sum(window))
+        averages.append(sum(window) / len(window))
+    return dict(zip(goal_score_types, (streaks, averages, amounts)))
+
+
+class GoalScoresTest(unittest.TestCase):
+
+    def assert_scores(self, goal: Goal, expected: Dict[str, List]):
+        for score_type in goal_score_types:
+            self.assertEqual(list(goal.scores(score_type)), expected[score_type], score_type)
+            self.assertEqual([goal.score_at(index, score_type) for index in range(len(goal.times))],
+                             expected[score_type], score_type)
+
+    def test_scores_of_an_ordered_history_are_the_stored_scores(self):
+        # the longer histories have dropped values the first scores depend on
+        for score_range in score_ranges:
+            for count in (0, 1, 5, 99, 100, 101, 151, 250, 400):
+                with self.subTest(score_range=score_range, count=count):
+                    goal = Goal('goal', '0 11 * * *', goal_score_types[1], score_range, 1)
+                    stored = StoredScoresGoal(score_range)
+                    for day, value in enumerate(answers(count, seed=count)):
+                        goal.add_data(value, start + timedelta(days=day))
+                        stored.add_data(value, start + timedelta(days=day))
+                    self.assertEqual(list(goal.times), list(stored.times))
+                    self.assert_scores(goal, {score_type: stored.scores(score_type)
+                                              for score_type in goal_score_types})
+                    self.assertEqual((goal.calculate_score_days(), goal.calculate_score_floating_amount()),
+                                     (stored.streak, stored.window_sum))
+
+    def test_out_of_order_answers_rescore_the_following_data_points(self):
+        for score_range in score_ranges:
+            with self.subTest(score_range=score_range):
+                goal = Goal('goal', '0 11 * * *', goal_score_types[1], score_range, 1)
+                answered: Dict[datetime, int] = {}
+                days = list(range(300))
+                # every tenth answer arrives a few days late
+                for late in range(5, 300, 10):
+                    days.remove(late)
+                    days.insert(min(len(days), late + 3), late)
+                for day, value in zip(days, answers(len(days), seed=score_range)):
+                    goal.add_data(value, start + timedelta(days=day))
+                    answered[start + timedelta(days=day)] = value
+                    # builds the index, which is then kept up to date by the following answers
+                    goal.score_at(-1, goal_score_types[0])
+
+                values = [answered[time_end] for time_end in sorted(answered)]
+                expected = derived_scores(values, goal.window_range)
+                retained = len(goal.times)
+                self.assertEqual(list(goal.times), [time_end.timestamp() for time_end in sorted(answered)][-retained:])
+                self.assert_scores(goal, {score_type: scores[-retained:] for score_type, scores in expected.items()})
+                self.assertEqual(goal.calculate_score_days(), expected[goal_score_types[0]][-1])
+                self.assertEqual(goal.calculate_score_floating_amount(), expected[goal_score_types[2]][-1])
+
+    def test_answers_older_than_a_trimmed_history_are_not_recorded(self):
+        for score_range in score_ranges:
+            with self.subTest(score_range=score_range):
+                goal = Goal('goal', '0 11 * * *', goal_score_types[1], score_range, 1)
+                values = answers(250, seed=score_range)
+                # skips the days before the history, which are answered late
+                for day, value in enumerate(values):
+                    if day not in (80, 99):
+                        goal.add_data(value, start + timedelta(days=day))
+                goal.score_at(-1, goal_score_types[0])
+                first = goal.times[0]
+                periods = goal.rollups.periods()
+
+                for day in (80, 99, 99):
+                    self.assertTrue(goal.is_before_history((start + timedelta(days=day)).timestamp()))
+                    goal.add_data(1, start + timedelta(days=day))
+                self.assertEqual(goal.times[0], first)
+                self.assertEqual(goal.rollups.periods(), periods)
+                expected = derived_scores([value for day, value in enumerate(values) if day not in (80, 99)],
+                                          goal.window_range)
+                retained = len(goal.times)
+                self.assert_scores(goal, {score_type: scores[-retained:] for score_type, scores in expected.items()})
+
+    def test_migrated_goals_keep_their_stored_scores(self):
+        # including the scores of answers that were recorded out of order
+        for score_range in score_ranges:
+            for count in (50, 100, 250):
+                with self.subTest(score_range=score_range, count=count):
+                    stored = StoredScoresGoal(score_range)
+                    days = list(range(count))
+                    days[count // 2], days[count // 2 + 1] = days[count // 2 + 1], days[count // 2]
+                    for day, value in zip(days, answers(count, seed=count + 1)):
+                        stored.add_data(value, start + timedelta(days=day))
+
+                    goal = Goal.__new__(Goal)
+                    goal.__setstate__(upgrade_goal_state(stored.state()))
+                    self.assertEqual(list(goal.times), list(stored.times))
+                    self.assert_scores(goal, {score_type: stored.scores(score_type)
+                                              for score_type in goal_score_types})
+                    self.assertEqual(goal.calculate_score_days(), stored.streak)
+
+    def test_pinned_scores_are_dropped_with_their_data_points(self):
+        stored = StoredScoresGoal(10)
+        for day in (0, 2, 1) + tuple(range(3, 100)):
+            stored.add_data(1, start + timedelta(days=day))
+        goal = Goal.__new__(Goal)
+        goal.__setstate__(upgrade_goal_state(stored.state()))
+        self.assertIsNotNone(goal.pinned)
+
+        for day in range(100, 103):
+            goal.add_data(1, start + timedelta(days=day))
+        self.assertIsNone(goal.pinned)
+        self.assertEqual(list(goal.scores(goal_score_types[0])), list(range(4, 104)))
+        self.assertEqual(goal.lead, bytearray([1] * 3))
+
+        # only the values the window of the first data point reaches back to are kept
+        for day in range(103, 120):
+            goal.add_data(1, start + timedelta(days=day))
+        self.assertEqual(goal.lead, bytearray([1] * 9))
+        self.assertEqual(goal.score_at(0, goal_score_types[2]), 10)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import os
+import tempfile
+import threading
+import unittest
+from unittest import mock
+from persistence import AnswerJournal
+
+
+class AnswerJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.journal = AnswerJournal(os.path.join(self.directory.name, 'answers.journal'), commit_delay=0)
+        self.addCleanup(self.journal.close)
+
+    def append(self, count: int):
+        for _ in range(count):
+            self.journal.append(1, 'key', 'goal', 1612177200., 1)
+
+    def test_entries_after_the_compacted_ones_are_kept(self):
+        self.append(3)
+        self.journal.compact(upto=2)
+        self.assertEqual([entry.sequence for entry in self.journal.read()], [3])
+        self.append(1)
+        self.journal.compact(upto=3)
+        self.assertEqual([entry.sequence for entry in self.journal.read()], [4])
+        self.assertEqual([sequence for sequence, _ in self.journal.segments()], [4])
+        self.journal.compact(upto=4)
+        self.assertEqual((list(self.journal.read()), self.journal.segments()), ([], []))
+
+        # the numbering continues after reopening
+        self.journal.close()
+        self.journal = AnswerJournal(self.journal.path, commit_delay=0, sequence=4)
+        self.append(1)
+        self.assertEqual([entry.sequence for entry in self.journal.read(after=4)], [5])
+
+    def test_answers_are_appended_while_compacted_segments_are_deleted(self):
+        self.append(2)
+        appended = []
+        remove = os.remove
+
+        def remove_segment(path: str):
+            # the journal must not be locked while the segment is deleted
+            appending = threading.Thread(target=lambda: appended.append(self.journal.append(1, 'key', 'goal', 0., 1)))
+            appending.start()
+            appending.join(5)
+            remove(path)
+
+        with mock.patch('persistence.journal.os.remove', remove_segment):
+            self.journal.compact(upto=2)
+        self.assertEqual(appended, [3])
+        self.assertEqual([entry.sequence for entry in self.journal.read()], [3])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,284 @@
+import copyreg
+import os
+import pickle
+import sqlite3
+import tempfile
+import unittest
+import zlib
+from array import array
+from datetime import timedelta
+from typing import Dict, List, Optional
+from common import goal_score_types
+from model import Goal, User, UserList
+from model.Goal import rolling_scores
+from persistence import SQLitePersistence, SCHEMA_VERSION, import_pickle, unpickle
+from tests.test_goal_scores import StoredScoresGoal, answers, derived_scores, start
+
+# the tables as created by the former versions of the bot, before the migration to the next schema version
+SCHEMA_TAIL = '''
+CREATE INDEX data_points_by_goal ON data_points (user_id, goal_position);
+CREATE TABLE bot_data (key TEXT PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE chat_data (chat_id INTEGER NOT NULL, key TEXT NOT NULL, data BLOB NOT NULL, PRIMARY KEY (chat_id, key));
+CREATE TABLE dialogs (chat_id INTEGER NOT NULL, dialog_id TEXT NOT NULL, data BLOB NOT NULL,
+                      PRIMARY KEY (chat_id, dialog_id));
+CREATE TABLE user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL);
+CREATE TABLE conversations (name TEXT NOT NULL, key BLOB NOT NULL, state BLOB, PRIMARY KEY (name, key));
+'''
+USERS_TABLE = '''
+CREATE TABLE users (id INTEGER PRIMARY KEY, name TEXT, authorized INTEGER NOT NULL, chat_id INTEGER NOT NULL,
+                    goal_polls BLOB);
+'''
+GOAL_COLUMNS = '''user_id INTEGER NOT NULL, position INTEGER NOT NULL, title TEXT NOT NULL, cron TEXT NOT NULL,
+    score_type TEXT NOT NULL, score_range INTEGER NOT NULL, chat_id INTEGER NOT NULL,
+    waiting_for_data INTEGER NOT NULL'''
+SCORED_DATA_POINTS_TABLE = '''
+CREATE TABLE data_points (user_id INTEGER NOT NULL, goal_position INTEGER NOT NULL, time REAL NOT NULL,
+                          value INTEGER NOT NULL, streak INTEGER NOT NULL, average REAL NOT NULL,
+                          amount INTEGER NOT NULL);
+'''
+schemas = {
+    1: USERS_TABLE + f'CREATE TABLE goals ({GOAL_COLUMNS}, PRIMARY KEY (user_id, position));' +
+    SCORED_DATA_POINTS_TABLE + SCHEMA_TAIL,
+    2: USERS_TABLE + f'CREATE TABLE goals ({GOAL_COLUMNS}, window_sum INTEGER NOT NULL DEFAULT 0, '
+                     f'streak INTEGER NOT NULL DEFAULT 0, PRIMARY KEY (user_id, position));' +
+    SCORED_DATA_POINTS_TABLE + SCHEMA_TAIL + 'CREATE TABLE meta (key TEXT PRIMARY KEY, value);',
+    3: USERS_TABLE + f'CREATE TABLE goals ({GOAL_COLUMNS}, window_sum INTEGER NOT NULL DEFAULT 0, '
+                     f'streak INTEGER NOT NULL DEFAULT 0, lead BLOB, lead_streak INTEGER NOT NULL DEFAULT 0, '
+                     f'pinned BLOB, PRIMARY KEY (user_id, position));' +
+    'CREATE TABLE data_points (user_id INTEGER NOT NULL, goal_position INTEGER NOT NULL, time REAL NOT NULL, '
+    'value INTEGER NOT NULL);' + SCHEMA_TAIL + 'CREATE TABLE meta (key TEXT PRIMARY KEY, value);'
+}
+schemas[4] = schemas[3].replace('pinned BLOB, PRIMARY KEY', 'pinned BLOB, rollups BLOB, PRIMARY KEY')
+
+
+class RecordedGoal:
+    """A goal as recorded by the versions that stored a score for every data point"""
+
+    def __init__(self, title: str, score_type: str, score_range: int, days: List[int]):
+        self.title = title
+        self.score_type = score_type
+        self.stored = StoredScoresGoal(score_range)
+        self.answered: Dict[int, int] = {}
+        for day, value in zip(days, answers(len(days), seed=len(days))):
+            self.stored.add_data(value, start + timedelta(days=day))
+            self.answered[day] = value
+
+    def config(self) -> Dict:
+        return {'title': self.title, 'cron': '0 11 * * *', 'score_type': self.score_type,
+                'score_range': self.stored.score_range, 'chat_id': 7, 'waiting_for_data': False}
+
+    def stored_scores(self) -> List[tuple]:
+        return list(zip(self.stored.streaks, self.stored.averages, self.stored.amounts))
+
+    def state(self, version: int) -> Dict:
+        """The pickled state of the goal written by the bot versions with goal state ``version`` (up to 4)"""
+        stored = self.stored
+        if version == 0:
+            return dict(self.config(), data=[
+                {'value': value, 'time': timestamp, 'score': dict(zip(goal_score_types, scores))}
+                for timestamp, value, scores in zip(stored.times, stored.values, self.stored_scores())])
+        state = dict(self.config(), times=array('d', stored.times), values=bytearray(stored.values))
+        if version in (1, 2):
+            state['scores'] = (array('i', stored.streaks), array('d', stored.averages), array('i', stored.amounts))
+            if version == 2:
+                state.update(window_sum=stored.window_sum, streak=stored.streak, version=2)
+            return state
+
+        # version 3 keeps the dropped values the scores depend on and pins stored scores that differ
+        values = [self.answered[day] for day in sorted(self.answered)]
+        dropped = bytearray(values[:len(values) - len(stored.values)])
+        derived = list(zip(*derived_scores(values, stored.window_range).values()))[len(dropped):]
+        pinned = {timestamp: scores for timestamp, scores, derived_scores_ in
+                  zip(stored.times, self.stored_scores(), derived) if scores != derived_scores_}
+        state.update(lead=dropped[max(0, len(dropped) - stored.window_range + 1):],
+                     lead_streak=rolling_scores(dropped, 1)[1], pinned=pinned or None,
+                     window_sum=stored.window_sum, streak=stored.streak, version=3)
+        if version == 4:
+            state.update(rollups=None, version=4)
+        return state
+
+
+def recorded_goals() -> List[RecordedGoal]:
+    late = list(range(60))
+    late[30], late[31] = late[31], late[30]
+    return [RecordedGoal('ordered', goal_score_types[1], 10, list(range(150))),
+            RecordedGoal('late answer', goal_score_types[0], -1, late),
+            RecordedGoal('long range', goal_score_types[2], 150, list(range(200))),
+            RecordedGoal('new', goal_score_types[1], 10, [])]
+
+
+class LegacyGoal:
+    """Pickles like a goal of a former version of the bot"""
+
+    def __init__(self, state: Dict):
+        self.state = state
+
+    def __reduce__(self):
+        return copyreg._reconstructor, (Goal, object, None), self.state
+
+
+class LegacyUserList(list):
+    """Pickles like the list based UserList of the first versions of the bot"""
+
+    def __reduce__(self):
+        # unpickled like the NEWOBJ of the list subclass: created without __init__, then the users are appended
+        return UserList.__new__, (UserList,), None, iter(self)
+
+
+def legacy_users(version: int) -> List[User]:
+    user = User(1)
+    user.name = 'user'
+    user.authorized = True
+    user.chat_id = 1
+    user.goals = [LegacyGoal(goal.state(version)) for goal in recorded_goals()]
+    return [user, User(2)]
+
+
+class MigrationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'state.sqlite')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def assert_goals(self, goals: List[Goal], scalar_scores: bool = False):
+        recorded = recorded_goals()
+        self.assertEqual([goal.title for goal in goals], [goal.title for goal in recorded])
+        for goal, expected in zip(goals, recorded):
+            with self.subTest(goal=goal.title):
+                self.assertIs(type(goal), Goal)
+                self.assertEqual({key: getattr(goal, key) for key in expected.config()},
+                                 dict(expected.config(), chat_id=-1) if scalar_scores else expected.config())
+                self.assertEqual(list(goal.times), list(expected.stored.times))
+                self.assertEqual(goal.values, expected.stored.values)
+                score_types = goal_score_types if not scalar_scores else [goal.score_type]
+                for score_type in score_types:
+                    self.assertEqual(list(goal.scores(score_type)), expected.stored.scores(score_type), score_type)
+                if not scalar_scores:
+                    # only the scores that can't be derived from the values are pinned
+                    recorded_state = expected.state(3)
+                    self.assertEqual((goal.lead, goal.pinned), (recorded_state['lead'], recorded_state['pinned']))
+                self.assertEqual(goal.calculate_score_days(), expected.stored.streak)
+                self.assertEqual(goal.calculate_score_floating_amount(), expected.stored.window_sum)
+                self.assertEqual(goal.__getstate__()['version'], Goal.state_version)
+                # the buttons sent before the goals had keys of their own keep working
+                self.assertEqual(goal.key, f'{zlib.crc32(goal.title.encode()):08x}')
+
+                # and the goal goes on like it would have, until the migrated data points are dropped
+                for day, value in enumerate(answers(200, seed=3), 1000):
+                    goal.add_data(value, start + timedelta(days=day))
+                    expected.stored.add_data(value, start + timedelta(days=day))
+                    for score_type in score_types:
+                        self.assertEqual(list(goal.scores(score_type)), expected.stored.scores(score_type))
+
+    def test_goal_states_of_every_version_are_upgraded(self):
+        for version in range(Goal.state_version):
+            with self.subTest(version=version):
+                users = unpickle(pickle.dumps(legacy_users(version)))
+                self.assert_goals(users[0].goals)
+
+    def test_goal_states_with_a_scalar_score_are_upgraded(self):
+        # the first versions stored the score of the goal's score type only and no chat
+        states = []
+        for goal in recorded_goals():
+            state = goal.state(0)
+            del state['chat_id']
+            for point in state['data']:
+                point['score'] = point['score'][goal.score_type]
+            states.append(LegacyGoal(state))
+        self.assert_goals(unpickle(pickle.dumps(states)), scalar_scores=True)
+
+    def test_current_goal_states_are_not_changed(self):
+        goals = unpickle(pickle.dumps(legacy_users(2)))[0].goals
+        for goal, restored in zip(goals, pickle.loads(pickle.dumps(goals))):
+            self.assertEqual(restored.__getstate__(), goal.__getstate__())
+            self.assertEqual(unpickle(pickle.dumps(goal)).__getstate__(), goal.__getstate__())
+
+    def test_pickle_persistence_files_are_imported(self):
+        pickle_path = os.path.join(self.directory.name, 'driserbot_state')
+        with open(pickle_path, 'wb') as f:
+            pickle.dump({'bot_data': {'users': LegacyUserList(legacy_users(0))}, 'chat_data': {-5: {'users': {1}}},
+                         'user_data': {1: {'key': 'value'}}, 'conversations': {'add_goal': {(1, 1): 2}}}, f)
+        persistence = SQLitePersistence(self.path)
+        import_pickle(pickle_path, persistence)
+        persistence.close()
+
+        persistence = SQLitePersistence(self.path)
+        users = persistence.load_bot_data()['users']
+        self.assertEqual([user.id for user in users], [1, 2])
+        self.assertEqual((users[1].name, users[1].authorized, users[1].chat_id), ('user', True, 1))
+        self.assert_goals(users[1].goals)
+        self.assertEqual(persistence.load_chat_data()[-5], {'users': {1}})
+        self.assertEqual(persistence.load_user_data()[1], {'key': 'value'})
+        self.assertEqual(persistence.load_conversations('add_goal'), {(1, 1): 2})
+        persistence.close()
+
+    def create_database(self, version: int):
+        connection = sqlite3.connect(self.path, isolation_level=None)
+        connection.executescript(schemas[version])
+        if version > 1:
+            connection.execute(f'PRAGMA user_version = {version}')
+        connection.execute('INSERT INTO users (id, name, authorized, chat_id, goal_polls) VALUES (?, ?, ?, ?, ?)',
+                           (1, 'user', 1, 1, pickle.dumps({'poll': 1})))
+        for position, goal in enumerate(recorded_goals()):
+            config = goal.config()
+            columns = [1, position, *config.values()]
+            state = goal.state(version)
+            if version == 2:
+                columns += [state['window_sum'], state['streak']]
+            elif version >= 3:
+                columns += [state['window_sum'], state['streak'], bytes(state['lead']) or None, state['lead_streak'],
+                            None if state['pinned'] is None else pickle.dumps(state['pinned'])]
+                if version == 4:
+                    columns.append(None)
+            connection.execute(f'INSERT INTO goals VALUES ({", ".join("?" * len(columns))})', columns)
+            points = zip(goal.stored.times, goal.stored.values) if version >= 3 else \
+                zip(goal.stored.times, goal.stored.values, *state['scores'] if version == 2 else
+                    (goal.stored.streaks, goal.stored.averages, goal.stored.amounts))
+            for point in points:
+                connection.execute(f'INSERT INTO data_points VALUES ({", ".join("?" * (len(point) + 2))})',
+                                   (1, position, *point))
+        connection.execute('INSERT INTO bot_data (key, data) VALUES (?, ?)', ('setting', pickle.dumps(1)))
+        connection.execute('INSERT INTO chat_data (chat_id, key, data) VALUES (?, ?, ?)',
+                           (-5, 'users', pickle.dumps({1})))
+        connection.close()
+
+    def load_database(self) -> Optional[UserList]:
+        persistence = SQLitePersistence(self.path)
+        try:
+            self.assertEqual(persistence.load_bot_data()['setting'], 1)
+            self.assertEqual(persistence.load_chat_data()[-5], {'users': {1}})
+            return persistence.load_bot_data()['users']
+        finally:
+            persistence.close()
+
+    def test_databases_of_every_schema_version_are_migrated(self):
+        for version in range(1, SCHEMA_VERSION):
+            with self.subTest(version=version):
+                self.create_database(version)
+                users = self.load_database()
+                user = users[1]
+                self.assertEqual((user.name, user.authorized, user.chat_id, user.goal_polls),
+                                 ('user', True, 1, {'poll': 1}))
+                self.assert_goals(user.goals)
+
+                connection = sqlite3.connect(self.path)
+                self.assertEqual(connection.execute('PRAGMA user_version').fetchone()[0], SCHEMA_VERSION)
+                connection.close()
+                # written and read again by the current version
+                self.assert_goals(self.load_database()[1].goals)
+                os.remove(self.path)
+
+    def test_newer_databases_are_not_opened(self):
+        connection = sqlite3.connect(self.path, isolation_level=None)
+        connection.executescript(schemas[4])
+        connection.execute(f'PRAGMA user_version = {SCHEMA_VERSION + 1}')
+        connection.close()
+        with self.assertRaises(RuntimeError):
+            SQLitePersistence(self.path)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,166 @@
+import asyncio
+import selectors
+import unittest
+from types import SimpleNamespace
+from typing import Dict, List, Tuple
+from unittest import mock
+from telegram.error import RetryAfter
+from messaging import OutboundQueue, Priority
+
+
+class TimeTravellingSelector(selectors.DefaultSelector):
+    """Advances a virtual clock by the timeout instead of waiting, when nothing is ready"""
+
+    def __init__(self):
+        super().__init__()
+        self.now = 0.
+
+    def select(self, timeout=None):
+        ready = super().select(0)
+        if len(ready) == 0:
+            if timeout is None:
+                raise RuntimeError('The event loop would wait forever')
+            self.now += timeout
+        return ready
+
+
+class VirtualTimeLoop(asyncio.SelectorEventLoop):
+    def __init__(self):
+        super().__init__(TimeTravellingSelector())
+
+    def time(self) -> float:
+        return self._selector.now
+
+
+class FakeBot:
+    """Records the time of every message, raises RetryAfter for the chats in ``flood_limits`` first"""
+
+    def __init__(self, loop: VirtualTimeLoop, flood_limits: Dict[int, List[int]] = None):
+        self.loop = loop
+        self.flood_limits = flood_limits or {}
+        self.sent: List[Tuple[float, int, str]] = []
+        self.refused: List[Tuple[float, int, str]] = []
+
+    async def send_message(self, chat_id: int, text: str, **kwargs) -> str:
+        now = self.loop.time()
+        # a round trip to Telegram
+        await asyncio.sleep(0.05)
+        if len(self.flood_limits.get(chat_id, [])) > 0:
+            self.refused.append((now, chat_id, text))
+            raise RetryAfter(self.flood_limits[chat_id].pop(0))
+        self.sent.append((now, chat_id, text))
+        return text
+
+
+class OutboundQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.loop = VirtualTimeLoop()
+        self.addCleanup(self.loop.close)
+        patcher = mock.patch('messaging.outbound.time', SimpleNamespace(monotonic=self.loop.time))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def run_queue(self, send, bot: FakeBot = None, **options) -> FakeBot:
+        """Runs ``await send(queue)`` on the virtual clock and waits until the queue is drained"""
+        bot = bot or FakeBot(self.loop)
+
+        async def run():
+            queue = OutboundQueue(bot, **options)
+            await send(queue)
+            await queue.stop()
+
+        with mock.patch('builtins.print'):
+            self.loop.run_until_complete(run())
+        return bot
+
+    def assert_rate(self, times: List[float], rate: float, burst: float):
+        """No more than ``burst`` messages at once and ``rate`` per second on top"""
+        for first in range(len(times)):
+            for last in range(first, len(times)):
+                self.assertLessEqual(last - first + 1, burst + rate * (times[last] - times[first]) + 1e-9)
+
+    def test_private_chats_are_limited_to_their_rate_after_a_burst(self):
+        async def send(queue: OutboundQueue):
+            await asyncio.gather(*(queue.send_message(1, str(index)) for index in range(10)))
+
+        bot = self.run_queue(send, chat_rate=1., chat_burst=2.)
+        times = [time for time, _, _ in bot.sent]
+        self.assertEqual([text for _, _, text in bot.sent], [str(index) for index in range(10)])
+        self.assert_rate(times, 1., 2.)
+        # and no slower than that
+        self.assertAlmostEqual(times[-1], 8., delta=0.1)
+
+    def test_group_chats_are_limited_to_their_rate(self):
+        async def send(queue: OutboundQueue):
+            await asyncio.gather(*(queue.send_message(-100, str(index)) for index in range(4)))
+
+        bot = self.run_queue(send, group_rate=20. / 60)
+        times = [time for time, _, _ in bot.sent]
+        self.assert_rate(times, 20. / 60, 1.)
+        self.assertAlmostEqual(times[-1], 9., delta=0.1)
+
+    def test_all_chats_together_are_limited_to_the_global_rate(self):
+        async def send(queue: OutboundQueue):
+            await asyncio.gather(*(queue.send_message(chat_id, 'hi') for chat_id in range(1, 91)))
+
+        bot = self.run_queue(send, global_rate=30.)
+        times = [time for time, _, _ in bot.sent]
+        self.assertEqual(sorted(chat_id for _, chat_id, _ in bot.sent), list(range(1, 91)))
+        self.assert_rate(times, 30., 1.)
+        self.assertAlmostEqual(times[-1], 89 / 30., delta=0.1)
+
+    def test_interactive_messages_are_sent_before_scheduled_ones(self):
+        async def send(queue: OutboundQueue):
+            scheduled = [queue.send_message(chat_id, 'scheduled') for chat_id in range(1, 61)]
+            queue.send_message(1000, 'first interactive', Priority.INTERACTIVE)
+            await asyncio.sleep(0.5)
+            # one arriving while the scheduled messages are being sent jumps the queue as well
+            queue.send_message(1001, 'second interactive', Priority.INTERACTIVE)
+            await asyncio.gather(*scheduled)
+
+        bot = self.run_queue(send, global_rate=30.)
+        texts = [text for _, _, text in bot.sent]
+        self.assertEqual(texts[0], 'first interactive')
+        second = texts.index('second interactive')
+        sent_before = [time for time, _, _ in bot.sent[:second]]
+        self.assertLessEqual(sent_before[-1], 0.5)
+        self.assertLess(bot.sent[second][0], 0.5 + 1 / 30. + 1e-9)
+        self.assertEqual(len(texts), 62)
+
+    def test_chats_resume_after_the_time_requested_by_retry_after(self):
+        bot = FakeBot(self.loop, flood_limits={1: [5]})
+        results = []
+
+        async def send(queue: OutboundQueue):
+            results.extend(await asyncio.gather(*(queue.send_message(1, str(index)) for index in range(3)),
+                                                *(queue.send_message(2, 'other chat') for _ in range(3))))
+
+        # without a burst, no other message to the chat is sent before the flood limit is reported
+        self.run_queue(send, bot, chat_rate=1., chat_burst=1.)
+        self.assertEqual(results, ['0', '1', '2'] + ['other chat'] * 3)
+        (refused_at, _, _), = bot.refused
+        flood_limit_end = refused_at + 0.05 + 5
+        chat_times = [time for time, chat_id, _ in bot.sent if chat_id == 1]
+        # the chat is paused (and then limited to its rate again), the other chat is not held up
+        self.assertTrue(all(time >= flood_limit_end for time in chat_times))
+        self.assertLessEqual(chat_times[0], flood_limit_end + 1. + 1e-9)
+        self.assert_rate(chat_times, 1., 1.)
+        self.assertTrue(all(time < flood_limit_end for time, chat_id, _ in bot.sent if chat_id == 2))
+
+    def test_requests_fail_after_too_many_flood_limits(self):
+        bot = FakeBot(self.loop, flood_limits={1: [1] * 3})
+        errors = []
+
+        async def send(queue: OutboundQueue):
+            try:
+                await queue.send_message(1, 'never sent')
+            except RetryAfter as e:
+                errors.append(e)
+
+        self.run_queue(send, bot, max_retries=2)
+        self.assertEqual((len(errors), len(bot.refused), bot.sent), (1, 3, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
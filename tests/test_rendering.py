@@ -0,0 +1,95 @@
+import asyncio
+import threading
+import unittest
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from unittest import mock
+from common import goal_score_types
+from model import Goal
+from stats.chart_data import ChartData
+from stats.evaluation import ChartCache
+from stats.rendering import ChartRenderer, RendererBusy
+
+chart = ChartData([], [], [], [], [], 0, 0., 100.)
+
+
+class RenderingTest(unittest.TestCase):
+
+    def setUp(self):
+        self.release = threading.Event()
+        self.started = []
+
+        def render_chart(chart_data, chart_format):
+            self.started.append(chart_data)
+            self.release.wait(5)
+            return b'chart'
+
+        patcher = mock.patch('stats.rendering.render_chart', render_chart)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.addCleanup(self.release.set)
+
+    def renderer(self, workers: int, max_queued: int) -> ChartRenderer:
+        renderer = ChartRenderer(workers, max_queued, timeout=0.05)
+        # threads stand in for the worker processes
+        renderer._executor = ThreadPoolExecutor(workers)
+        self.addCleanup(renderer._executor.shutdown)
+        return renderer
+
+    def test_timed_out_renders_keep_their_slot_until_the_worker_is_done(self):
+        renderer = self.renderer(workers=1, max_queued=1)
+
+        async def run():
+            with self.assertRaises(asyncio.TimeoutError):
+                await renderer.render(chart)
+            # the worker is still rendering the chart
+            with self.assertRaises(RendererBusy):
+                await renderer.render(chart)
+            self.release.set()
+            renderer._executor.submit(lambda: None).result(5)
+            return await renderer.render(chart)
+
+        self.assertEqual(asyncio.run(run()), b'chart')
+
+    def test_timed_out_renders_that_have_not_started_are_cancelled(self):
+        renderer = self.renderer(workers=1, max_queued=2)
+
+        async def run():
+            first = asyncio.ensure_future(renderer.render(chart))
+            await asyncio.sleep(0.01)
+            # queued behind the first render, which occupies the only worker
+            with self.assertRaises(asyncio.TimeoutError):
+                await renderer.render(chart)
+            with self.assertRaises(asyncio.TimeoutError):
+                await first
+            self.release.set()
+            self.assertEqual(await renderer.render(chart), b'chart')
+
+        asyncio.run(run())
+        # the cancelled render has never been started
+        self.assertEqual(len(self.started), 2)
+
+
+class ChartCacheTest(unittest.TestCase):
+
+    def test_charts_are_reused_on_the_day_they_have_been_rendered_only(self):
+        cache = ChartCache()
+        goals = [Goal('run', '0 11 * * *', goal_score_types[1], 10, 1)]
+        goals[0].add_data(1, datetime(2021, 2, 1, 11))
+        with mock.patch('stats.evaluation.datetime', wraps=datetime) as clock:
+            clock.now.return_value = datetime(2021, 2, 1, 12)
+            cache.put(cache.key(goals, True), 'file id')
+            clock.now.return_value = datetime(2021, 2, 1, 23)
+            self.assertEqual(cache.get(cache.key(goals, True)), 'file id')
+            clock.now.return_value = datetime(2021, 2, 2, 8)
+            self.assertIsNone(cache.get(cache.key(goals, True)))
+
+    def test_charts_of_deleted_goals_are_not_reused_for_goals_with_the_same_title(self):
+        cache = ChartCache()
+        goal = Goal('run', '0 11 * * *', goal_score_types[1], 10, 1)
+        cache.put(cache.key([goal], True), 'file id')
+        self.assertIsNone(cache.get(cache.key([Goal('run', '0 11 * * *', goal_score_types[1], 10, 1)], True)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+import unittest
+from telegram import Update
+from sharding import ShardRouter
+from sharding.ipc import update_owner
+
+user = {'id': 7, 'is_bot': False, 'first_name': 'user'}
+private_chat = {'id': 7, 'type': 'private'}
+group_chat = {'id': -100123, 'type': 'group'}
+message = {'message_id': 1, 'date': 1612177200, 'from': user, 'chat': group_chat, 'text': 'hi'}
+updates = [
+    {'update_id': 1, 'message': message},
+    {'update_id': 2, 'edited_message': dict(message, edit_date=1612177300)},
+    {'update_id': 3, 'callback_query': {'id': '1', 'from': user, 'chat_instance': '1', 'data': 'gc',
+                                        'message': dict(message, chat=private_chat)}},
+    {'update_id': 4, 'callback_query': {'id': '1', 'from': user, 'chat_instance': '1', 'inline_message_id': '1'}},
+    {'update_id': 5, 'channel_post': {'message_id': 1, 'date': 1612177200, 'chat': {'id': -100456, 'type': 'channel'},
+                                      'sender_chat': {'id': -100456, 'type': 'channel'}, 'text': 'hi'}},
+    {'update_id': 6, 'poll_answer': {'poll_id': '1', 'user': user, 'option_ids': [0]}},
+    {'update_id': 7, 'my_chat_member': {'chat': group_chat, 'from': user, 'date': 1612177200,
+                                        'old_chat_member': {'status': 'left', 'user': user},
+                                        'new_chat_member': {'status': 'member', 'user': user}}},
+    {'update_id': 8, 'poll': {'id': '1', 'question': 'q', 'options': [], 'total_voter_count': 0, 'is_closed': False,
+                              'is_anonymous': True, 'type': 'regular', 'allows_multiple_answers': False}},
+]
+
+
+class ShardingTest(unittest.TestCase):
+
+    def test_updates_are_routed_to_the_same_shard_without_decoding_them(self):
+        router = ShardRouter(3, 'state.sqlite')
+        for data in updates:
+            with self.subTest(update=next(key for key in data if key != 'update_id')):
+                update = Update.de_json(data, None)
+                owner = update.effective_user or update.effective_chat
+                self.assertEqual(update_owner(data), owner.id if owner is not None else None)
+                self.assertEqual(update_owner(data) % 3 if update_owner(data) is not None else 0,
+                                 router.shard_of_update(update))
+
+
+if __name__ == '__main__':
+    unittest.main()
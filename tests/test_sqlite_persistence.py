@@ -0,0 +1,199 @@
+import asyncio
+import os
+import sqlite3
+import tempfile
+import unittest
+from datetime import datetime, timedelta
+from model import Goal, User, UserList
+from persistence import SQLitePersistence, BotData
+
+
+def make_user(user_id: int, points: int = 5) -> User:
+    user = User(user_id)
+    user.authorized = True
+    goal = Goal('goal', '0 11 * * *', 'Floating Average (x/10)', 10, user_id)
+    for day in range(points):
+        goal.add_data(day % 2, datetime(2021, 1, 1, 11) + timedelta(days=day))
+    user.add_goal(goal)
+    return user
+
+
+class SQLitePersistenceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'state.sqlite')
+        self.persistence = SQLitePersistence(self.path)
+
+    def tearDown(self):
+        self.persistence.close()
+        self.directory.cleanup()
+
+    def fail_inserts(self, table: str, condition: str = '1'):
+        self.persistence._connection.execute(f"CREATE TEMP TRIGGER fail_{table} BEFORE INSERT ON {table} "
+                                             f"WHEN {condition} BEGIN SELECT RAISE(ABORT, 'injected failure'); END")
+
+    def allow_inserts(self, table: str):
+        self.persistence._connection.execute(f'DROP TRIGGER fail_{table}')
+
+    def reopened(self) -> SQLitePersistence:
+        self.persistence.close()
+        self.persistence = SQLitePersistence(self.path)
+        return self.persistence
+
+    def with_journal(self) -> SQLitePersistence:
+        self.persistence.close()
+        self.persistence = SQLitePersistence(self.path, on_flush=True,
+                                             journal_path=os.path.join(self.directory.name, 'answers.journal'))
+        return self.persistence
+
+    def crashed(self) -> SQLitePersistence:
+        """Reopens the database like after the process died, without writing or compacting anything"""
+        journal_path = self.persistence.journal.path
+        self.persistence.journal.close()
+        self.persistence._connection.close()
+        self.persistence._executor.shutdown()
+        self.persistence = SQLitePersistence(self.path, on_flush=True, journal_path=journal_path)
+        return self.persistence
+
+    def test_users_are_written_again_after_a_failed_transaction(self):
+        self.persistence.save_bot_data(BotData(users=UserList([make_user(1)])))
+        users = self.persistence.bot_data['users']
+        users[1].goals[0].add_data(1, datetime(2021, 2, 1, 11))
+        users.mark_dirty(1)
+
+        self.fail_inserts('goals')
+        with self.assertRaises(sqlite3.DatabaseError):
+            self.persistence.checkpoint()
+        self.allow_inserts('goals')
+        self.persistence.checkpoint()
+
+        loaded = self.reopened().load_bot_data()['users'][1].goals[0]
+        self.assertEqual(list(loaded.times), list(users[1].goals[0].times))
+        self.assertEqual(loaded.values, users[1].goals[0].values)
+
+    def test_bot_data_is_written_again_after_a_failed_transaction(self):
+        self.persistence.save_bot_data(BotData(users=UserList(), a=1, b=1))
+        self.persistence.bot_data.update(a=2, b=2)
+
+        # the first row is written before the transaction fails
+        self.fail_inserts('bot_data', "NEW.key = 'b'")
+        with self.assertRaises(sqlite3.DatabaseError):
+            self.persistence.checkpoint()
+        self.allow_inserts('bot_data')
+        self.persistence.checkpoint()
+
+        bot_data = self.reopened().load_bot_data()
+        self.assertEqual((bot_data['a'], bot_data['b']), (2, 2))
+
+    def test_chat_data_is_written_again_after_a_failed_transaction(self):
+        self.persistence.load_chat_data()
+        self.fail_inserts('chat_data', "NEW.key = 'b'")
+        with self.assertRaises(sqlite3.DatabaseError):
+            self.persistence.save_chat_data(-5, {'a': 1, 'b': 2})
+        self.allow_inserts('chat_data')
+        self.persistence.checkpoint()
+
+        self.assertEqual(self.reopened().load_chat_data()[-5], {'a': 1, 'b': 2})
+
+    def test_user_data_is_written_again_after_a_failed_transaction(self):
+        self.persistence.close()
+        self.persistence = SQLitePersistence(self.path, on_flush=True)
+        self.persistence.load_user_data()
+        self.persistence.save_user_data(1, {'key': 1})
+        self.persistence.save_user_data(2, {'key': 2})
+        self.fail_inserts('user_data', 'NEW.user_id = 2')
+        with self.assertRaises(sqlite3.DatabaseError):
+            self.persistence.checkpoint()
+        self.allow_inserts('user_data')
+        self.persistence.checkpoint()
+
+        user_data = self.reopened().load_user_data()
+        self.assertEqual((user_data[1], user_data[2]), ({'key': 1}, {'key': 2}))
+
+    def test_staged_rows_are_not_affected_by_later_changes(self):
+        self.persistence.save_bot_data(BotData(users=UserList([make_user(1, points=120)])))
+        self.persistence.save_chat_data(1, {'dialogs': {'a': {'expires': 1e12}}})
+        users = self.persistence.bot_data['users']
+        goal = users[1].goals[0]
+        goal.add_data(1, datetime(2021, 6, 1, 11))
+        users.mark_dirty(1)
+        self.persistence.chat_data[1]['dialogs']['b'] = {'expires': 1e12}
+        self.persistence._dirty_chats.add(1)
+        expected = (list(goal.times), bytes(goal.values), goal.calculate_score_floating_amount(),
+                    goal.calculate_score_days())
+
+        staged = self.persistence._stage_checkpoint()
+        # changed by the handlers while the worker thread writes the staged rows
+        for day in range(150):
+            goal.add_data(0, datetime(2021, 7, 1, 11) + timedelta(days=day))
+        goal.add_data(1, datetime(2021, 5, 1, 11))
+        self.persistence.chat_data[1]['dialogs']['c'] = {'expires': 1e12}
+        self.persistence._commit(staged)
+
+        persistence = self.reopened()
+        loaded = persistence.load_bot_data()['users'][1].goals[0]
+        self.assertEqual((list(loaded.times), bytes(loaded.values), loaded.calculate_score_floating_amount(),
+                          loaded.calculate_score_days()), expected)
+        self.assertEqual(sorted(persistence.load_chat_data()[1]['dialogs']), ['a', 'b'])
+
+    def test_coroutines_write_through_the_worker_thread(self):
+        async def update():
+            await self.persistence.update_bot_data(BotData(users=UserList([make_user(1)]), setting=1))
+            await self.persistence.update_chat_data(-5, {'users': {1}})
+            await self.persistence.update_user_data(1, {'key': 'value'})
+            await self.persistence.update_conversation('dialog', (1, 1), 2)
+            self.persistence.bot_data['users'][1].goals[0].add_data(1, datetime(2021, 2, 1, 11))
+            self.persistence.bot_data['users'].mark_dirty(1, deferred=True)
+            await self.persistence.flush()
+
+        asyncio.run(update())
+        persistence = self.reopened()
+        self.assertEqual(len(persistence.load_bot_data()['users'][1].goals[0].times), 6)
+        self.assertEqual(persistence.load_bot_data()['setting'], 1)
+        self.assertEqual(persistence.load_chat_data()[-5], {'users': {1}})
+        self.assertEqual(persistence.load_user_data()[1], {'key': 'value'})
+        self.assertEqual(persistence.load_conversations('dialog'), {(1, 1): 2})
+
+    def test_journaled_answers_are_replayed_to_the_goal_with_their_key(self):
+        self.with_journal().save_bot_data(BotData(users=UserList([make_user(1)])))
+        self.persistence.checkpoint()
+        users = self.persistence.bot_data['users']
+        deleted = users[1].goals[0]
+        self.persistence.journal.append(1, deleted.key, 'goal', datetime(2021, 3, 1, 11).timestamp(), 1)
+        users[1].remove_goal(deleted)
+        users[1].add_goal(Goal('goal', '0 11 * * *', 'Floating Average (x/10)', 10, 1))
+        recreated = users[1].goals[0]
+        users.mark_dirty(1)
+        # written without compacting the journal
+        self.persistence._write(self.persistence._stage(users=True))
+        self.persistence.journal.append(1, recreated.key, 'goal', datetime(2021, 3, 2, 11).timestamp(), 1)
+        # written before the goals had keys
+        self.persistence.journal.append(1, None, 'goal', datetime(2021, 3, 3, 11).timestamp(), 0)
+
+        # the process dies before the next flush
+        loaded = self.crashed().load_bot_data()['users'][1].goals[0]
+        self.assertEqual(loaded.key, recreated.key)
+        self.assertEqual((list(loaded.times), bytes(loaded.values)),
+                         ([datetime(2021, 3, day, 11).timestamp() for day in (2, 3)], b'\x01\x00'))
+
+    def test_answers_journaled_after_a_clean_restart_are_replayed(self):
+        self.with_journal().save_bot_data(BotData(users=UserList([make_user(1)])))
+        answered = datetime(2021, 3, 1, 11)
+        users = self.persistence.bot_data['users']
+        users[1].goals[0].add_data(1, answered)
+        asyncio.run(self.persistence.record_answer(users, 1, users[1].goals[0], answered.timestamp(), 1))
+        # closing the persistence compacts the journal
+        persistence = self.with_journal()
+        users = persistence.load_bot_data()['users']
+        answered += timedelta(days=1)
+        users[1].goals[0].add_data(0, answered)
+        asyncio.run(persistence.record_answer(users, 1, users[1].goals[0], answered.timestamp(), 0))
+
+        loaded = self.crashed().load_bot_data()['users'][1].goals[0]
+        self.assertEqual(len(loaded.times), 7)
+        self.assertEqual((loaded.times[-1], loaded.values[-1]), (answered.timestamp(), 0))
+
+
+if __name__ == '__main__':
+    unittest.main()